@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.contacts.address
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+from __future__ import unicode_literals
+from collections import namedtuple, OrderedDict
+import threading
+
+from django.utils.translation import ugettext_lazy as _
+
+from lucterios.contacts.models import PostalCode
+from lucterios.contacts.cacheversion import get_cache_version
+from lucterios.contacts.duplicate import normalize_text
+
+ADDRESS_VALID = 0
+ADDRESS_FIXED = 1
+ADDRESS_UNKNOWN_POSTAL_CODE = 2
+ADDRESS_CITY_MISMATCH = 3
+
+ADDRESS_STATUS = ((ADDRESS_VALID, _('valid')), (ADDRESS_FIXED, _('to normalize')),
+                  (ADDRESS_UNKNOWN_POSTAL_CODE, _('unknown postal code')), (ADDRESS_CITY_MISMATCH, _('city not matching postal code')))
+
+CITY_WORDS = {'saint': 'st', 'sainte': 'ste'}
+
+
+def get_city_key(city):
+    return " ".join([CITY_WORDS.get(word, word) for word in normalize_text(city).split()])
+
+
+class NormalizedAddress(namedtuple('NormalizedAddress', ['postal_code', 'city', 'country', 'status'])):
+
+    @property
+    def status_text(self):
+        return dict(ADDRESS_STATUS)[self.status]
+
+
+class AddressNormalizer(object):
+
+    MAX_CACHE_SIZE = 10000
+
+    _ADDRESS_CACHE = OrderedDict()
+    _cache_version = None
+    _cachelock = threading.RLock()
+
+    @classmethod
+    def clear_cache(cls):
+        cls._cachelock.acquire()
+        try:
+            cls._ADDRESS_CACHE.clear()
+            cls._cache_version = None
+        finally:
+            cls._cachelock.release()
+
+    @classmethod
+    def _normalize(cls, postal_code, city, country):
+        cities = PostalCode.get_cities(postal_code.strip())
+        if len(cities) == 0:
+            return NormalizedAddress(postal_code, city, country, ADDRESS_UNKNOWN_POSTAL_CODE)
+        city_key = get_city_key(city)
+        if city_key == '':
+            cities_found = cities
+        else:
+            cities_found = [(ref_city, ref_country) for ref_city, ref_country in cities if get_city_key(ref_city) == city_key]
+        if len(cities_found) != 1:
+            return NormalizedAddress(postal_code, city, country, ADDRESS_CITY_MISMATCH)
+        ref_city, ref_country = cities_found[0]
+        if (postal_code, city, country) == (postal_code.strip(), ref_city, ref_country):
+            return NormalizedAddress(postal_code, city, country, ADDRESS_VALID)
+        return NormalizedAddress(postal_code.strip(), ref_city, ref_country, ADDRESS_FIXED)
+
+    @classmethod
+    def normalize(cls, postal_code, city, country):
+        key = (postal_code, city, country)
+        cls._cachelock.acquire()
+        try:
+            current_version = get_cache_version(PostalCode.CACHE_VERSION_KEY)
+            if current_version != cls._cache_version:
+                cls._ADDRESS_CACHE.clear()
+                cls._cache_version = current_version
+            if key in cls._ADDRESS_CACHE:
+                cls._ADDRESS_CACHE.move_to_end(key)
+            else:
+                cls._ADDRESS_CACHE[key] = cls._normalize(postal_code, city, country)
+                if len(cls._ADDRESS_CACHE) > cls.MAX_CACHE_SIZE:
+                    cls._ADDRESS_CACHE.popitem(last=False)
+            return cls._ADDRESS_CACHE[key]
+        finally:
+            cls._cachelock.release()
+
+    @classmethod
+    def normalize_contacts(cls, contacts):
+        return [(contact, cls.normalize(contact.postal_code, contact.city, contact.country)) for contact in contacts]
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.contacts.autocomplete
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+from __future__ import unicode_literals
+from bisect import bisect_left, insort
+import threading
+
+from django.utils import six
+
+from lucterios.contacts.cacheversion import get_cache_version, change_cache_version
+from lucterios.contacts.duplicate import normalize_text, get_search_words
+
+
+class PrefixIndex(object):
+
+    def __init__(self):
+        self.keys = []
+        self.items = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item_id, label, kind=''):
+        self.remove(item_id)
+        words = sorted(set(get_search_words(label)))
+        self.items[item_id] = (six.text_type(label), kind, words)
+        for word in words:
+            insort(self.keys, (word, item_id))
+
+    def remove(self, item_id):
+        if item_id in self.items:
+            for word in self.items[item_id][2]:
+                pos = bisect_left(self.keys, (word, item_id))
+                if (pos < len(self.keys)) and (self.keys[pos] == (word, item_id)):
+                    del self.keys[pos]
+            del self.items[item_id]
+
+    def load(self, items):
+        self.keys = []
+        self.items = {}
+        for item_id, label, kind in items:
+            words = sorted(set(get_search_words(label)))
+            self.items[item_id] = (six.text_type(label), kind, words)
+            self.keys.extend([(word, item_id) for word in words])
+        self.keys.sort()
+
+    def _match_words(self, item_id, other_prefixes):
+        words = self.items[item_id][2]
+        for other_prefix in other_prefixes:
+            if not any(word.startswith(other_prefix) for word in words):
+                return False
+        return True
+
+    def search(self, prefix, limit=10, kind=''):
+        prefixes = get_search_words(prefix)
+        result = []
+        if len(prefixes) == 0:
+            return result
+        prefixes.sort(key=len, reverse=True)
+        first_prefix = prefixes[0]
+        item_ids = set()
+        pos = bisect_left(self.keys, (first_prefix,))
+        while (pos < len(self.keys)) and (len(result) < limit):
+            word, item_id = self.keys[pos]
+            if not word.startswith(first_prefix):
+                break
+            pos += 1
+            if item_id in item_ids:
+                continue
+            label, item_kind, _words = self.items[item_id]
+            if ((kind == '') or (item_kind == kind)) and self._match_words(item_id, prefixes[1:]):
+                item_ids.add(item_id)
+                result.append((item_id, label, item_kind))
+        return result
+
+
+class ContactPrefixIndex(object):
+
+    CACHE_VERSION_KEY = 'lucterios.contacts.prefixindex.version'
+
+    _index = None
+    _cache_version = None
+    _cachelock = threading.RLock()
+
+    @classmethod
+    def get_contact_models(cls):
+        from lucterios.contacts.models import LegalEntity, Individual
+        return [(LegalEntity, ['name']), (Individual, ['lastname', 'firstname'])]
+
+    @classmethod
+    def get_items(cls):
+        for model, name_fields in cls.get_contact_models():
+            kind = model.get_long_name()
+            for values in model.objects.values_list('id', *name_fields).iterator():
+                yield (values[0], " ".join([six.text_type(value) for value in values[1:]]), kind)
+
+    @classmethod
+    def clear(cls):
+        cls._cachelock.acquire()
+        try:
+            cls._index = None
+            cls._cache_version = None
+        finally:
+            cls._cachelock.release()
+
+    @classmethod
+    def get_index(cls):
+        cls._cachelock.acquire()
+        try:
+            current_version = get_cache_version(cls.CACHE_VERSION_KEY)
+            if (cls._index is None) or (current_version != cls._cache_version):
+                index = PrefixIndex()
+                index.load(cls.get_items())
+                cls._index = index
+                cls._cache_version = current_version
+            return cls._index
+        finally:
+            cls._cachelock.release()
+
+    @classmethod
+    def contact_changed(cls, contact, deleted=False):
+        cls.contacts_changed([contact], deleted)
+
+    @classmethod
+    def contacts_changed(cls, contacts, deleted=False):
+        def apply_change(new_version):
+            cls._cachelock.acquire()
+            try:
+                if (cls._index is None) or (cls._cache_version != new_version - 1):
+                    cls.clear()
+                    return
+                cls._cache_version = new_version
+                for model, name_fields in cls.get_contact_models():
+                    for contact in contacts:
+                        if isinstance(contact, model):
+                            if deleted:
+                                cls._index.remove(contact.id)
+                            else:
+                                label = " ".join([six.text_type(getattr(contact, name_field)) for name_field in name_fields])
+                                cls._index.add(contact.id, label, model.get_long_name())
+            finally:
+                cls._cachelock.release()
+        change_cache_version(cls.CACHE_VERSION_KEY, apply_change)
+
+    @classmethod
+    def search(cls, prefix, limit=10, kind=''):
+        if normalize_text(prefix) == '':
+            return []
+        cls._cachelock.acquire()
+        try:
+            return cls.get_index().search(prefix, limit, kind)
+        finally:
+            cls._cachelock.release()
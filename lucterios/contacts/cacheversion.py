@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.contacts.cacheversion
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+from __future__ import unicode_literals
+from itertools import count
+
+from django.core.cache import cache
+from django.db import transaction
+
+_change_serial = count(1)
+
+
+def get_pending_changes(connection):
+    pending_changes = getattr(connection, 'cache_version_changes', None)
+    if (pending_changes is None) or (pending_changes[0] is not connection.run_on_commit):
+        # commit, rollback and savepoint rollback all replace the list of hooks
+        pending_changes = (connection.run_on_commit, {})
+        for _sids, func in connection.run_on_commit:
+            if hasattr(func, 'cache_version_key'):
+                pending_changes[1][func.cache_version_key] = func.change_serial
+        connection.cache_version_changes = pending_changes
+    return pending_changes[1]
+
+
+def get_cache_version(key):
+    pending_serial = get_pending_changes(transaction.get_connection()).get(key)
+    if pending_serial is not None:
+        return ('pending', pending_serial)
+    return cache.get(key, 0)
+
+
+def change_cache_version(key, callback=None):
+    def bump_cache_version():
+        try:
+            new_version = cache.incr(key)
+        except ValueError:
+            new_version = 1
+            cache.set(key, new_version, None)
+        if callback is not None:
+            callback(new_version)
+    bump_cache_version.cache_version_key = key
+    bump_cache_version.change_serial = next(_change_serial)
+    connection = transaction.get_connection()
+    if connection.in_atomic_block:
+        get_pending_changes(connection)[key] = bump_cache_version.change_serial
+    transaction.on_commit(bump_cache_version)
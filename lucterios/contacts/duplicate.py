@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.contacts.duplicate
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+from __future__ import unicode_literals
+from unicodedata import normalize, combining
+import re
+
+from django.utils import six
+
+SOUNDEX_CODES = dict([(letter, six.text_type(code)) for code, letters in enumerate(['aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r']) for letter in letters])
+
+KEY_NAME = 'name'
+KEY_PHONETIC = 'phonetic'
+KEY_PHONE = 'phone'
+KEY_EMAIL = 'email'
+KEY_POSTAL_CODE = 'postal_code'
+
+KEY_WEIGHTS = {KEY_NAME: 0.5, KEY_PHONETIC: 0.3, KEY_PHONE: 0.3, KEY_EMAIL: 0.3, KEY_POSTAL_CODE: 0.1}
+BLOCKING_KEYS = (KEY_NAME, KEY_PHONETIC, KEY_PHONE, KEY_EMAIL)
+CONTACT_FIELDS = ['tel1', 'tel2', 'email', 'postal_code']
+MAX_KEY_LENGTH = 200
+
+
+def normalize_text(text):
+    text = normalize('NFKD', six.text_type(text)).lower()
+    text = "".join([char for char in text if not combining(char)])
+    return " ".join(re.sub(r'[^a-z0-9]+', ' ', text).split())
+
+
+def phonetic_key(text):
+    keys = []
+    for word in normalize_text(text).split():
+        word = re.sub(r'[^a-z]', '', word)
+        if word == '':
+            continue
+        key = word[0]
+        last_code = SOUNDEX_CODES.get(word[0], '')
+        for letter in word[1:]:
+            code = SOUNDEX_CODES.get(letter, '')
+            if (code != last_code) and (code not in ('', '0')):
+                key += code
+            if letter not in 'hw':
+                last_code = code
+        keys.append((key + '000')[:4])
+    return " ".join(sorted(keys))
+
+
+def normalize_phone(phone):
+    digits = re.sub(r'[^0-9]', '', six.text_type(phone))
+    if len(digits) < 6:
+        return ''
+    return digits[-9:]
+
+
+def email_local_parts(email):
+    local_parts = []
+    for email_item in six.text_type(email).split(';'):
+        local_part = normalize_text(email_item.split('@')[0]).replace(' ', '')
+        if local_part != '':
+            local_parts.append(local_part)
+    return local_parts
+
+
+def get_search_text(texts, phones):
+    words = [normalize_text(text) for text in texts]
+    words.extend([re.sub(r'[^0-9]', '', six.text_type(phone)) for phone in phones])
+    return " ".join([word for word in words if word != ''])
+
+
+def get_search_words(text):
+    return normalize_text(text).split()
+
+
+class DuplicateCluster(object):
+
+    def __init__(self, ids, score):
+        self.ids = sorted(ids)
+        self.score = score
+
+    def __repr__(self):
+        return "DuplicateCluster(%s, %.2f)" % (self.ids, self.score)
+
+
+class DuplicateFinder(object):
+
+    MAX_BLOCK_SIZE = 50
+    MIN_SCORE = 0.6
+
+    def __init__(self, model, name_fields=None):
+        self.model = model
+        if name_fields is None:
+            name_fields = [order_fd.lstrip('-') for order_fd in (model._meta.ordering or [])]
+        self.name_fields = name_fields
+
+    @classmethod
+    def get_keys(cls, name, phones, email, postal_code):
+        keys = {}
+        if normalize_text(name) != '':
+            keys[KEY_NAME] = set([normalize_text(name)[:MAX_KEY_LENGTH]])
+            keys[KEY_PHONETIC] = set([phonetic_key(name)[:MAX_KEY_LENGTH]])
+        keys[KEY_PHONE] = set([normalize_phone(phone) for phone in phones]) - set([''])
+        keys[KEY_EMAIL] = set([local_part[:MAX_KEY_LENGTH] for local_part in email_local_parts(email)])
+        if normalize_text(postal_code) != '':
+            keys[KEY_POSTAL_CODE] = set([normalize_text(postal_code)[:MAX_KEY_LENGTH]])
+        return keys
+
+    def get_values_keys(self, values):
+        name = " ".join([six.text_type(values[name_field]) for name_field in self.name_fields])
+        return self.get_keys(name, [values['tel1'], values['tel2']], values['email'], values['postal_code'])
+
+    def get_item_keys(self, item):
+        return self.get_values_keys(dict([(fieldname, getattr(item, fieldname)) for fieldname in CONTACT_FIELDS + self.name_fields]))
+
+    def get_contact_keys(self):
+        contact_keys = {}
+        for values in self.model.objects.values(*(['id'] + CONTACT_FIELDS + self.name_fields)).order_by('id'):
+            contact_keys[values['id']] = self.get_values_keys(values)
+        return contact_keys
+
+    @classmethod
+    def get_score(cls, keys1, keys2):
+        score = 0.0
+        for key_kind, key_weight in KEY_WEIGHTS.items():
+            if len(keys1.get(key_kind, set()) & keys2.get(key_kind, set())) > 0:
+                score += key_weight
+        return min(score, 1.0)
+
+    def get_blocks(self, contact_keys):
+        blocks = {}
+        for contact_id, keys in contact_keys.items():
+            for key_kind in BLOCKING_KEYS:
+                for key_value in keys.get(key_kind, ()):
+                    blocks.setdefault((key_kind, key_value), []).append(contact_id)
+        return [block for block in blocks.values() if 1 < len(block) <= self.MAX_BLOCK_SIZE]
+
+    def find_clusters(self, contact_keys=None):
+        if contact_keys is None:
+            contact_keys = self.get_contact_keys()
+        parents = {}
+
+        def find_root(contact_id):
+            while parents.get(contact_id, contact_id) != contact_id:
+                contact_id = parents[contact_id]
+            return contact_id
+        scores = {}
+        pairs_done = set()
+        for block in self.get_blocks(contact_keys):
+            for idx1, contact_id1 in enumerate(block):
+                for contact_id2 in block[idx1 + 1:]:
+                    if (contact_id1, contact_id2) in pairs_done:
+                        continue
+                    pairs_done.add((contact_id1, contact_id2))
+                    score = self.get_score(contact_keys[contact_id1], contact_keys[contact_id2])
+                    if score >= self.MIN_SCORE:
+                        root1 = find_root(contact_id1)
+                        root2 = find_root(contact_id2)
+                        root = min(root1, root2)
+                        parents[root1] = root
+                        parents[root2] = root
+                        scores[root] = max(scores.get(root1, 0.0), scores.get(root2, 0.0), score)
+        clusters = {}
+        for contact_id in parents.keys():
+            clusters.setdefault(find_root(contact_id), []).append(contact_id)
+        result = [DuplicateCluster(ids, scores[root]) for root, ids in clusters.items()]
+        result.sort(key=lambda cluster: (-cluster.score, cluster.ids[0]))
+        return result
+
+    def get_duplicate_ids(self, contact_keys=None):
+        duplicate_ids = []
+        for cluster in self.find_clusters(contact_keys):
+            duplicate_ids.extend(cluster.ids)
+        return duplicate_ids
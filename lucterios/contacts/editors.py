@@ -23,20 +23,19 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import unicode_literals
-from os import unlink
-from os.path import exists
 
 from django.utils import six
 from django.utils.translation import ugettext_lazy as _
 
-from lucterios.framework.filetools import save_from_base64, get_user_path, open_image_resize, readimage_to_base64
+from lucterios.framework.filetools import save_from_base64
 from lucterios.framework.xfercomponents import XferCompEdit, XferCompFloat, XferCompCheck, XferCompSelect, \
     XferCompMemo, XferCompUpLoad, XferCompImage, XferCompButton, XferCompLinkLabel
-from lucterios.framework.tools import FORMTYPE_REFRESH, FORMTYPE_MODAL, CLOSE_NO, CLOSE_YES, get_icon_path, WrapAction
+from lucterios.framework.tools import FORMTYPE_REFRESH, FORMTYPE_MODAL, CLOSE_NO, CLOSE_YES, WrapAction
 from lucterios.framework.tools import ActionsManage
 from lucterios.framework.editors import LucteriosEditor
 
-from lucterios.contacts.models import PostalCode, CustomField
+from lucterios.contacts.models import PostalCode, CustomField, CustomFieldArgs
+from lucterios.contacts.images import ImageProcessor, fill_image
 from lucterios.CORE.parameters import Params
 from lucterios.framework import signal_and_lock
 from lucterios.CORE.views import ObjectPromote
@@ -45,29 +44,29 @@ from lucterios.CORE.views import ObjectPromote
 class CustomFieldEditor(LucteriosEditor):
 
     def _edit_add_args(self, xfer, obj_kind):
-        args = self.item.get_args()
+        args = self.item.args_spec
         arg = XferCompCheck('args_multi')
-        arg.set_value(args['multi'])
+        arg.set_value(args.multi)
         arg.set_location(obj_kind.col, obj_kind.row + 1, obj_kind.colspan, 1)
         arg.description = _('multi-line')
         xfer.add_component(arg)
         arg = XferCompFloat('args_min', -10000, 10000, 0)
-        arg.set_value(args['min'])
+        arg.set_value(args.min)
         arg.set_location(obj_kind.col, obj_kind.row + 2, obj_kind.colspan, 1)
         arg.description = _('min')
         xfer.add_component(arg)
         arg = XferCompFloat('args_max', -10000, 10000, 0)
-        arg.set_value(args['max'])
+        arg.set_value(args.max)
         arg.set_location(obj_kind.col, obj_kind.row + 3, obj_kind.colspan, 1)
         arg.description = _('max')
         xfer.add_component(arg)
         arg = XferCompFloat('args_prec', 0, 10, 0)
-        arg.set_value(args['prec'])
+        arg.set_value(args.prec)
         arg.set_location(obj_kind.col, obj_kind.row + 4, obj_kind.colspan, 1)
         arg.description = _('precision')
         xfer.add_component(arg)
         arg = XferCompEdit('args_list')
-        arg.set_value(','.join(args['list']))
+        arg.set_value(','.join(args.list))
         arg.set_location(obj_kind.col, obj_kind.row + 5, obj_kind.colspan, 1)
         arg.description = _('list')
         xfer.add_component(arg)
@@ -115,33 +114,30 @@ parent.get('args_list').setVisible(type==4);
                     args[arg_name] = (args_val != 'False') and (args_val != '0') and (args_val != '') and (args_val != 'n')
                 else:
                     args[arg_name] = float(args_val)
-        self.item.args = six.text_type(args)
+        self.item.args = CustomFieldArgs.create(args).to_json()
         LucteriosEditor.saving(self, xfer)
         self.item.save()
 
     def get_comp(self, value):
         comp = None
-        args = self.item.get_args()
+        args = self.item.args_spec
         if self.item.kind == 0:
-            if args['multi']:
+            if args.multi:
                 comp = XferCompMemo(self.item.get_fieldname())
             else:
                 comp = XferCompEdit(self.item.get_fieldname())
             comp.set_value(value)
         elif (self.item.kind == 1) or (self.item.kind == 2):
             comp = XferCompFloat(
-                self.item.get_fieldname(), args['min'], args['max'], args['prec'])
+                self.item.get_fieldname(), args.min, args.max, args.prec)
             comp.set_value(value)
         elif self.item.kind == 3:
             comp = XferCompCheck(self.item.get_fieldname())
             comp.set_value(value)
         elif self.item.kind == 4:
-            val_selected = value
-            select_id = 0
+            select_id = args.list_index.get(value, 0)
             select_list = []
-            for sel_item in args['list']:
-                if sel_item == val_selected:
-                    select_id = len(select_list)
+            for sel_item in args.list:
                 select_list.append((len(select_list), sel_item))
             comp = XferCompSelect(self.item.get_fieldname())
             comp.set_select(select_list)
@@ -157,13 +153,12 @@ class AbstractContactEditor(LucteriosEditor):
         city_current = obj_city.value
         city_list = {}
         obj_country.value = ""
-        for item_postalcode in list_postalcode:
-            city_list[item_postalcode.city] = item_postalcode.city
-            if item_postalcode.city == city_current:
-                obj_country.value = item_postalcode.country
+        for city, country in list_postalcode:
+            city_list[city] = city
+            if city == city_current:
+                obj_country.value = country
         if obj_country.value == "":
-            obj_country.value = list_postalcode[0].country
-            city_current = list_postalcode[0].city
+            city_current, obj_country.value = list_postalcode[0]
         xfer.remove_component('city')
         xfer.tab = obj_city.tab
         city_select = XferCompSelect('city')
@@ -180,8 +175,7 @@ class AbstractContactEditor(LucteriosEditor):
         obj_pstcd.set_action(xfer.request, xfer.get_action(), modal=FORMTYPE_REFRESH, close=CLOSE_NO)
         obj_city = xfer.get_components('city')
         postalcode_current = obj_pstcd.value
-        list_postalcode = PostalCode.objects.filter(
-            postal_code=postalcode_current)
+        list_postalcode = PostalCode.get_cities(postalcode_current)
         if len(list_postalcode) > 0:
             self._change_city_select(xfer, list_postalcode, obj_city)
         obj_cmt = xfer.get_components('comment')
@@ -205,13 +199,8 @@ class AbstractContactEditor(LucteriosEditor):
         xfer.tab = obj_addr.tab
         new_col = obj_addr.col
         xfer.move(obj_addr.tab, 1, 0)
-        img_path = get_user_path("contacts", "Image_%s.jpg" % self.item.abstractcontact_ptr_id)
         img = XferCompImage('logoimg')
-        if exists(img_path):
-            img.type = 'jpg'
-            img.set_value(readimage_to_base64(img_path))
-        else:
-            img.set_value(get_icon_path("lucterios.contacts/images/NoImage.png"))
+        fill_image(img, self.item.abstractcontact_ptr_id)
         img.set_location(new_col, obj_addr.row, 1, 6)
         xfer.add_component(img)
         if WrapAction.is_permission(xfer.request, 'contacts.add_abstractcontact'):
@@ -226,14 +215,7 @@ class AbstractContactEditor(LucteriosEditor):
     def saving(self, xfer):
         uploadlogo = xfer.getparam('uploadlogo')
         if uploadlogo is not None:
-            tmp_file = save_from_base64(uploadlogo)
-            with open(tmp_file, "rb") as image_tmp:
-                image = open_image_resize(image_tmp, 100, 100)
-                image = image.convert("RGB")
-                img_path = get_user_path("contacts", "Image_%s.jpg" % self.item.abstractcontact_ptr_id)
-                with open(img_path, "wb") as image_file:
-                    image.save(image_file, 'JPEG', quality=90)
-            unlink(tmp_file)
+            ImageProcessor.submit(self.item.abstractcontact_ptr_id, save_from_base64(uploadlogo))
         LucteriosEditor.saving(self, xfer)
         self.item.set_custom_values(xfer.params)
 
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.contacts.images
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+from __future__ import unicode_literals
+from os import stat, replace, unlink, listdir
+from os.path import join, dirname, relpath, isfile, isdir, getmtime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from shutil import move
+from hashlib import md5
+from base64 import b64encode
+from time import time, sleep
+import threading
+import logging
+import re
+
+from django.utils import six
+
+from lucterios.framework.filetools import get_user_path, get_user_dir, BASE64_PREFIX, open_image_resize
+from lucterios.framework.tools import get_icon_path, get_binay
+from lucterios.CORE.parameters import Params
+
+NO_IMAGE_PATH = join(dirname(__file__), "static", 'lucterios.contacts', "images", "NoImage.png")
+NO_IMAGE_ICON = "lucterios.contacts/images/NoImage.png"
+
+IMAGE_SHOW = ''
+IMAGE_THUMBNAIL = '_thumb'
+IMAGE_PRINT = '_print'
+IMAGE_SIZES = ((IMAGE_SHOW, 100), (IMAGE_THUMBNAIL, 32), (IMAGE_PRINT, 300))
+
+IMAGE_FILE_PATTERN = re.compile(r'^Image_([0-9]+)[_.]')
+
+
+class ImageCache(object):
+
+    MAX_SIZE = 200
+
+    _IMAGES_CACHE = OrderedDict()
+    _cachelock = threading.RLock()
+
+    @classmethod
+    def clear(cls):
+        cls._cachelock.acquire()
+        try:
+            cls._IMAGES_CACHE.clear()
+        finally:
+            cls._cachelock.release()
+
+    @classmethod
+    def get(cls, file_path):
+        try:
+            mtime = stat(file_path).st_mtime
+        except OSError:
+            return None
+        cls._cachelock.acquire()
+        try:
+            cached = cls._IMAGES_CACHE.get(file_path)
+            if (cached is not None) and (cached[0] == mtime):
+                cls._IMAGES_CACHE.move_to_end(file_path)
+                return cached[1]
+        finally:
+            cls._cachelock.release()
+        with open(file_path, "rb") as image_file:
+            content = image_file.read()
+        value = (get_binay(BASE64_PREFIX) + b64encode(content), md5(content).hexdigest())
+        cls._cachelock.acquire()
+        try:
+            cls._IMAGES_CACHE[file_path] = (mtime, value)
+            cls._IMAGES_CACHE.move_to_end(file_path)
+            while len(cls._IMAGES_CACHE) > cls.MAX_SIZE:
+                cls._IMAGES_CACHE.popitem(last=False)
+        finally:
+            cls._cachelock.release()
+        return value
+
+    @classmethod
+    def invalidate(cls, file_path):
+        cls._cachelock.acquire()
+        try:
+            cls._IMAGES_CACHE.pop(file_path, None)
+        finally:
+            cls._cachelock.release()
+
+
+class ImageProcessor(object):
+
+    MAX_WORKERS = 2
+    WORK_TIMEOUT = 30
+    WORK_DELAY = 0.1
+
+    _executor = None
+    _futures = {}
+    _lock = threading.RLock()
+
+    @classmethod
+    def get_executor(cls):
+        cls._lock.acquire()
+        try:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=cls.MAX_WORKERS)
+            return cls._executor
+        finally:
+            cls._lock.release()
+
+    @classmethod
+    def submit(cls, contact_id, upload_path):
+        move(upload_path, get_upload_path(contact_id))
+        cls._lock.acquire()
+        try:
+            future = cls.get_executor().submit(cls.process, contact_id)
+            cls._futures[contact_id] = future
+            future.add_done_callback(lambda done: cls._forget(contact_id, done))
+        finally:
+            cls._lock.release()
+
+    @classmethod
+    def _forget(cls, contact_id, future):
+        cls._lock.acquire()
+        try:
+            if cls._futures.get(contact_id) is future:
+                del cls._futures[contact_id]
+        finally:
+            cls._lock.release()
+
+    @classmethod
+    def process(cls, contact_id):
+        upload_path = get_upload_path(contact_id)
+        work_path = upload_path + ".work"
+        try:
+            replace(upload_path, work_path)
+        except OSError:
+            return
+        try:
+            for size_name, size in IMAGE_SIZES:
+                img_path = get_image_path(contact_id, size_name, False)
+                with open(work_path, "rb") as image_upload:
+                    image = open_image_resize(image_upload, size, size)
+                    image = image.convert("RGB")
+                    with open(img_path + ".tmp", "wb") as image_file:
+                        image.save(image_file, 'JPEG', quality=90)
+                replace(img_path + ".tmp", img_path)
+                ImageCache.invalidate(img_path)
+                legacy_path = get_legacy_path("Image_%s%s.jpg" % (contact_id, size_name))
+                if isfile(legacy_path):
+                    unlink(legacy_path)
+                    ImageCache.invalidate(legacy_path)
+        except Exception:
+            logging.getLogger('lucterios.contacts').exception("image processing of contact %s", contact_id)
+        finally:
+            unlink(work_path)
+
+    @classmethod
+    def ensure(cls, contact_id):
+        cls._lock.acquire()
+        try:
+            future = cls._futures.get(contact_id)
+        finally:
+            cls._lock.release()
+        if future is not None:
+            future.result()
+        else:
+            if isfile(get_upload_path(contact_id)):
+                cls.process(contact_id)
+            cls._wait_work(contact_id)
+
+    @classmethod
+    def _wait_work(cls, contact_id):
+        work_path = get_upload_path(contact_id) + ".work"
+        try:
+            end_time = getmtime(work_path) + cls.WORK_TIMEOUT
+        except OSError:
+            return
+        while isfile(work_path) and (time() < end_time):
+            sleep(cls.WORK_DELAY)
+
+    @classmethod
+    def wait(cls):
+        cls._lock.acquire()
+        try:
+            futures = list(cls._futures.values())
+        finally:
+            cls._lock.release()
+        for future in futures:
+            future.result()
+
+
+def get_image_shard(contact_id):
+    return md5(six.text_type(contact_id).encode('ascii')).hexdigest()[:2]
+
+
+def get_sharded_path(contact_id, filename):
+    return get_user_path(join("contacts", get_image_shard(contact_id)), filename)
+
+
+def get_legacy_path(filename):
+    return join(get_user_dir(), "contacts", filename)
+
+
+def get_upload_path(contact_id):
+    return get_sharded_path(contact_id, "Image_%s.upload" % contact_id)
+
+
+def get_image_path(contact_id, size_name=IMAGE_SHOW, with_legacy=True):
+    filename = "Image_%s%s.jpg" % (contact_id, size_name)
+    img_path = get_sharded_path(contact_id, filename)
+    if with_legacy and not isfile(img_path):
+        legacy_path = get_legacy_path(filename)
+        if isfile(legacy_path):
+            return legacy_path
+    return img_path
+
+
+def shard_images():
+    nb_moved = 0
+    root_path = join(get_user_dir(), "contacts")
+    if isdir(root_path):
+        for filename in listdir(root_path):
+            file_match = IMAGE_FILE_PATTERN.match(filename)
+            if (file_match is not None) and isfile(join(root_path, filename)):
+                img_path = get_sharded_path(file_match.group(1), filename)
+                if isfile(img_path):
+                    unlink(join(root_path, filename))
+                else:
+                    replace(join(root_path, filename), img_path)
+                    nb_moved += 1
+                ImageCache.invalidate(join(root_path, filename))
+    return nb_moved
+
+
+def get_image_base64(contact_id, size_name=IMAGE_SHOW):
+    ImageProcessor.ensure(contact_id)
+    image = ImageCache.get(get_image_path(contact_id, size_name))
+    if (image is None) and (size_name != IMAGE_SHOW):
+        image = ImageCache.get(get_image_path(contact_id))
+    if image is None:
+        image = ImageCache.get(NO_IMAGE_PATH)
+    return image[0]
+
+
+def get_image_url(contact_id):
+    ImageProcessor.ensure(contact_id)
+    img_path = get_image_path(contact_id)
+    image = ImageCache.get(img_path)
+    if image is None:
+        return None
+    return "CORE/download?filename=%s&sign=%s" % (relpath(img_path, get_user_dir()).replace('\\', '/'), image[1])
+
+
+def fill_image(img, contact_id):
+    ImageProcessor.ensure(contact_id)
+    img_path = get_image_path(contact_id)
+    if Params.getvalue("contacts-imageurl"):
+        image_url = get_image_url(contact_id)
+        if image_url is not None:
+            img.type = 'jpg'
+            img.set_value(image_url)
+        else:
+            img.set_value(get_icon_path(NO_IMAGE_ICON))
+    else:
+        image = ImageCache.get(img_path)
+        if image is not None:
+            img.type = 'jpg'
+            img.set_value(image[0])
+        else:
+            img.set_value(get_icon_path(NO_IMAGE_ICON))
@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.contacts.importation
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+from __future__ import unicode_literals
+from datetime import datetime
+from time import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from io import TextIOWrapper
+import gzip
+import csv
+import logging
+
+import django
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction, IntegrityError
+from django.db.models.fields import IntegerField, FloatField, DecimalField, DateField, TimeField, DateTimeField, BooleanField, EmailField
+from django.db.models.fields.related import ForeignKey
+from django.utils import six
+from django.utils.translation import ugettext_lazy as _, get_language, override
+from django.apps import apps
+
+from lucterios.contacts.models import CustomField, PostalCode
+from lucterios.contacts.address import AddressNormalizer, ADDRESS_VALID, ADDRESS_FIXED
+
+
+class ImportRowError(Exception):
+    pass
+
+
+class ContactRowValidator(object):
+
+    def __init__(self, model, dateformat):
+        self.model = model
+        self.dateformat = dateformat
+        self.custom_fields = dict(CustomField.get_fields(model))
+        self.language = get_language()
+
+    def _convert_value(self, dep_field, fieldvalue):
+        if isinstance(fieldvalue, six.string_types):
+            fieldvalue = fieldvalue.strip()
+        if isinstance(dep_field, IntegerField):
+            if (dep_field.choices is not None) and (len(dep_field.choices) > 0):
+                for choice in dep_field.choices:
+                    if fieldvalue == choice[1]:
+                        fieldvalue = choice[0]
+            try:
+                fieldvalue = int(fieldvalue)
+            except (TypeError, ValueError):
+                fieldvalue = 0
+        elif isinstance(dep_field, FloatField) or isinstance(dep_field, DecimalField):
+            try:
+                fieldvalue = float(six.text_type(fieldvalue).replace(',', '.'))
+            except ValueError:
+                fieldvalue = 0.0
+        elif isinstance(dep_field, DateField) and isinstance(fieldvalue, six.text_type):
+            try:
+                fieldvalue = datetime.strptime(fieldvalue, self.dateformat).date()
+            except ValueError:
+                raise ImportRowError(_("invalid date '%(value)s' for %(field)s") % {'value': fieldvalue, 'field': dep_field.verbose_name})
+        elif isinstance(dep_field, TimeField) and isinstance(fieldvalue, six.text_type):
+            try:
+                fieldvalue = datetime.strptime(fieldvalue, "%H:%M").time()
+            except ValueError:
+                raise ImportRowError(_("invalid time '%(value)s' for %(field)s") % {'value': fieldvalue, 'field': dep_field.verbose_name})
+        elif isinstance(dep_field, DateTimeField) and isinstance(fieldvalue, six.text_type):
+            try:
+                fieldvalue = datetime.strptime(fieldvalue, self.dateformat + " %H:%M")
+            except ValueError:
+                raise ImportRowError(_("invalid date '%(value)s' for %(field)s") % {'value': fieldvalue, 'field': dep_field.verbose_name})
+        elif isinstance(dep_field, BooleanField):
+            fieldvalue = (six.text_type(fieldvalue) == 'True') or (six.text_type(fieldvalue).lower() == 'yes') or (six.text_type(fieldvalue).lower() == 'oui') or (fieldvalue != 0)
+        elif isinstance(dep_field, EmailField) and (fieldvalue != ''):
+            for email in fieldvalue.split(';'):
+                try:
+                    validate_email(email.strip())
+                except ValidationError:
+                    raise ImportRowError(_("invalid email '%s'") % email.strip())
+        return fieldvalue
+
+    def validate_row(self, rowdata):
+        values = {}
+        foreign_values = {}
+        custom_values = {}
+        for fieldname, fieldvalue in rowdata.items():
+            if fieldname in self.custom_fields:
+                custom_values[self.custom_fields[fieldname].id] = self.custom_fields[fieldname].convert_value(fieldvalue)
+                continue
+            dep_field = self.model.get_field_by_name(fieldname)
+            if (dep_field is None) or (dep_field.is_relation and dep_field.many_to_many):
+                continue
+            if not fieldname.endswith('_id') and isinstance(dep_field, ForeignKey):
+                foreign_values[fieldname] = six.text_type(fieldvalue).strip()
+            else:
+                values[fieldname] = self._convert_value(dep_field, fieldvalue)
+        return values, foreign_values, custom_values
+
+    def validate_chunk(self, rows):
+        chunk = []
+        errors = []
+        for line_num, rowdata in rows:
+            try:
+                values, foreign_values, custom_values = self.validate_row(rowdata)
+                chunk.append((line_num, values, foreign_values, custom_values))
+            except ImportRowError as err:
+                errors.append((line_num, six.text_type(err)))
+        return chunk, errors
+
+
+def validate_chunk_in_process(validator, rows):
+    if not apps.ready:
+        django.setup()
+    with override(validator.language):
+        return validator.validate_chunk(rows)
+
+
+class ContactImporter(object):
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, model, dateformat, chunk_size=None, progress=None, keep_items=True, processes=0):
+        self.model = model
+        self.keep_items = keep_items
+        self.chunk_size = chunk_size if chunk_size is not None else self.CHUNK_SIZE
+        self.progress = progress
+        self.processes = processes
+        self.validator = ContactRowValidator(model, dateformat)
+        self.key_fields = [order_fd.lstrip('-') for order_fd in (model._meta.ordering or [])]
+        self.required_fields = []
+        for fieldname in model.get_import_fields():
+            if not isinstance(fieldname, tuple):
+                dep_field = model.get_field_by_name(fieldname)
+                if (dep_field is not None) and not dep_field.null and not dep_field.blank:
+                    self.required_fields.append(fieldname)
+        self.foreign_values = {}
+        self.known_ids = {}
+        self.imported_ids = set()
+        self.items_imported = {}
+        self.nb_rows = 0
+        self.errors = []
+        self.duration = 0.0
+
+    @property
+    def rows_per_second(self):
+        if self.duration > 0:
+            return self.nb_rows / self.duration
+        else:
+            return 0.0
+
+    def _get_foreign_value(self, fieldname, fieldvalue):
+        if fieldname not in self.foreign_values:
+            dep_field = self.model.get_field_by_name(fieldname)
+            self.foreign_values[fieldname] = {}
+            for sub_item in dep_field.remote_field.model.objects.all():
+                self.foreign_values[fieldname].setdefault(six.text_type(sub_item.get_final_child()), sub_item)
+        return self.foreign_values[fieldname].get(fieldvalue)
+
+    def _get_key(self, values):
+        return tuple([(key_field, values[key_field]) for key_field in self.key_fields if key_field in values])
+
+    def _get_existing_items(self, chunk):
+        existing_items = {}
+        keys = set([self._get_key(values) for _line_num, values, _foreign_values, _custom_values in chunk])
+        keys.discard(())
+        known_keys = dict([(self.known_ids[key], key) for key in keys if key in self.known_ids])
+        for item in self.model.objects.filter(id__in=list(known_keys.keys())):
+            existing_items[known_keys[item.id]] = item
+        first_values = {}
+        for key in keys:
+            if key not in self.known_ids:
+                first_values.setdefault(key[0][0], set()).add(key[0][1])
+        for first_field, values in first_values.items():
+            values = list(values)
+            for chunk_begin in range(0, len(values), self.chunk_size):
+                query = {first_field + '__in': values[chunk_begin:chunk_begin + self.chunk_size]}
+                for item in self.model.objects.filter(**query):
+                    for key in keys:
+                        if (key not in existing_items) and (key[0][0] == first_field) and all([getattr(item, key_field) == key_value for key_field, key_value in key]):
+                            existing_items[key] = item
+        return existing_items
+
+    def _complete_address(self, values):
+        if (values.get('postal_code', '') != '') and ((values.get('city', '') == '') or (values.get('country', '') == '')):
+            address = AddressNormalizer.normalize(values['postal_code'], values.get('city', ''), values.get('country', ''))
+            if address.status in (ADDRESS_VALID, ADDRESS_FIXED):
+                if values.get('city', '') == '':
+                    values['city'] = address.city
+                if values.get('country', '') == '':
+                    values['country'] = address.country
+
+    def _prepare_item(self, values, foreign_values, existing_items):
+        key = self._get_key(values)
+        if key in existing_items:
+            item = existing_items[key]
+        else:
+            item = self.model()
+        self._complete_address(values)
+        new_values = dict(values)
+        for fieldname, fieldvalue in foreign_values.items():
+            sub_item = self._get_foreign_value(fieldname, fieldvalue)
+            if (sub_item is None) and not self.model.get_field_by_name(fieldname.split('.')[0]).null:
+                raise ImportRowError(_("unknown value '%(value)s' for %(field)s") % {'value': fieldvalue, 'field': self.model.get_field_by_name(fieldname).verbose_name})
+            new_values[fieldname] = sub_item
+        for fieldname in self.required_fields:
+            if new_values.get(fieldname, getattr(item, fieldname)) in [None, '']:
+                raise ImportRowError(_("%s is required") % self.model.get_field_by_name(fieldname).verbose_name)
+        for fieldname, fieldvalue in new_values.items():
+            setattr(item, fieldname, fieldvalue)
+        if key != ():
+            existing_items[key] = item
+        return item
+
+    def _reset_new_items(self, new_items):
+        for item in new_items:
+            item.id = None
+            item.pk = None
+            item._state.adding = True
+
+    def _save_items(self, items, lines):
+        new_items = [item for item in items if item.id is None]
+        try:
+            with transaction.atomic():
+                self.model.bulk_save(items)
+            return items
+        except Exception:
+            logging.getLogger('lucterios.contacts').exception("import_data")
+            self._reset_new_items(new_items)
+        saved_items = []
+        for item in items:
+            try:
+                with transaction.atomic():
+                    self.model.bulk_save([item])
+                saved_items.append(item)
+            except Exception as err:
+                logging.getLogger('lucterios.contacts').exception("import_data")
+                if any([item is new_item for new_item in new_items]):
+                    self._reset_new_items([item])
+                for line_num in lines[id(item)]:
+                    self.errors.append((line_num, six.text_type(err)))
+        return saved_items
+
+    def write_chunk(self, chunk):
+        existing_items = self._get_existing_items(chunk)
+        items = []
+        lines = {}
+        item_keys = {}
+        item_custom_values = []
+        for line_num, values, foreign_values, row_custom_values in chunk:
+            try:
+                item = self._prepare_item(values, foreign_values, existing_items)
+            except ImportRowError as err:
+                self.errors.append((line_num, six.text_type(err)))
+                continue
+            if id(item) not in lines:
+                items.append(item)
+                lines[id(item)] = []
+                item_keys[id(item)] = self._get_key(values)
+            lines[id(item)].append(line_num)
+            item_custom_values.append((item, row_custom_values))
+        with transaction.atomic():
+            saved_items = self._save_items(items, lines)
+            custom_values = {}
+            for item in saved_items:
+                if item_keys[id(item)] != ():
+                    self.known_ids[item_keys[id(item)]] = item.id
+                self.imported_ids.add(item.id)
+                if self.keep_items:
+                    self.items_imported[item.id] = item
+            for item, row_custom_values in item_custom_values:
+                if item.id is not None:
+                    for field_id, value in row_custom_values.items():
+                        custom_values[(item.id, field_id)] = value
+            self.model.save_custom_values(custom_values)
+
+    def get_chunks(self, rowdatas):
+        rows = []
+        for rowdata in rowdatas:
+            self.nb_rows += 1
+            rows.append((self.nb_rows, rowdata))
+            if len(rows) == self.chunk_size:
+                yield rows
+                rows = []
+        if len(rows) > 0:
+            yield rows
+
+    def get_validated_chunks(self, rowdatas):
+        if self.processes > 0:
+            with ProcessPoolExecutor(max_workers=self.processes) as executor:
+                pending = deque()
+                for rows in self.get_chunks(rowdatas):
+                    pending.append(executor.submit(validate_chunk_in_process, self.validator, rows))
+                    if len(pending) > 2 * self.processes:
+                        yield pending.popleft().result()
+                while len(pending) > 0:
+                    yield pending.popleft().result()
+        else:
+            for rows in self.get_chunks(rowdatas):
+                yield self.validator.validate_chunk(rows)
+
+    def import_rows(self, rowdatas):
+        begin = time()
+        for chunk, errors in self.get_validated_chunks(rowdatas):
+            self.errors.extend(errors)
+            self.write_chunk(chunk)
+            self.duration = time() - begin
+            if self.progress is not None:
+                self.progress(self)
+        self.duration = time() - begin
+        self.errors.sort()
+        logging.getLogger('lucterios.contacts').info("import %s: %d rows, %d imported, %d errors, %.1f rows/s",
+                                                     self.model.get_long_name(), self.nb_rows, len(self.imported_ids), len(self.errors), self.rows_per_second)
+        return self.imported_ids
+
+
+class PostalCodeLoader(object):
+
+    BATCH_SIZE = 900
+
+    def __init__(self, country='', delimiter='', batch_size=None):
+        self.country = country
+        self.delimiter = delimiter
+        self.batch_size = batch_size if batch_size else self.BATCH_SIZE
+        self.nb_rows = 0
+        self.nb_created = 0
+        self.nb_existing = 0
+        self.errors = []
+        self.duration = 0.0
+        self.known_keys = set()
+
+    @property
+    def rows_per_second(self):
+        if self.duration > 0:
+            return self.nb_rows / self.duration
+        else:
+            return 0.0
+
+    @classmethod
+    def open_stream(cls, stream, encoding='utf-8'):
+        if stream.read(2) == b'\x1f\x8b':
+            stream.seek(0)
+            stream = gzip.GzipFile(fileobj=stream)
+        else:
+            stream.seek(0)
+        return TextIOWrapper(stream, encoding=encoding, errors='replace')
+
+    def get_rows(self, lines):
+        lines = iter(lines)
+        first_line = next(lines, None)
+        if first_line is None:
+            return
+        delimiter = self.delimiter
+        if delimiter == '':
+            delimiter = '\t' if '\t' in first_line else ';' if ';' in first_line else ','
+        for line_num, values in enumerate(csv.reader(chain([first_line], lines), delimiter=delimiter), 1):
+            if len([value for value in values if value.strip() != '']) > 0:
+                yield line_num, values
+
+    def get_item(self, line_num, values):
+        values = [six.text_type(value).strip() for value in values[:3]]
+        if (len(values) == 2) and (self.country != ''):
+            values.append(self.country)
+        if len(values) < 3:
+            self.errors.append((line_num, _('invalid line')))
+            return None
+        postal_code, city, country = values
+        if (line_num == 1) and not any(char.isdigit() for char in postal_code):
+            return None
+        if (postal_code == '') or (len(postal_code) > 10) or (city == '') or (len(city) > 100) or (country == '') or (len(country) > 100):
+            self.errors.append((line_num, _('invalid postal code, city or country')))
+            return None
+        return PostalCode(postal_code=postal_code, city=city, country=country)
+
+    def save_items(self, items):
+        try:
+            with transaction.atomic():
+                PostalCode.objects.bulk_create(items)
+            self.nb_created += len(items)
+        except IntegrityError:
+            for item in items:
+                try:
+                    with transaction.atomic():
+                        item.save()
+                    self.nb_created += 1
+                except IntegrityError:
+                    self.nb_existing += 1
+
+    def load(self, lines):
+        begin = time()
+        self.known_keys = set(PostalCode.objects.values_list('postal_code', 'city', 'country').iterator())
+        new_items = []
+        for line_num, values in self.get_rows(lines):
+            self.nb_rows += 1
+            item = self.get_item(line_num, values)
+            if item is None:
+                continue
+            key = (item.postal_code, item.city, item.country)
+            if key in self.known_keys:
+                self.nb_existing += 1
+                continue
+            self.known_keys.add(key)
+            new_items.append(item)
+            if len(new_items) >= self.batch_size:
+                self.save_items(new_items)
+                new_items = []
+        if len(new_items) > 0:
+            self.save_items(new_items)
+        if self.nb_created > 0:
+            PostalCode.change_cache_version()
+        self.duration = time() - begin
+        logging.getLogger('lucterios.contacts').info("load postal codes: %d rows, %d created, %d existing, %d errors, %.1f rows/s",
+                                                     self.nb_rows, self.nb_created, self.nb_existing, len(self.errors), self.rows_per_second)
+        return self.nb_created
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.contacts.management.commands.benchmark_autocomplete
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+from __future__ import unicode_literals
+from random import Random
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from lucterios.contacts.autocomplete import ContactPrefixIndex
+
+
+class Command(BaseCommand):
+    help = 'Measure response time of contact autocomplete'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lookups', type=int, dest='lookups', default=1000, help='number of prefix searches')
+        parser.add_argument('--nb-result', type=int, dest='nb_result', default=10, help='number of contacts returned by search')
+        parser.add_argument('--target', type=float, dest='target', default=20.0, help='maximum response time expected (ms)')
+
+    def handle(self, *args, **options):
+        ContactPrefixIndex.clear()
+        start = time()
+        index = ContactPrefixIndex.get_index()
+        build_duration = time() - start
+        self.stdout.write("index of %d contacts built in %.3f s" % (len(index), build_duration))
+        words = sorted(set([word for word, _item_id in index.keys]))
+        if len(words) == 0:
+            self.stdout.write("no contact to search")
+            return
+        random = Random(0)
+        durations = []
+        for _idx in range(options['lookups']):
+            word = random.choice(words)
+            prefix = word[:random.randint(1, min(len(word), 4))]
+            start = time()
+            ContactPrefixIndex.search(prefix, options['nb_result'])
+            durations.append((time() - start) * 1000.0)
+        durations.sort()
+        average = sum(durations) / len(durations)
+        percentile = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+        self.stdout.write("%d searches: average %.3f ms - 95%% %.3f ms - max %.3f ms" % (len(durations), average, percentile, durations[-1]))
+        if percentile > options['target']:
+            self.stderr.write("95%% of searches above target of %.1f ms" % options['target'])
+        else:
+            self.stdout.write("target of %.1f ms reached" % options['target'])
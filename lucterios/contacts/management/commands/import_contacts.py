@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.contacts.management.commands.import_contacts
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+from __future__ import unicode_literals
+from csv import DictReader, QUOTE_NONE, QUOTE_ALL
+from io import open
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from lucterios.contacts.importation import ContactImporter
+
+
+class Command(BaseCommand):
+    help = 'Import contacts from a CSV file whose columns are named as the contact fields'
+
+    def add_arguments(self, parser):
+        parser.add_argument('modelname', type=str, help='contacts.Individual or contacts.LegalEntity')
+        parser.add_argument('csvfile', type=str)
+        parser.add_argument('--delimiter', type=str, default=';')
+        parser.add_argument('--quotechar', type=str, default='')
+        parser.add_argument('--encoding', type=str, default='utf-8')
+        parser.add_argument('--dateformat', type=str, default='%d/%m/%Y')
+        parser.add_argument('--chunk-size', type=int, default=ContactImporter.CHUNK_SIZE, dest='chunk_size')
+        parser.add_argument('--processes', type=int, default=0, help='number of processes validating rows')
+
+    def show_progress(self, importer):
+        self.stdout.write("%d rows, %d imported, %d errors (%.1f rows/s)" % (importer.nb_rows, len(importer.imported_ids), len(importer.errors), importer.rows_per_second))
+
+    def handle(self, modelname, csvfile, *args, **options):
+        if options['quotechar'] == '':
+            reader_options = {'quoting': QUOTE_NONE}
+        else:
+            reader_options = {'quoting': QUOTE_ALL, 'quotechar': options['quotechar']}
+        importer = ContactImporter(apps.get_model(modelname), options['dateformat'], chunk_size=options['chunk_size'],
+                                   progress=self.show_progress, keep_items=False, processes=options['processes'])
+        with open(csvfile, 'r', encoding=options['encoding'], errors='replace') as csvcontent:
+            importer.import_rows(DictReader(csvcontent, delimiter=options['delimiter'], restkey='', restval='', **reader_options))
+        for line_num, message in importer.errors:
+            self.stderr.write("line %d: %s" % (line_num, message))
+        self.show_progress(importer)
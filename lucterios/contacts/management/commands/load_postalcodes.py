@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.contacts.management.commands.load_postalcodes
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from lucterios.contacts.importation import PostalCodeLoader
+
+
+class Command(BaseCommand):
+    help = 'Load postal codes from CSV/TSV files (possibly gzipped) of postal code, city and country columns'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', type=str)
+        parser.add_argument('--country', type=str, default='', help='country of files with only postal code and city columns')
+        parser.add_argument('--delimiter', type=str, default='', help='detected from the first line by default')
+        parser.add_argument('--encoding', type=str, default='utf-8')
+        parser.add_argument('--batch-size', type=int, default=PostalCodeLoader.BATCH_SIZE, dest='batch_size')
+
+    def handle(self, files, *args, **options):
+        for filename in files:
+            loader = PostalCodeLoader(options['country'], options['delimiter'], options['batch_size'])
+            with open(filename, 'rb') as stream:
+                loader.load(PostalCodeLoader.open_stream(stream, options['encoding']))
+            for line_num, message in loader.errors:
+                self.stderr.write("%s line %d: %s" % (filename, line_num, message))
+            self.stdout.write("%s: %d rows, %d created, %d existing, %d errors (%.1f rows/s)" % (filename, loader.nb_rows, loader.nb_created,
+                                                                                                 loader.nb_existing, len(loader.errors), loader.rows_per_second))
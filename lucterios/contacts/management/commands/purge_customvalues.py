@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+'''
+lucterios.contacts.management.commands.purge_customvalues
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from lucterios.contacts.models import ContactCustomField
+
+
+class Command(BaseCommand):
+    help = 'Remove empty custom field values of contacts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False, help='only count empty values')
+
+    def handle(self, *args, **options):
+        empty_values = ContactCustomField.objects.filter(value='')
+        if options['dry_run']:
+            nb_values = empty_values.count()
+        else:
+            nb_values, _deleted = empty_values.delete()
+        self.stdout.write("%d empty custom field values" % nb_values)
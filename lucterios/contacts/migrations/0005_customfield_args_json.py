@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name
+'''
+Convert arguments of custom fields to JSON
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+
+from ast import literal_eval
+import json
+
+from django.db import migrations
+from django.utils import six
+
+
+def parse_args(args_text):
+    try:
+        args = json.loads(args_text)
+    except (ValueError, TypeError):
+        try:
+            args = literal_eval(args_text)
+        except (ValueError, SyntaxError):
+            args = {}
+    if not isinstance(args, dict):
+        args = {}
+    return {'min': args.get('min', 0), 'max': args.get('max', 0), 'prec': args.get('prec', 0),
+            'list': list(args.get('list', ())), 'multi': bool(args.get('multi', False))}
+
+
+def args_to_json(apps, schema_editor):
+    customfield = apps.get_model("contacts", "CustomField")
+    for cf_model in customfield.objects.all():
+        cf_model.args = json.dumps(parse_args(cf_model.args), ensure_ascii=False)
+        cf_model.save()
+
+
+def args_to_python(apps, schema_editor):
+    customfield = apps.get_model("contacts", "CustomField")
+    for cf_model in customfield.objects.all():
+        cf_model.args = six.text_type(parse_args(cf_model.args))
+        cf_model.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0004_length_field'),
+    ]
+
+    operations = [
+        migrations.RunPython(args_to_json, args_to_python),
+    ]
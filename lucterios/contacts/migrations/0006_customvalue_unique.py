@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name
+'''
+Keep one custom value per contact and field
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Min, Count
+
+
+def remove_duplicate_values(apps, schema_editor):
+    contactcustomfield = apps.get_model("contacts", "ContactCustomField")
+    old_ids = []
+    for duplicate in contactcustomfield.objects.values('contact_id', 'field_id').annotate(first_id=Min('id'), nb=Count('id')).filter(nb__gt=1):
+        old_ids.extend(contactcustomfield.objects.filter(contact_id=duplicate['contact_id'], field_id=duplicate['field_id']).exclude(id=duplicate['first_id']).values_list('id', flat=True))
+    for chunk_begin in range(0, len(old_ids), 500):
+        contactcustomfield.objects.filter(id__in=old_ids[chunk_begin:chunk_begin + 500]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0005_customfield_args_json'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_values, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='contactcustomfield',
+            unique_together=set([('contact', 'field')]),
+        ),
+    ]
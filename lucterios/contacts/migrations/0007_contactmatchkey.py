@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name
+'''
+Add contact match keys used to find duplicates
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+
+from unicodedata import normalize, combining
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import six
+
+SOUNDEX_CODES = dict([(letter, six.text_type(code)) for code, letters in enumerate(['aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r']) for letter in letters])
+MAX_KEY_LENGTH = 200
+
+
+def normalize_text(text):
+    text = normalize('NFKD', six.text_type(text)).lower()
+    text = "".join([char for char in text if not combining(char)])
+    return " ".join(re.sub(r'[^a-z0-9]+', ' ', text).split())
+
+
+def phonetic_key(text):
+    keys = []
+    for word in normalize_text(text).split():
+        word = re.sub(r'[^a-z]', '', word)
+        if word == '':
+            continue
+        key = word[0]
+        last_code = SOUNDEX_CODES.get(word[0], '')
+        for letter in word[1:]:
+            code = SOUNDEX_CODES.get(letter, '')
+            if (code != last_code) and (code not in ('', '0')):
+                key += code
+            if letter not in 'hw':
+                last_code = code
+        keys.append((key + '000')[:4])
+    return " ".join(sorted(keys))
+
+
+def normalize_phone(phone):
+    digits = re.sub(r'[^0-9]', '', six.text_type(phone))
+    if len(digits) < 6:
+        return ''
+    return digits[-9:]
+
+
+def get_match_keys(values, name_fields):
+    keys = {}
+    name = normalize_text(" ".join([six.text_type(values[name_field]) for name_field in name_fields]))
+    if name != '':
+        keys['name'] = set([name[:MAX_KEY_LENGTH]])
+        keys['phonetic'] = set([phonetic_key(name)[:MAX_KEY_LENGTH]])
+    keys['phone'] = set([normalize_phone(values['tel1']), normalize_phone(values['tel2'])]) - set([''])
+    keys['email'] = set()
+    for email_item in six.text_type(values['email']).split(';'):
+        local_part = normalize_text(email_item.split('@')[0]).replace(' ', '')
+        if local_part != '':
+            keys['email'].add(local_part[:MAX_KEY_LENGTH])
+    postal_code = normalize_text(values['postal_code'])
+    if postal_code != '':
+        keys['postal_code'] = set([postal_code[:MAX_KEY_LENGTH]])
+    return keys
+
+
+def fill_match_keys(apps, schema_editor):
+    contactmatchkey = apps.get_model("contacts", "ContactMatchKey")
+    for modelname, name_fields in (("Individual", ['lastname', 'firstname']), ("LegalEntity", ['name'])):
+        new_keys = []
+        for values in apps.get_model("contacts", modelname).objects.values(*(['id', 'tel1', 'tel2', 'email', 'postal_code'] + name_fields)).order_by('id'):
+            for kind, key_values in get_match_keys(values, name_fields).items():
+                new_keys.extend([contactmatchkey(contact_id=values['id'], kind=kind, value=value) for value in key_values])
+        contactmatchkey.objects.bulk_create(new_keys, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0006_customvalue_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactMatchKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=20, verbose_name='kind')),
+                ('value', models.CharField(max_length=200, verbose_name='value')),
+                ('contact', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contacts.AbstractContact', verbose_name='contact')),
+            ],
+            options={
+                'verbose_name': 'contact match key',
+                'verbose_name_plural': 'contact match keys',
+                'default_permissions': [],
+                'index_together': set([('kind', 'value')]),
+            },
+        ),
+        migrations.RunPython(fill_match_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name
+'''
+Add the normalized search text of contacts
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+
+from unicodedata import normalize, combining
+import re
+
+from django.db import migrations, models
+from django.utils import six
+
+
+def normalize_text(text):
+    text = normalize('NFKD', six.text_type(text)).lower()
+    text = "".join([char for char in text if not combining(char)])
+    return " ".join(re.sub(r'[^a-z0-9]+', ' ', text).split())
+
+
+def get_search_text(texts, phones):
+    words = [normalize_text(text) for text in texts]
+    words.extend([re.sub(r'[^0-9]', '', six.text_type(phone)) for phone in phones])
+    return " ".join([word for word in words if word != ''])
+
+
+def fill_search_text(apps, schema_editor):
+    abstractcontact = apps.get_model("contacts", "AbstractContact")
+    contactcustomfield = apps.get_model("contacts", "ContactCustomField")
+    custom_texts = {}
+    for contact_id, value in contactcustomfield.objects.filter(field__kind=0).values_list('contact_id', 'value'):
+        custom_texts.setdefault(contact_id, []).append(value)
+    for modelname, name_fields in (("Individual", ['lastname', 'firstname']), ("LegalEntity", ['name'])):
+        for values in apps.get_model("contacts", modelname).objects.values(*(['id', 'city', 'email', 'tel1', 'tel2'] + name_fields)):
+            texts = [" ".join([values[name_field] for name_field in name_fields]), values['city'], values['email']] + custom_texts.get(values['id'], [])
+            abstractcontact.objects.filter(id=values['id']).update(search_text=get_search_text(texts, [values['tel1'], values['tel2']]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0007_contactmatchkey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='abstractcontact',
+            name='search_text',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='search text'),
+        ),
+        migrations.RunPython(fill_search_text, migrations.RunPython.noop),
+    ]
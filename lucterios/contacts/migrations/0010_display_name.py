@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name
+'''
+Add the display name and sort key of contacts
+
+@author: Laurent GAY
+@organization: sd-libre.fr
+@contact: info@sd-libre.fr
+@copyright: 2015 sd-libre.fr
+@license: This file is part of Lucterios.
+
+Lucterios is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Lucterios is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import unicode_literals
+
+from unicodedata import normalize, combining
+import re
+
+from django.db import migrations, models
+from django.utils import six
+
+
+def normalize_text(text):
+    text = normalize('NFKD', six.text_type(text)).lower()
+    text = "".join([char for char in text if not combining(char)])
+    return " ".join(re.sub(r'[^a-z0-9]+', ' ', text).split())
+
+
+def fill_display_name(apps, schema_editor):
+    abstractcontact = apps.get_model("contacts", "AbstractContact")
+    for modelname, name_fields in (("Individual", ['lastname', 'firstname']), ("LegalEntity", ['name'])):
+        for values in apps.get_model("contacts", modelname).objects.values_list(*(['id'] + name_fields)):
+            display_name = " ".join(values[1:])
+            abstractcontact.objects.filter(id=values[0]).update(display_name=display_name, sort_key=normalize_text(display_name)[:250])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0009_final_modelname'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='abstractcontact',
+            name='display_name',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=250, verbose_name='contact'),
+        ),
+        migrations.AddField(
+            model_name='abstractcontact',
+            name='sort_key',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=250, verbose_name='sort key'),
+        ),
+        migrations.AlterModelOptions(
+            name='abstractcontact',
+            options={'ordering': ['sort_key'], 'verbose_name': 'generic contact', 'verbose_name_plural': 'generic contacts'},
+        ),
+        migrations.RunPython(fill_display_name, migrations.RunPython.noop),
+    ]
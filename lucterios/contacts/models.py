@@ -23,19 +23,63 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import unicode_literals
-from os.path import exists, join, dirname
-import logging
+from collections import namedtuple
+from types import MappingProxyType
+from ast import literal_eval
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import json
 
 from django.utils import six
 from django.utils.translation import ugettext_lazy as _
-from django.db import models
+from django.db import models, transaction, connection
+from django.db.models import Q, Count, Case, When, Value, F
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.apps import apps
 
 from lucterios.framework.models import LucteriosModel, PrintFieldsPlugIn,\
     get_value_if_choices
-from lucterios.framework.filetools import get_user_path, readimage_to_base64
 from lucterios.framework.signal_and_lock import Signal
 from lucterios.CORE.models import Parameter
 
+from lucterios.contacts.cacheversion import get_cache_version, change_cache_version
+from lucterios.contacts.duplicate import DuplicateFinder, BLOCKING_KEYS, MAX_KEY_LENGTH, get_search_text, get_search_words, normalize_text
+
+
+class CustomFieldArgs(namedtuple('CustomFieldArgs', ['min', 'max', 'prec', 'list', 'multi', 'list_index'])):
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, args):
+        args_list = tuple(args.get('list', ()))
+        list_index = {}
+        for item_idx, item in enumerate(args_list):
+            list_index.setdefault(item, item_idx)
+        return cls(args.get('min', 0), args.get('max', 0), args.get('prec', 0), args_list, bool(args.get('multi', False)), MappingProxyType(list_index))
+
+    @classmethod
+    def parse(cls, args_text):
+        try:
+            args = json.loads(args_text)
+        except (ValueError, TypeError):
+            try:
+                args = literal_eval(args_text)
+            except (ValueError, SyntaxError):
+                args = {}
+        if not isinstance(args, dict):
+            args = {}
+        return cls.create(args)
+
+    def as_dict(self):
+        return {'min': self.min, 'max': self.max, 'prec': self.prec, 'list': list(self.list), 'multi': self.multi}
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), ensure_ascii=False)
+
+    def __reduce__(self):
+        return (self.__class__.create, (self.as_dict(),))
+
 
 class CustomField(LucteriosModel):
     modelname = models.CharField(_('model'), max_length=100)
@@ -43,6 +87,13 @@ class CustomField(LucteriosModel):
     kind = models.IntegerField(_('kind'), choices=((0, _('String')), (1, _('Integer')), (2, _('Real')), (3, _('Boolean')), (4, _('Select'))))
     args = models.CharField(_('arguments'), max_length=200, default="{}")
 
+    CACHE_VERSION_KEY = 'lucterios.contacts.customfield.version'
+
+    _FIELDS_CACHE_LIST = {}
+    _FIELDS_CACHE_BY_ID = {}
+    _cache_version = None
+    _cachelock = threading.RLock()
+
     @classmethod
     def get_show_fields(cls):
         return ['modelname', 'name', 'kind']
@@ -69,49 +120,64 @@ class CustomField(LucteriosModel):
     @property
     def kind_txt(self):
         dep_field = self.get_field_by_name('kind')
-        args = self.get_args()
+        args = self.args_spec
         params_txt = ""
         if self.kind == 0:
-            if args['multi']:
+            if args.multi:
                 params_txt = "(%s)" % _('multi-line')
         elif self.kind == 1:
-            params_txt = "[%d;%d]" % (int(args['min']), int(args['max']))
+            params_txt = "[%d;%d]" % (int(args.min), int(args.max))
         elif self.kind == 2:
-            prec = ".%df" % int(args['prec'])
+            prec = ".%df" % int(args.prec)
             floatformat = "[%" + prec + ";%" + prec + "]"
-            params_txt = floatformat % (float(args['min']), float(args['max']))
+            params_txt = floatformat % (float(args.min), float(args.max))
         elif self.kind == 4:
-            params_txt = "(%s)" % ",".join(args['list'])
+            params_txt = "(%s)" % ",".join(args.list)
         value = "%s %s" % (get_value_if_choices(self.kind, dep_field), params_txt)
         return value.strip()
 
+    @property
+    def args_spec(self):
+        if (self.__dict__.get('_args_parsed') is None) or (self._args_parsed[0] != self.args):
+            self._args_parsed = (self.args, CustomFieldArgs.parse(self.args))
+        return self._args_parsed[1]
+
     def get_args(self):
-        default_args = {'min': 0, 'max': 0, 'prec': 0, 'list': [], 'multi': False}
+        return self.args_spec.as_dict()
+
+    def convert_value(self, value):
         try:
-            args = eval(self.args)
-        except:
-            args = {}
-        for name, val in default_args.items():
-            if name not in args.keys():
-                args[name] = val
-        args['list'] = list(args['list'])
-        return args
+            if self.kind == 1:
+                value = int(value)
+            if self.kind == 2:
+                value = float(value)
+            if self.kind == 3:
+                value = (value != 'False') and (value != '0') and (value != '') and (value != 'n')
+            if self.kind == 4:
+                list_index = self.args_spec.list_index
+                if value in list_index:
+                    value = list_index[value]
+                else:
+                    value = int(value)
+        except (TypeError, ValueError):
+            value = ""
+        return six.text_type(value)
 
     def get_field(self):
         from django.db.models.fields import IntegerField, DecimalField, BooleanField, TextField
         from django.core.validators import MaxValueValidator, MinValueValidator
-        args = self.get_args()
+        args = self.args_spec
         if self.kind == 0:
             dbfield = TextField(self.name)
         if self.kind == 1:
-            dbfield = IntegerField(self.name, validators=[MinValueValidator(float(args['min'])), MaxValueValidator(float(args['max']))])
+            dbfield = IntegerField(self.name, validators=[MinValueValidator(float(args.min)), MaxValueValidator(float(args.max))])
         if self.kind == 2:
-            dbfield = DecimalField(self.name, decimal_places=int(args['prec']), validators=[MinValueValidator(float(args['min'])), MaxValueValidator(float(args['max']))])
+            dbfield = DecimalField(self.name, decimal_places=int(args.prec), validators=[MinValueValidator(float(args.min)), MaxValueValidator(float(args.max))])
         if self.kind == 3:
             dbfield = BooleanField(self.name)
         if self.kind == 4:
             choices = []
-            for item in args['list']:
+            for item in args.list:
                 choices.append((len(choices), item))
             dbfield = IntegerField(self.name, choices=tuple(choices))
         return dbfield
@@ -123,17 +189,59 @@ class CustomField(LucteriosModel):
             model_list.append(sub_class[0])
         return cls.objects.filter(modelname__in=model_list)
 
+    @classmethod
+    def clear_cache(cls):
+        cls._cachelock.acquire()
+        try:
+            cls._FIELDS_CACHE_LIST.clear()
+            cls._FIELDS_CACHE_BY_ID.clear()
+            cls._cache_version = None
+        finally:
+            cls._cachelock.release()
+
+    @classmethod
+    def change_cache_version(cls):
+        change_cache_version(cls.CACHE_VERSION_KEY, lambda new_version: cls.clear_cache())
+
+    @classmethod
+    def _check_cache_version(cls):
+        current_version = get_cache_version(cls.CACHE_VERSION_KEY)
+        if current_version != cls._cache_version:
+            cls._FIELDS_CACHE_LIST.clear()
+            cls._FIELDS_CACHE_BY_ID.clear()
+            cls._cache_version = current_version
+
     @classmethod
     def get_fields(cls, model):
-        fields = []
-        import inspect
-        model_list = []
-        for sub_class in inspect.getmro(model):
-            if hasattr(sub_class, "get_long_name"):
-                model_list.append(sub_class.get_long_name())
-        for cf_model in cls.objects.filter(modelname__in=model_list):
-            fields.append((cf_model.get_fieldname(), cf_model))
-        return fields
+        model_name = model.get_long_name()
+        cls._cachelock.acquire()
+        try:
+            cls._check_cache_version()
+            if model_name not in cls._FIELDS_CACHE_LIST.keys():
+                import inspect
+                fields = []
+                model_list = []
+                for sub_class in inspect.getmro(model):
+                    if hasattr(sub_class, "get_long_name"):
+                        model_list.append(sub_class.get_long_name())
+                for cf_model in cls.objects.filter(modelname__in=model_list):
+                    cls._FIELDS_CACHE_BY_ID[cf_model.id] = cf_model
+                    fields.append((cf_model.get_fieldname(), cf_model))
+                cls._FIELDS_CACHE_LIST[model_name] = fields
+            return list(cls._FIELDS_CACHE_LIST[model_name])
+        finally:
+            cls._cachelock.release()
+
+    @classmethod
+    def get_cached(cls, cf_id):
+        cls._cachelock.acquire()
+        try:
+            cls._check_cache_version()
+            if cf_id not in cls._FIELDS_CACHE_BY_ID.keys():
+                cls._FIELDS_CACHE_BY_ID[cf_id] = cls.objects.get(id=cf_id)
+            return cls._FIELDS_CACHE_BY_ID[cf_id]
+        finally:
+            cls._cachelock.release()
 
     @classmethod
     def edit_fields(cls, xfer, init_col):
@@ -160,6 +268,46 @@ class CustomField(LucteriosModel):
         default_permissions = []
 
 
+class CustomValuesBatch(object):
+
+    ID_CHUNK_SIZE = 500
+
+    def __init__(self, items):
+        self.item_ids = [item.id for item in items if item.id is not None]
+        self.loaded_ids = set()
+        self.values = {}
+        self.fields = {}
+
+    @classmethod
+    def attach(cls, items):
+        items = [item for item in items if isinstance(item, CustomizeObject)]
+        if len(items) > 0:
+            new_batch = cls(items)
+            for item in items:
+                item._custom_batch = new_batch
+
+    def get_field(self, cf_id):
+        if cf_id not in self.fields:
+            self.fields[cf_id] = CustomField.get_cached(cf_id)
+        return self.fields[cf_id]
+
+    def _load(self, item):
+        if item.id in self.item_ids:
+            chunk_begin = (self.item_ids.index(item.id) // self.ID_CHUNK_SIZE) * self.ID_CHUNK_SIZE
+            chunk_ids = self.item_ids[chunk_begin:chunk_begin + self.ID_CHUNK_SIZE]
+        else:
+            chunk_ids = [item.id]
+        self.loaded_ids.update(chunk_ids)
+        query = {item.FieldName + '_id__in': chunk_ids}
+        for item_id, field_id, value in item.CustomFieldClass.objects.filter(**query).values_list(item.FieldName + '_id', 'field_id', 'value'):
+            self.values[(item_id, field_id)] = value
+
+    def get_value(self, item, cf_model):
+        if item.id not in self.loaded_ids:
+            self._load(item)
+        return self.values.get((item.id, cf_model.id), "")
+
+
 class CustomizeObject(object):
 
     CustomFieldClass = None
@@ -180,34 +328,53 @@ class CustomizeObject(object):
                 fields_desc.append(tuple(cust_item))
         return fields_desc
 
+    def _get_custom_batch(self):
+        if self.__dict__.get('_custom_batch') is None:
+            CustomValuesBatch.attach([self])
+        return self.__dict__['_custom_batch']
+
     def set_custom_values(self, params):
-        for cf_name, cf_model in CustomField.get_fields(self.__class__):
-            if cf_name in params.keys():
-                cf_value = params[cf_name]
-                cf_id = int(cf_name[7:])
-                cf_model = CustomField.objects.get(id=cf_id)
-                try:
-                    if cf_model.kind == 1:
-                        cf_value = int(cf_value)
-                    if cf_model.kind == 2:
-                        cf_value = float(cf_value)
-                    if cf_model.kind == 3:
-                        cf_value = (cf_value != 'False') and (cf_value != '0') and (cf_value != '') and (cf_value != 'n')
-                    if cf_model.kind == 4:
-                        args_list = cf_model.get_args()['list']
-                        if args_list.count(cf_value) > 0:
-                            cf_value = args_list.index(cf_value)
-                        else:
-                            cf_value = int(cf_value)
-                except:
-                    cf_value = ""
-                args = {self.FieldName: self, 'field': cf_model}
-                ccf_model = self.CustomFieldClass.objects.get_or_create(**args)
-                ccf_model[0].value = six.text_type(cf_value)
-                ccf_model[0].save()
+        self.__class__.set_custom_values_list([(self, params)])
+
+    @classmethod
+    def set_custom_values_list(cls, items_params):
+        new_values = {}
+        for item, params in items_params:
+            item.__dict__['_custom_batch'] = None
+            for cf_name, cf_model in CustomField.get_fields(item.__class__):
+                if cf_name in params.keys():
+                    new_values[(item.id, cf_model.id)] = cf_model.convert_value(params[cf_name])
+        cls.save_custom_values(new_values)
+
+    @classmethod
+    def save_custom_values(cls, new_values):
+        if len(new_values) == 0:
+            return
+        item_ids = list(set([item_id for item_id, _field_id in new_values.keys()]))
+        current_values = {}
+        for chunk_begin in range(0, len(item_ids), CustomValuesBatch.ID_CHUNK_SIZE):
+            query = {cls.FieldName + '_id__in': item_ids[chunk_begin:chunk_begin + CustomValuesBatch.ID_CHUNK_SIZE]}
+            for ccf_id, item_id, field_id, value in cls.CustomFieldClass.objects.filter(**query).values_list('id', cls.FieldName + '_id', 'field_id', 'value'):
+                current_values[(item_id, field_id)] = (ccf_id, value)
+        ccf_to_create = []
+        ccf_to_update = {}
+        for (item_id, field_id), value in new_values.items():
+            if (item_id, field_id) in current_values:
+                ccf_id, old_value = current_values[(item_id, field_id)]
+                if old_value != value:
+                    ccf_to_update.setdefault(value, []).append(ccf_id)
+            else:
+                ccf_to_create.append(cls.CustomFieldClass(**{cls.FieldName + '_id': item_id, 'field_id': field_id, 'value': value}))
+        with transaction.atomic():
+            if len(ccf_to_create) > 0:
+                cls.CustomFieldClass.objects.bulk_create(ccf_to_create, batch_size=CustomValuesBatch.ID_CHUNK_SIZE)
+            for value, ccf_ids in ccf_to_update.items():
+                for chunk_begin in range(0, len(ccf_ids), CustomValuesBatch.ID_CHUNK_SIZE):
+                    cls.CustomFieldClass.objects.filter(id__in=ccf_ids[chunk_begin:chunk_begin + CustomValuesBatch.ID_CHUNK_SIZE]).update(value=value)
 
     def get_custom_by_name(self, custom_name):
-        fields = CustomField.objects.filter(modelname=self.__class__.get_long_name(), name=custom_name)
+        model_name = self.__class__.get_long_name()
+        fields = [cf_model for _cf_name, cf_model in CustomField.get_fields(self.__class__) if (cf_model.modelname == model_name) and (cf_model.name == custom_name)]
         if len(fields) == 1:
             return getattr(self, fields[0].get_fieldname())
         else:
@@ -218,22 +385,12 @@ class CustomizeObject(object):
             return six.text_type(self.get_final_child())
         elif name[:7] == "custom_":
             cf_id = int(name[7:])
-            cf_model = CustomField.objects.get(
-                id=cf_id)
+            custom_batch = self._get_custom_batch()
+            cf_model = custom_batch.get_field(cf_id)
             if self.id is None:
                 ccf_value = ""
             else:
-                args = {self.FieldName: self, 'field': cf_model}
-                ccf_models = self.CustomFieldClass.objects.filter(**args)
-                if len(ccf_models) == 0:
-                    ccf_model = self.CustomFieldClass.objects.create(**args)
-                elif len(ccf_models) == 1:
-                    ccf_model = ccf_models[0]
-                else:
-                    ccf_model = ccf_models[0]
-                    for old_model in ccf_models[1:]:
-                        old_model.delete()
-                ccf_value = ccf_model.value
+                ccf_value = custom_batch.get_value(self, cf_model)
             if cf_model.kind == 0:
                 return six.text_type(ccf_value)
             if ccf_value == '':
@@ -246,7 +403,7 @@ class CustomizeObject(object):
                 return (ccf_value != 'False') and (ccf_value != '0') and (ccf_value != '') and (ccf_value != 'n')
             if cf_model.kind == 4:
                 num = int(ccf_value)
-                args_list = cf_model.get_args()['list']
+                args_list = cf_model.args_spec.list
                 if num < len(args_list):
                     return args_list[num]
                 else:
@@ -254,6 +411,29 @@ class CustomizeObject(object):
         raise AttributeError(name)
 
 
+class CustomizeQuerySet(models.QuerySet):
+
+    _final_children = False
+
+    def with_final_children(self):
+        clone = self._chain()
+        clone._final_children = True
+        return clone
+
+    def _clone(self):
+        clone = models.QuerySet._clone(self)
+        clone._final_children = self._final_children
+        return clone
+
+    def _fetch_all(self):
+        is_new_fetch = self._result_cache is None
+        models.QuerySet._fetch_all(self)
+        if is_new_fetch:
+            CustomValuesBatch.attach(self._result_cache)
+            if self._final_children:
+                AbstractContact.attach_final_children([item for item in self._result_cache if isinstance(item, AbstractContact)])
+
+
 class PostalCode(LucteriosModel):
     postal_code = models.CharField(_('postal code'), max_length=10, blank=False)
     city = models.CharField(_('city'), max_length=100, blank=False)
@@ -262,6 +442,13 @@ class PostalCode(LucteriosModel):
     postalcode__editfields = ['postal_code', 'city', 'country']
     postalcode__searchfields = ['postal_code', 'city', 'country']
 
+    CACHE_VERSION_KEY = 'lucterios.contacts.postalcode.version'
+
+    _CITIES_CACHE = {}
+    _CODES_CACHE = []
+    _cache_version = None
+    _cachelock = threading.RLock()
+
     @classmethod
     def get_default_fields(cls):
         return ['postal_code', 'city', 'country']
@@ -269,6 +456,63 @@ class PostalCode(LucteriosModel):
     def __str__(self):
         return '[%s] %s %s' % (self.country, self.postal_code, self.city)
 
+    @classmethod
+    def clear_cache(cls):
+        cls._cachelock.acquire()
+        try:
+            cls._CITIES_CACHE = {}
+            cls._CODES_CACHE = []
+            cls._cache_version = None
+        finally:
+            cls._cachelock.release()
+
+    @classmethod
+    def change_cache_version(cls):
+        change_cache_version(cls.CACHE_VERSION_KEY, lambda new_version: cls.clear_cache())
+
+    @classmethod
+    def _check_cache_version(cls):
+        current_version = get_cache_version(cls.CACHE_VERSION_KEY)
+        if current_version != cls._cache_version:
+            cities = {}
+            for postal_code, city, country in cls.objects.order_by('postal_code', 'city').values_list('postal_code', 'city', 'country').iterator():
+                cities.setdefault(postal_code, []).append((city, country))
+            cls._CITIES_CACHE = cities
+            cls._CODES_CACHE = sorted(cities.keys())
+            cls._cache_version = current_version
+
+    @classmethod
+    def get_cities(cls, postal_code):
+        cls._cachelock.acquire()
+        try:
+            cls._check_cache_version()
+            return list(cls._CITIES_CACHE.get(postal_code, []))
+        finally:
+            cls._cachelock.release()
+
+    @classmethod
+    def get_codes_with_prefix(cls, prefix):
+        cls._cachelock.acquire()
+        try:
+            cls._check_cache_version()
+            codes = []
+            pos = bisect_left(cls._CODES_CACHE, prefix)
+            while (pos < len(cls._CODES_CACHE)) and cls._CODES_CACHE[pos].startswith(prefix):
+                codes.append(cls._CODES_CACHE[pos])
+                pos += 1
+            return codes
+        finally:
+            cls._cachelock.release()
+
+    @classmethod
+    def get_prefix_filter(cls, prefix):
+        if prefix == '':
+            return Q()
+        codes = cls.get_codes_with_prefix(prefix)
+        if len(codes) == 0:
+            return Q(id__in=[])
+        return Q(postal_code__gte=codes[0], postal_code__lte=codes[-1], postal_code__startswith=prefix)
+
     class Meta(object):
 
         verbose_name = _('postal code')
@@ -276,6 +520,7 @@ class PostalCode(LucteriosModel):
         default_permissions = ['add', 'change']
         ordering = ['postal_code', 'city']
         unique_together = (('postal_code', 'city', 'country'),)
+        index_together = [('country', 'postal_code')]
 
 
 class Function(LucteriosModel):
@@ -321,6 +566,91 @@ class ContactCustomField(LucteriosModel):
         verbose_name = _('custom field value')
         verbose_name_plural = _('custom field values')
         default_permissions = []
+        unique_together = (('contact', 'field'),)
+
+
+class ContactMatchKey(LucteriosModel):
+    contact = models.ForeignKey('AbstractContact', verbose_name=_('contact'), null=False, on_delete=models.CASCADE)
+    kind = models.CharField(_('kind'), max_length=20)
+    value = models.CharField(_('value'), max_length=MAX_KEY_LENGTH)
+
+    @classmethod
+    def _get_contact_keys(cls, key_query):
+        contact_keys = {}
+        for contact_id, kind, value in key_query.values_list('contact_id', 'kind', 'value'):
+            contact_keys.setdefault(contact_id, {}).setdefault(kind, set()).add(value)
+        return contact_keys
+
+    @classmethod
+    def get_candidates(cls, model):
+        model_keys = cls.objects.filter(contact__in=model.objects.values('id'), kind__in=BLOCKING_KEYS)
+        shared_keys = model_keys.values('kind', 'value').annotate(nb=Count('contact_id')).filter(nb__gt=1, nb__lte=DuplicateFinder.MAX_BLOCK_SIZE)
+        shared_query = Q()
+        for kind in BLOCKING_KEYS:
+            shared_query |= Q(kind=kind, value__in=shared_keys.filter(kind=kind).values('value'))
+        return model_keys.filter(shared_query).values('contact_id')
+
+    @classmethod
+    def get_candidate_keys(cls, model):
+        return cls._get_contact_keys(cls.objects.filter(contact__in=cls.get_candidates(model)))
+
+    @classmethod
+    def get_similar_contacts(cls, contact):
+        finder = DuplicateFinder(contact.__class__)
+        contact_keys = finder.get_item_keys(contact)
+        query = Q()
+        for kind in BLOCKING_KEYS:
+            for value in contact_keys.get(kind, ()):
+                query |= Q(kind=kind, value=value)
+        if len(query) == 0:
+            return []
+        candidates = cls.objects.filter(query, contact__in=contact.__class__.objects.values('id')).exclude(contact_id=contact.id)
+        scores = {}
+        for other_id, other_keys in cls._get_contact_keys(cls.objects.filter(contact__in=candidates.values('contact_id'))).items():
+            score = finder.get_score(contact_keys, other_keys)
+            if score >= finder.MIN_SCORE:
+                scores[other_id] = score
+        similar_contacts = list(contact.__class__.objects.filter(id__in=list(scores.keys())))
+        similar_contacts.sort(key=lambda other: (-scores[other.id], other.id))
+        return similar_contacts
+
+    @classmethod
+    def update_keys(cls, contact):
+        cls.update_contacts_keys([contact])
+
+    @classmethod
+    def update_contacts_keys(cls, contacts):
+        finders = {}
+        new_keys = {}
+        for contact in contacts:
+            if contact.__class__ == AbstractContact:
+                contact = contact.get_final_child()
+            if contact.__class__ not in finders:
+                finders[contact.__class__] = DuplicateFinder(contact.__class__)
+            new_keys[contact.id] = set()
+            for kind, values in finders[contact.__class__].get_item_keys(contact).items():
+                new_keys[contact.id].update([(kind, value) for value in values])
+        contact_ids = list(new_keys.keys())
+        removed_ids = []
+        added_keys = []
+        for chunk_begin in range(0, len(contact_ids), CustomValuesBatch.ID_CHUNK_SIZE):
+            chunk_ids = contact_ids[chunk_begin:chunk_begin + CustomValuesBatch.ID_CHUNK_SIZE]
+            old_keys = {}
+            for key_id, contact_id, kind, value in cls.objects.filter(contact_id__in=chunk_ids).values_list('id', 'contact_id', 'kind', 'value'):
+                old_keys[(contact_id, kind, value)] = key_id
+            removed_ids.extend([key_id for (contact_id, kind, value), key_id in old_keys.items() if (kind, value) not in new_keys[contact_id]])
+            for contact_id in chunk_ids:
+                added_keys.extend([cls(contact_id=contact_id, kind=kind, value=value) for kind, value in new_keys[contact_id] if (contact_id, kind, value) not in old_keys])
+        for chunk_begin in range(0, len(removed_ids), CustomValuesBatch.ID_CHUNK_SIZE):
+            cls.objects.filter(id__in=removed_ids[chunk_begin:chunk_begin + CustomValuesBatch.ID_CHUNK_SIZE]).delete()
+        if len(added_keys) > 0:
+            cls.objects.bulk_create(added_keys, batch_size=CustomValuesBatch.ID_CHUNK_SIZE)
+
+    class Meta(object):
+        verbose_name = _('contact match key')
+        verbose_name_plural = _('contact match keys')
+        default_permissions = []
+        index_together = [('kind', 'value')]
 
 
 class AbstractContact(LucteriosModel, CustomizeObject):
@@ -335,9 +665,17 @@ class AbstractContact(LucteriosModel, CustomizeObject):
     tel2 = models.CharField(_('tel2'), max_length=20, blank=True)
     email = models.EmailField(_('email'), blank=True)
     comment = models.TextField(_('comment'), blank=True)
+    search_text = models.TextField(_('search text'), blank=True, default='', editable=False)
+    final_modelname = models.CharField(_('final model'), max_length=100, blank=True, default='', editable=False, db_index=True)
+    display_name = models.CharField(_('contact'), max_length=250, blank=True, default='', editable=False, db_index=True)
+    sort_key = models.CharField(_('sort key'), max_length=250, blank=True, default='', editable=False, db_index=True)
+
+    objects = CustomizeQuerySet.as_manager()
 
     def __str__(self):
-        if self.get_final_child() != self:
+        if self.display_name != '':
+            return self.display_name
+        elif self.get_final_child() != self:
             return six.text_type(self.get_final_child())
         else:
             return "contact#%d" % self.id
@@ -378,15 +716,114 @@ class AbstractContact(LucteriosModel, CustomizeObject):
 
     @classmethod
     def import_data(cls, rowdata, dateformat):
-        try:
-            new_item = super(AbstractContact, cls).import_data(rowdata, dateformat)
-            if new_item is not None:
-                new_item.set_custom_values(rowdata)
-            return new_item
-        except Exception:
-            logging.getLogger('lucterios.contacts').exception("import_data")
+        items_imported = cls.import_data_list([rowdata], dateformat)
+        if len(items_imported) == 1:
+            return items_imported[0]
+        else:
             return None
 
+    @classmethod
+    def import_data_list(cls, rowdatas, dateformat):
+        from lucterios.contacts.importation import ContactImporter
+        importer = ContactImporter(cls, dateformat)
+        importer.import_rows(rowdatas)
+        return list(importer.items_imported.values())
+
+    @classmethod
+    def get_search_filter(cls, text):
+        query = Q()
+        for word in get_search_words(text):
+            query &= Q(search_text__contains=word)
+        return query
+
+    def get_search_text(self, custom_texts=None):
+        if custom_texts is None:
+            if self.id is None:
+                custom_texts = []
+            else:
+                custom_texts = list(self.CustomFieldClass.objects.filter(contact_id=self.id, field__kind=0).values_list('value', flat=True))
+        texts = [self.display_name, self.city, self.email] + custom_texts
+        return get_search_text(texts, [self.tel1, self.tel2])
+
+    def set_computed_fields(self, custom_texts=None):
+        self.final_modelname = self.get_final_modelname()
+        self.display_name = self.get_display_name()
+        self.sort_key = normalize_text(self.display_name)[:250]
+        self.search_text = self.get_search_text(custom_texts)
+
+    @classmethod
+    def get_custom_texts(cls, contact_ids):
+        custom_texts = {}
+        for chunk_begin in range(0, len(contact_ids), CustomValuesBatch.ID_CHUNK_SIZE):
+            chunk_ids = contact_ids[chunk_begin:chunk_begin + CustomValuesBatch.ID_CHUNK_SIZE]
+            for contact_id, value in cls.CustomFieldClass.objects.filter(contact_id__in=chunk_ids, field__kind=0).values_list('contact_id', 'value'):
+                custom_texts.setdefault(contact_id, []).append(value)
+        return custom_texts
+
+    @classmethod
+    def contacts_saved(cls, contacts):
+        from lucterios.contacts.autocomplete import ContactPrefixIndex
+        ContactMatchKey.update_contacts_keys(contacts)
+        ContactPrefixIndex.contacts_changed(contacts)
+
+    @classmethod
+    def _bulk_insert(cls, contacts):
+        if list(cls._meta.get_parent_list()) != [AbstractContact]:
+            for contact in contacts:
+                contact.save()
+            return
+        parent_fields = [field for field in AbstractContact._meta.local_concrete_fields if not field.primary_key]
+        parents = [AbstractContact(**dict([(field.attname, getattr(contact, field.attname)) for field in parent_fields])) for contact in contacts]
+        if connection.features.can_return_ids_from_bulk_insert:
+            AbstractContact.objects.bulk_create(parents, batch_size=CustomValuesBatch.ID_CHUNK_SIZE)
+        else:
+            for parent in parents:
+                parent.save_base(raw=True)
+        for contact, parent in zip(contacts, parents):
+            contact.id = parent.id
+            contact.pk = parent.id
+            contact._state.adding = False
+            contact._state.db = parent._state.db
+        cls.objects.all()._batched_insert(contacts, cls._meta.local_concrete_fields, CustomValuesBatch.ID_CHUNK_SIZE)
+
+    @classmethod
+    def bulk_save(cls, contacts):
+        custom_texts = cls.get_custom_texts([contact.id for contact in contacts if contact.id is not None])
+        for contact in contacts:
+            contact.set_computed_fields(custom_texts.get(contact.id, []))
+        with transaction.atomic():
+            with deferred_contact_hooks():
+                for contact in contacts:
+                    if contact.id is not None:
+                        contact.save()
+                cls._bulk_insert([contact for contact in contacts if contact.id is None])
+            cls.contacts_saved(contacts)
+
+    def get_display_name(self):
+        final_child = self.get_final_child()
+        if final_child.__class__ == AbstractContact:
+            return ''
+        return six.text_type(final_child)
+
+    @classmethod
+    def save_custom_values(cls, new_values):
+        super(AbstractContact, cls).save_custom_values(new_values)
+        item_ids = list(set([item_id for item_id, _field_id in new_values.keys()]))
+        custom_texts = cls.get_custom_texts(item_ids)
+        for chunk_begin in range(0, len(item_ids), CustomValuesBatch.ID_CHUNK_SIZE):
+            search_texts = {}
+            for contact in cls.objects.filter(id__in=item_ids[chunk_begin:chunk_begin + CustomValuesBatch.ID_CHUNK_SIZE]):
+                search_text = contact.get_search_text(custom_texts.get(contact.id, []))
+                if search_text != contact.search_text:
+                    search_texts[contact.id] = search_text
+            if len(search_texts) > 0:
+                AbstractContact.objects.filter(id__in=list(search_texts.keys())).update(search_text=Case(*[When(id=contact_id, then=Value(search_text)) for contact_id, search_text in search_texts.items()],
+                                                                                                   default=F('search_text'), output_field=models.TextField()))
+
+    @classmethod
+    def get_duplicate_clusters(cls):
+        return DuplicateFinder(cls).find_clusters(ContactMatchKey.get_candidate_keys(cls))
+
     def get_presentation(self):
         return ""
 
@@ -399,19 +836,82 @@ class AbstractContact(LucteriosModel, CustomizeObject):
 
     @property
     def image(self):
-        img_path = get_user_path("contacts", "Image_%s.jpg" % self.abstractcontact_ptr_id)
-        if exists(img_path):
-            img = readimage_to_base64(img_path)
-        else:
-            img = readimage_to_base64(join(dirname(__file__), "static", 'lucterios.contacts', "images", "NoImage.png"))
-        return img.decode('ascii')
+        from lucterios.contacts.images import get_image_base64, IMAGE_PRINT
+        return get_image_base64(self.abstractcontact_ptr_id, IMAGE_PRINT).decode('ascii')
 
     def get_ref_contact(self):
         return self
 
+    @classmethod
+    def get_contact_model(cls, modelname):
+        try:
+            return apps.get_model(modelname)
+        except (LookupError, ValueError):
+            return None
+
+    @classmethod
+    def has_sub_models(cls, model):
+        return any(not sub_model._meta.abstract and not sub_model._meta.proxy for sub_model in model.__subclasses__())
+
+    def get_final_modelname(self):
+        model = self.get_contact_model(self.final_modelname)
+        if (model is not None) and issubclass(model, self.__class__):
+            return self.final_modelname
+        return self._meta.label
+
+    def _set_final_child(self, final_child):
+        if final_child is not self:
+            final_child._custom_batch = self.__dict__.get('_custom_batch')
+            if self.id is not None:
+                self._final_child = final_child
+        return final_child
+
+    def get_final_child(self):
+        if '_final_child' in self.__dict__:
+            return self._final_child
+        model = self.get_contact_model(self.final_modelname)
+        if (model is None) or not issubclass(model, self.__class__):
+            return self._set_final_child(LucteriosModel.get_final_child(self))
+        final_child = self
+        if model is not self.__class__:
+            final_child = model.objects.filter(id=self.id).first()
+            if final_child is None:
+                return self._set_final_child(LucteriosModel.get_final_child(self))
+        if (model is not AbstractContact) and self.has_sub_models(model):
+            final_child = LucteriosModel.get_final_child(final_child)
+        return self._set_final_child(final_child)
+
+    @classmethod
+    def attach_final_children(cls, contacts):
+        contact_ids = {}
+        for contact in contacts:
+            if ('_final_child' in contact.__dict__) or ('final_modelname' in contact.get_deferred_fields()):
+                continue
+            if contact.final_modelname != contact._meta.label:
+                model = cls.get_contact_model(contact.final_modelname)
+                if (model is not None) and issubclass(model, contact.__class__):
+                    contact_ids.setdefault(model, []).append(contact.id)
+        children = {}
+        for model, item_ids in contact_ids.items():
+            for chunk_begin in range(0, len(item_ids), CustomValuesBatch.ID_CHUNK_SIZE):
+                for child in model.objects.filter(id__in=item_ids[chunk_begin:chunk_begin + CustomValuesBatch.ID_CHUNK_SIZE]):
+                    if cls.has_sub_models(model):
+                        child = LucteriosModel.get_final_child(child)
+                    children[child.id] = child
+        for contact in contacts:
+            if contact.id in children:
+                contact._set_final_child(children[contact.id])
+
+    @classmethod
+    def get_final_children(cls, contacts):
+        contacts = list(contacts)
+        cls.attach_final_children(contacts)
+        return [contact.get_final_child() for contact in contacts]
+
     class Meta(object):
         verbose_name = _('generic contact')
         verbose_name_plural = _('generic contacts')
+        ordering = ['sort_key']
 
 
 class LegalEntity(AbstractContact):
@@ -573,9 +1073,59 @@ class OurDetailPrintPlugin(PrintFieldsPlugIn):
 PrintFieldsPlugIn.add_plugin(OurDetailPrintPlugin)
 
 
+def customfield_changed(sender, **kwargs):
+    CustomField.change_cache_version()
+
+
+post_save.connect(customfield_changed, sender=CustomField)
+post_delete.connect(customfield_changed, sender=CustomField)
+
+
+def postalcode_changed(sender, **kwargs):
+    PostalCode.change_cache_version()
+
+
+post_save.connect(postalcode_changed, sender=PostalCode)
+post_delete.connect(postalcode_changed, sender=PostalCode)
+
+
+_contact_hooks = threading.local()
+
+
+@contextmanager
+def deferred_contact_hooks():
+    _contact_hooks.deferred = True
+    try:
+        yield
+    finally:
+        _contact_hooks.deferred = False
+
+
+def contact_saving(sender, instance, raw=False, **kwargs):
+    if isinstance(instance, AbstractContact) and not raw and not getattr(_contact_hooks, 'deferred', False):
+        instance.set_computed_fields()
+
+
+def contact_saved(sender, instance, raw=False, **kwargs):
+    if isinstance(instance, AbstractContact) and not raw and not getattr(_contact_hooks, 'deferred', False):
+        AbstractContact.contacts_saved([instance])
+
+
+def contact_deleted(sender, instance, **kwargs):
+    if isinstance(instance, AbstractContact):
+        from lucterios.contacts.autocomplete import ContactPrefixIndex
+        ContactPrefixIndex.contact_changed(instance, deleted=True)
+
+
+pre_save.connect(contact_saving)
+post_save.connect(contact_saved)
+post_delete.connect(contact_deleted)
+
+
 @Signal.decorate('checkparam')
 def contacts_checkparam():
     Parameter.check_and_create(name='contacts-mailtoconfig', typeparam=4, title=_("contacts-mailtoconfig"), args="{'Enum':3}", value='0',
                                param_titles=(_("contacts-mailtoconfig.0"), _("contacts-mailtoconfig.1"), _("contacts-mailtoconfig.2")))
     Parameter.check_and_create(name='contacts-createaccount', typeparam=4, title=_("contacts-createaccount"), args="{'Enum':3}", value='0',
                                param_titles=(_("contacts-createaccount.0"), _("contacts-createaccount.1"), _("contacts-createaccount.2")))
+    Parameter.check_and_create(name='contacts-imageurl', typeparam=3, title=_("contacts-imageurl"), args="{}", value='False')
@@ -26,8 +26,13 @@ from __future__ import unicode_literals
 from base64 import b64decode
 from shutil import rmtree
 from os.path import join, dirname, exists
+from io import StringIO
+import gzip
 
 from django.utils import six
+from django.db import connection, transaction, DatabaseError
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext
 
 from lucterios.framework.test import LucteriosTest, add_empty_user
 from lucterios.framework.xfergraphic import XferContainerAcknowledge
@@ -37,7 +42,8 @@ from lucterios.CORE.models import LucteriosUser
 
 from lucterios.contacts.views import PostalCodeList, PostalCodeAdd, Configuration, CurrentStructure, \
     CurrentStructureAddModify, Account, AccountAddModify, CurrentStructurePrint
-from lucterios.contacts.models import LegalEntity
+from lucterios.contacts.models import LegalEntity, CustomField, PostalCode
+from lucterios.contacts.images import ImageCache, ImageProcessor
 from lucterios.contacts.tests_contacts import change_ourdetail, create_jack
 
 
@@ -45,6 +51,8 @@ class PostalCodeTest(LucteriosTest):
 
     def setUp(self):
         LucteriosTest.setUp(self)
+        CustomField.clear_cache()
+        PostalCode.clear_cache()
         ourdetails = LegalEntity.objects.get(id=1)
         ourdetails.postal_code = "97400"
         ourdetails.save()
@@ -56,8 +64,9 @@ class PostalCodeTest(LucteriosTest):
         self.assert_observer('core.custom', 'lucterios.contacts', 'postalCodeList')
         self.assertEqual(self.json_meta['title'], 'Code postal')
         self.assertEqual(len(self.json_context), 1)
-        self.assertEqual(len(self.json_actions), 1)
-        self.assert_action_equal(self.json_actions[0], ('Fermer', 'images/close.png'))
+        self.assertEqual(len(self.json_actions), 2)
+        self.assert_action_equal(self.json_actions[0], ('Import', 'images/up.png', 'lucterios.contacts', 'postalCodeImport', 0, 1, 1))
+        self.assert_action_equal(self.json_actions[1], ('Fermer', 'images/close.png'))
         self.assert_count_equal('', 4)
         self.assert_comp_equal(('IMAGE', "img"), '/static/lucterios.contacts/images/postalCode.png', (0, 0, 1, 1))
         self.assert_comp_equal(('LABELFORM', "filtre"), '{[b]}Filtrer par code postal{[/b]}', (1, 0, 1, 1))
@@ -124,11 +133,61 @@ class PostalCodeTest(LucteriosTest):
         self.assert_json_equal('', 'type', '3')
         self.assert_json_equal('', 'text', six.text_type('Cet enregistrement existe déjà!'))
 
+    def test_cache(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(PostalCode.get_cities('97250'), [('FONDS ST DENIS', 'MARTINIQUE'), ('LE PRECHEUR', 'MARTINIQUE'), ('ST PIERRE', 'MARTINIQUE')])
+            self.assertEqual(PostalCode.get_cities('96999'), [])
+            self.assertEqual(len(PostalCode.get_codes_with_prefix('973')), 25)
+            self.assertEqual(PostalCode.get_codes_with_prefix('0'), [])
+        self.assertEqual(1, len(queries.captured_queries))
+
+        PostalCode.objects.create(postal_code='96999', city='Trifouilly', country='LOIN')
+        self.assertEqual(PostalCode.get_cities('96999'), [('Trifouilly', 'LOIN')])
+        self.assertEqual(PostalCode.objects.filter(PostalCode.get_prefix_filter('9699')).count(), 1)
+        self.assertEqual(PostalCode.objects.filter(PostalCode.get_prefix_filter('973')).count(), 27)
+        self.assertEqual(PostalCode.objects.filter(PostalCode.get_prefix_filter('0')).count(), 0)
+        PostalCode.objects.filter(postal_code='96999').delete()
+        self.assertEqual(PostalCode.get_cities('96999'), [])
+        try:
+            with transaction.atomic():
+                PostalCode.objects.create(postal_code='96998', city='Perpete', country='LOIN')
+                self.assertEqual(PostalCode.get_cities('96998'), [('Perpete', 'LOIN')])
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(PostalCode.get_cities('96998'), [('Perpete', 'LOIN')])
+                self.assertEqual(0, len(queries.captured_queries))
+                raise DatabaseError('rollback')
+        except DatabaseError:
+            pass
+        self.assertEqual(PostalCode.get_cities('96998'), [])
+
+    def test_load_file(self):
+        rmtree(get_user_dir(), True)
+        csv_path = join(get_user_dir(), 'postalcodes.csv.gz')
+        with gzip.open(csv_path, 'wt', encoding='utf-8') as csv_file:
+            csv_file.write('postal_code;city;country\n97250;ST PIERRE;MARTINIQUE\n96998;Trifouilly;LOIN\n96999;Trifouilly;LOIN\n96999;Trifouilly;LOIN\n')
+            csv_file.write('96997;Pétaouchnok;LOIN\n96996\n;ville;LOIN\n\n')
+        out = StringIO()
+        call_command('load_postalcodes', csv_path, stdout=out, stderr=StringIO())
+        self.assertIn('8 rows, 3 created, 2 existing, 2 errors', out.getvalue())
+        self.assertEqual(PostalCode.get_cities('96997'), [('Pétaouchnok', 'LOIN')])
+        self.assertEqual(PostalCode.objects.filter(country='LOIN').count(), 3)
+
+        tsv_path = join(get_user_dir(), 'postalcodes.tsv')
+        with open(tsv_path, 'w', encoding='utf-8') as tsv_file:
+            tsv_file.write('96995\tLà-bas\n96998\tTrifouilly\n')
+        out = StringIO()
+        call_command('load_postalcodes', tsv_path, country='LOIN', stdout=out)
+        self.assertIn('2 rows, 1 created, 1 existing, 0 errors', out.getvalue())
+        self.assertEqual(PostalCode.objects.filter(country='LOIN').count(), 4)
+
 
 class ConfigurationTest(LucteriosTest):
 
     def setUp(self):
         LucteriosTest.setUp(self)
+        CustomField.clear_cache()
+        ImageProcessor.wait()
+        ImageCache.clear()
         change_ourdetail()
         create_jack(add_empty_user())
         rmtree(get_user_dir(), True)
@@ -226,7 +285,7 @@ class ConfigurationTest(LucteriosTest):
         self.assertEqual(pdf_value[:4], "%PDF".encode('ascii', 'ignore'))
 
     def test_logo(self):
-        self.assertFalse(exists(get_user_path('contacts', 'Image_1.jpg')))
+        self.assertFalse(exists(get_user_path('contacts/c4', 'Image_1.jpg')))
         logo_path = join(dirname(__file__), "static", 'lucterios.contacts', 'images', 'ourDetails.png')
         logo_stream = "image.jpg;" + \
             readimage_to_base64(logo_path, False).decode("utf-8")
@@ -235,7 +294,11 @@ class ConfigurationTest(LucteriosTest):
         self.calljson('/lucterios.contacts/currentStructureAddModify',
                       {"SAVE": 'YES', "uploadlogo": logo_stream}, False)
         self.assert_observer('core.acknowledge', 'lucterios.contacts', 'currentStructureAddModify')
-        self.assertTrue(exists(get_user_path('contacts', 'Image_1.jpg')))
+        ImageProcessor.wait()
+        self.assertTrue(exists(get_user_path('contacts/c4', 'Image_1.jpg')))
+        self.assertTrue(exists(get_user_path('contacts/c4', 'Image_1_thumb.jpg')))
+        self.assertTrue(exists(get_user_path('contacts/c4', 'Image_1_print.jpg')))
+        self.assertFalse(exists(get_user_path('contacts/c4', 'Image_1.upload')))
 
         self.factory.xfer = CurrentStructure()
         self.calljson('/lucterios.contacts/currentStructure', {}, False)
@@ -23,12 +23,20 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import unicode_literals
-from shutil import rmtree
+from shutil import rmtree, copyfile
+from os import unlink, utime
 from os.path import join, dirname, exists
 from _io import StringIO
+from threading import Timer
+from time import time
 from base64 import b64decode
+from unittest.mock import patch
+import json
 
 from django.utils import six
+from django.db import connection, transaction, IntegrityError
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext
 
 from lucterios.framework.test import LucteriosTest
 from lucterios.framework.xfergraphic import XferContainerAcknowledge
@@ -37,17 +45,24 @@ from lucterios.framework.filetools import get_user_dir, readimage_to_base64, \
 from lucterios.framework.xfersearch import get_search_query_from_criteria
 from lucterios.CORE.views_usergroup import UsersEdit
 from lucterios.CORE.views import ObjectMerge
-
+from lucterios.CORE.models import Parameter
+from lucterios.CORE.parameters import Params
+
+from lucterios.contacts.importation import ContactImporter
+from lucterios.contacts.duplicate import DuplicateFinder, phonetic_key, normalize_text, normalize_phone
+from lucterios.contacts.autocomplete import ContactPrefixIndex
+from lucterios.contacts.images import ImageCache, ImageProcessor, get_image_base64, get_image_url, get_image_path, get_upload_path, IMAGE_PRINT
+from lucterios.contacts.address import AddressNormalizer, ADDRESS_VALID, ADDRESS_FIXED, ADDRESS_UNKNOWN_POSTAL_CODE, ADDRESS_CITY_MISMATCH
 from lucterios.contacts.views import Configuration, CustomFieldAddModify, \
     ContactImport
 from lucterios.contacts.models import LegalEntity, Individual, StructureType, \
-    Function, Responsability, CustomField, ContactCustomField
+    Function, Responsability, CustomField, ContactCustomField, CustomFieldArgs, ContactMatchKey, AbstractContact, PostalCode
 from lucterios.contacts.views_contacts import IndividualList, LegalEntityList, \
     LegalEntityAddModify, IndividualAddModify, IndividualShow, IndividualUserAdd, \
     IndividualUserValid, LegalEntityDel, LegalEntityShow, ResponsabilityAdd, \
     ResponsabilityModify, LegalEntitySearch, IndividualSearch, \
     LegalEntityListing, LegalEntityLabel, IndividualListing, IndividualLabel, \
-    AbstractContactFindDouble, AbstractContactShow
+    AbstractContactFindDouble, AbstractContactShow, AbstractContactAutocomplete, AbstractContactNormalizeAddress
 
 
 def change_ourdetail():
@@ -82,6 +97,12 @@ class ContactsTest(LucteriosTest):
 
     def setUp(self):
         LucteriosTest.setUp(self)
+        CustomField.clear_cache()
+        PostalCode.clear_cache()
+        AddressNormalizer.clear_cache()
+        ContactPrefixIndex.clear()
+        ImageProcessor.wait()
+        ImageCache.clear()
         change_ourdetail()
         rmtree(get_user_dir(), True)
         StructureType.objects.create(
@@ -147,7 +168,7 @@ class ContactsTest(LucteriosTest):
         self.assert_count_equal('individual', 0)
 
     def test_individual_image(self):
-        self.assertFalse(exists(get_user_path('contacts', 'Image_2.jpg')))
+        self.assertFalse(exists(get_user_path('contacts/c8', 'Image_2.jpg')))
         logo_path = join(dirname(__file__), 'docs', 'en', 'EditIndividual.png')
         logo_stream = "image.png;" + \
             readimage_to_base64(logo_path, False).decode("utf-8")
@@ -161,13 +182,83 @@ class ContactsTest(LucteriosTest):
         self.calljson('/lucterios.contacts/individualAddModify',
                       {"SAVE": 'YES', 'individual': '2', "uploadlogo": logo_stream}, False)
         self.assert_observer('core.acknowledge', 'lucterios.contacts', 'individualAddModify')
-        self.assertTrue(exists(get_user_path('contacts', 'Image_2.jpg')))
+        ImageProcessor.wait()
+        self.assertTrue(exists(get_user_path('contacts/c8', 'Image_2.jpg')))
 
         self.factory.xfer = IndividualShow()
         self.calljson('/lucterios.contacts/individualShow', {'individual': '2'}, False)
         self.assert_observer('core.custom', 'lucterios.contacts', 'individualShow')
         self.assert_json_equal('IMAGE', 'logoimg', "data:image/*;base64,", True)
 
+    def test_individual_image_cache(self):
+        self.assertIs(get_image_base64(1), get_image_base64(2))
+        self.assertIsNone(get_image_url(2))
+        logo_path = join(dirname(__file__), 'docs', 'en', 'EditIndividual.png')
+        logo_stream = "image.png;" + readimage_to_base64(logo_path, False).decode("utf-8")
+        self.factory.xfer = IndividualAddModify()
+        self.calljson('/lucterios.contacts/individualAddModify',
+                      {"SAVE": 'YES', 'individual': '2', "uploadlogo": logo_stream}, False)
+        self.assert_observer('core.acknowledge', 'lucterios.contacts', 'individualAddModify')
+        image_value = get_image_base64(2)
+        self.assertEqual(image_value[:29], b"data:image/*;base64,/9j/4AAQS")
+        self.assertIs(get_image_base64(2), image_value)
+        self.assertIsNot(get_image_base64(1), image_value)
+        self.assertEqual(Individual.objects.get(id=2).image, get_image_base64(2, IMAGE_PRINT).decode('ascii'))
+        self.assertNotEqual(get_image_base64(2, IMAGE_PRINT), image_value)
+        image_url = get_image_url(2)
+        self.assertEqual(image_url[:51], "CORE/download?filename=contacts/c8/Image_2.jpg&sign")
+
+        param = Parameter.objects.get(name='contacts-imageurl')
+        param.value = 'True'
+        param.save()
+        Params.clear()
+        self.factory.xfer = IndividualShow()
+        self.calljson('/lucterios.contacts/individualShow', {'individual': '2'}, False)
+        self.assert_observer('core.custom', 'lucterios.contacts', 'individualShow')
+        self.assert_json_equal('IMAGE', 'logoimg', image_url)
+        self.factory.xfer = LegalEntityShow()
+        self.calljson('/lucterios.contacts/legalEntityShow', {'legal_entity': '1'}, False)
+        self.assert_observer('core.custom', 'lucterios.contacts', 'legalEntityShow')
+        self.assert_json_equal('IMAGE', 'logoimg', "/static/lucterios.contacts/images/NoImage.png")
+
+    def test_individual_image_in_progress(self):
+        work_path = get_upload_path(2) + ".work"
+        with open(work_path, "wb") as work_file:
+            work_file.write(b"")
+        Timer(0.3, unlink, [work_path]).start()
+        ImageProcessor.ensure(2)
+        self.assertFalse(exists(work_path))
+
+        with open(work_path, "wb") as work_file:
+            work_file.write(b"")
+        utime(work_path, (time() - 60, time() - 60))
+        ImageProcessor.ensure(2)
+        self.assertTrue(exists(work_path))
+        unlink(work_path)
+
+    def test_individual_image_shard(self):
+        logo_path = join(dirname(__file__), 'static', 'lucterios.contacts', 'images', 'NoImage.png')
+        for filename in ('Image_2.jpg', 'Image_2_print.jpg', 'Image_1.jpg'):
+            copyfile(logo_path, get_user_path('contacts', filename))
+        self.assertEqual(get_image_path(2), get_user_path('contacts', 'Image_2.jpg'))
+        self.assertEqual(get_image_path(2, with_legacy=False), get_user_path('contacts/c8', 'Image_2.jpg'))
+        legacy_value = get_image_base64(2)
+        self.assertEqual(legacy_value, readimage_to_base64(logo_path))
+
+        out = StringIO()
+        call_command('shard_images', stdout=out)
+        self.assertEqual(out.getvalue().strip(), "3 pictures moved")
+        self.assertFalse(exists(get_user_path('contacts', 'Image_2.jpg')))
+        self.assertTrue(exists(get_user_path('contacts/c8', 'Image_2.jpg')))
+        self.assertTrue(exists(get_user_path('contacts/c8', 'Image_2_print.jpg')))
+        self.assertTrue(exists(get_user_path('contacts/c4', 'Image_1.jpg')))
+        self.assertEqual(get_image_path(2), get_user_path('contacts/c8', 'Image_2.jpg'))
+        self.assertEqual(get_image_base64(2), legacy_value)
+
+        out = StringIO()
+        call_command('shard_images', stdout=out)
+        self.assertEqual(out.getvalue().strip(), "0 pictures moved")
+
     def test_individual_user(self):
         self.factory.xfer = IndividualShow()
         self.calljson('/lucterios.contacts/individualShow', {'individual': '2'}, False)
@@ -279,6 +370,119 @@ class ContactsTest(LucteriosTest):
         self.assert_count_equal('', 20)
         self.assert_count_equal('individual', 0)
 
+    def test_individual_search_text(self):
+        self._initial_custom_values()
+        create_jack(firstname="Hélène", lastname="ÉBÈNE", with_email=False)
+        Individual.objects.get(id=2).set_custom_values({'custom_1': 'Grand Blabla', 'custom_2': '5'})
+        for name_filter, nb_individual in (('helene', 1), ('EBENE hél', 1), ('0278451295', 2), ('02-78', 2), ('worldcompany', 1), ('blabla', 1), ('precheur', 2), ('truc', 0)):
+            self.factory.xfer = IndividualList()
+            self.calljson('/lucterios.contacts/individualList', {'filter': name_filter}, False)
+            self.assert_observer('core.custom', 'lucterios.contacts', 'individualList')
+            self.assert_count_equal('individual', nb_individual)
+
+    def test_contact_autocomplete(self):
+        self.assertEqual(ContactPrefixIndex.search('mis'), [(2, 'MISTER jack', 'contacts.Individual')])
+        create_jack(firstname="Hélène", lastname="ÉBÈNE", with_email=False)
+        LegalEntity.objects.create(name="Mister Bricolage", address="rue de la gare", postal_code="97200", city="FORT DE FRANCE", country="MARTINIQUE")
+        self.assertEqual(len(ContactPrefixIndex.get_index()), 4)
+        self.assertEqual([item[0] for item in ContactPrefixIndex.search('MIST')], [2, 4])
+        self.assertEqual([item[0] for item in ContactPrefixIndex.search('mist ja')], [2])
+        self.assertEqual([item[0] for item in ContactPrefixIndex.search('mist', kind='contacts.LegalEntity')], [4])
+        self.assertEqual([item[0] for item in ContactPrefixIndex.search('hel')], [3])
+        self.assertEqual(len(ContactPrefixIndex.search('mist', 1)), 1)
+        self.assertEqual(ContactPrefixIndex.search(''), [])
+
+        Individual.objects.filter(id=3).delete()
+        jack = Individual.objects.get(id=2)
+        jack.lastname = 'DOE'
+        jack.save()
+        self.assertEqual(ContactPrefixIndex.search('hel'), [])
+        self.assertEqual([item[0] for item in ContactPrefixIndex.search('mist')], [4])
+        self.assertEqual([item[0] for item in ContactPrefixIndex.search('doe')], [2])
+
+        self.factory.xfer = AbstractContactAutocomplete()
+        self.calljson('/lucterios.contacts/abstractContactAutocomplete', {'prefix': 'w'}, False)
+        self.assert_observer('core.custom', 'lucterios.contacts', 'abstractContactAutocomplete')
+        self.assert_count_equal('abstractcontact', 1)
+        self.assert_json_equal('', 'abstractcontact/@0/id', '1')
+        self.assert_json_equal('', 'abstractcontact/@0/contact', 'WoldCompany')
+        self.assert_json_equal('', 'abstractcontact/@0/modelname', 'personne morale')
+
+    def test_contact_final_child(self):
+        create_jack(firstname="Hélène", lastname="ÉBÈNE", with_email=False)
+        LegalEntity.objects.create(name="Mister Bricolage", address="rue de la gare", postal_code="97200", city="FORT DE FRANCE", country="MARTINIQUE")
+        AbstractContact.objects.create(address="rue de la paix", postal_code="97200", city="FORT DE FRANCE", country="MARTINIQUE")
+        self.assertEqual(list(AbstractContact.objects.order_by('id').values_list('final_modelname', flat=True)),
+                         ['contacts.LegalEntity', 'contacts.Individual', 'contacts.Individual', 'contacts.LegalEntity', 'contacts.AbstractContact'])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(AbstractContact.objects.get(id=3).get_final_child().__class__, Individual)
+        self.assertEqual(2, len(queries.captured_queries))
+        with CaptureQueriesContext(connection) as queries:
+            contacts = AbstractContact.get_final_children(AbstractContact.objects.order_by('id'))
+            self.assertEqual([six.text_type(contact) for contact in contacts], ['WoldCompany', 'MISTER jack', 'ÉBÈNE Hélène', 'Mister Bricolage', 'contact#5'])
+            self.assertEqual([contact.__class__ for contact in contacts], [LegalEntity, Individual, Individual, LegalEntity, AbstractContact])
+        self.assertEqual(3, len(queries.captured_queries))
+        with CaptureQueriesContext(connection) as queries:
+            contacts = list(AbstractContact.objects.order_by('id'))
+        self.assertEqual(1, len(queries.captured_queries))
+        with CaptureQueriesContext(connection) as queries:
+            contacts = [contact.get_final_child() for contact in AbstractContact.objects.order_by('id').with_final_children()]
+            self.assertEqual([contact.__class__ for contact in contacts], [LegalEntity, Individual, Individual, LegalEntity, AbstractContact])
+        self.assertEqual(3, len(queries.captured_queries))
+
+    def test_contact_display_name(self):
+        create_jack(firstname="Hélène", lastname="ÉBÈNE", with_email=False)
+        LegalEntity.objects.create(name="Mister Bricolage", address="rue de la gare", postal_code="97200", city="FORT DE FRANCE", country="MARTINIQUE")
+        AbstractContact.objects.create(address="rue de la paix", postal_code="97200", city="FORT DE FRANCE", country="MARTINIQUE")
+        self.assertEqual(list(AbstractContact.objects.values_list('id', 'display_name', 'sort_key')),
+                         [(5, '', ''), (3, 'ÉBÈNE Hélène', 'ebene helene'), (4, 'Mister Bricolage', 'mister bricolage'),
+                          (2, 'MISTER jack', 'mister jack'), (1, 'WoldCompany', 'woldcompany')])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual([six.text_type(contact) for contact in AbstractContact.objects.filter(id__in=[2, 3]).only('id', 'display_name')],
+                             ['ÉBÈNE Hélène', 'MISTER jack'])
+            self.assertEqual(six.text_type(AbstractContact.objects.get(id=4)), 'Mister Bricolage')
+        self.assertEqual(2, len(queries.captured_queries))
+
+        jack = Individual.objects.get(id=2)
+        jack.lastname = 'Doe'
+        jack.save()
+        contact = AbstractContact.objects.get(id=3)
+        contact.city = 'LE PRECHEUR'
+        contact.save()
+        self.assertEqual(list(AbstractContact.objects.filter(id__in=[2, 3]).values_list('display_name', 'sort_key')),
+                         [('Doe jack', 'doe jack'), ('ÉBÈNE Hélène', 'ebene helene')])
+
+    def test_address_normalize(self):
+        self.assertEqual(tuple(AddressNormalizer.normalize('97250', 'LE PRECHEUR', 'MARTINIQUE')), ('97250', 'LE PRECHEUR', 'MARTINIQUE', ADDRESS_VALID))
+        self.assertEqual(tuple(AddressNormalizer.normalize('97250', 'Saint-Pierre', '')), ('97250', 'ST PIERRE', 'MARTINIQUE', ADDRESS_FIXED))
+        self.assertEqual(tuple(AddressNormalizer.normalize('97200 ', '', 'FRANCE')), ('97200', 'FORT DE FRANCE', 'MARTINIQUE', ADDRESS_FIXED))
+        self.assertEqual(AddressNormalizer.normalize('97250', '', '').status, ADDRESS_CITY_MISMATCH)
+        self.assertEqual(AddressNormalizer.normalize('97250', 'FORT DE FRANCE', 'MARTINIQUE').status, ADDRESS_CITY_MISMATCH)
+        self.assertEqual(AddressNormalizer.normalize('96999', 'Trifouilly', 'LOIN').status, ADDRESS_UNKNOWN_POSTAL_CODE)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(AddressNormalizer.normalize('97250', 'Saint-Pierre', '').city, 'ST PIERRE')
+        self.assertEqual(0, len(queries.captured_queries))
+
+        create_jack(firstname="Hélène", lastname="ÉBÈNE", with_email=False)
+        Individual.objects.filter(id=3).update(city='fort-de-france', postal_code='97200', country='')
+        create_jack(firstname="Joe", lastname="DALTON", with_email=False)
+        Individual.objects.filter(id=4).update(city='Trifouilly', postal_code='96999', country='LOIN')
+        self.factory.xfer = AbstractContactNormalizeAddress()
+        self.calljson('/lucterios.contacts/abstractContactNormalizeAddress', {'modelname': 'contacts.Individual', 'CRITERIA': ''}, False)
+        self.assert_observer('core.custom', 'lucterios.contacts', 'abstractContactNormalizeAddress')
+        self.assert_count_equal('address', 2)
+        self.assert_json_equal('', 'address/@0/id', '4')
+        self.assert_json_equal('', 'address/@1/id', '3')
+        self.assert_json_equal('', 'address/@1/normalized', '97200 FORT DE FRANCE MARTINIQUE')
+        self.assertEqual(len(self.json_actions), 2)
+
+        self.factory.xfer = AbstractContactNormalizeAddress()
+        self.calljson('/lucterios.contacts/abstractContactNormalizeAddress', {'modelname': 'contacts.Individual', 'CRITERIA': '', 'CONFIRME': 'YES'}, False)
+        self.assert_observer('core.dialogbox', 'lucterios.contacts', 'abstractContactNormalizeAddress')
+        self.assertEqual(list(Individual.objects.filter(id__in=[3, 4]).order_by('id').values_list('city', 'country')),
+                         [('FORT DE FRANCE', 'MARTINIQUE'), ('Trifouilly', 'LOIN')])
+
     def test_individual_listing(self):
         self.factory.xfer = IndividualListing()
         self.calljson('/lucterios.contacts/individualListing', {}, False)
@@ -699,6 +903,30 @@ class ContactsTest(LucteriosTest):
         self.assert_json_equal('', 'custom_field/@4/model_title', 'personne physique')
         self.assert_json_equal('', 'custom_field/@4/kind_txt', 'Sélection (U,V,W,X,Y,Z)')
 
+        eee_field = CustomField.objects.get(name='eee')
+        self.assertEqual({'min': 0.0, 'max': 0.0, 'prec': 0.0, 'list': ['U', 'V', 'W', 'X', 'Y', 'Z'], 'multi': False}, json.loads(eee_field.args))
+        self.assertEqual(('U', 'V', 'W', 'X', 'Y', 'Z'), eee_field.args_spec.list)
+        self.assertEqual(3, eee_field.args_spec.list_index['X'])
+
+    def test_custom_fields_args(self):
+        args = CustomFieldArgs.parse("{'multi':True, 'min':-2, 'max':5.5, 'list':['a','b']}")
+        self.assertEqual((-2, 5.5, 0, ('a', 'b'), True), args[:5])
+        self.assertEqual({'a': 0, 'b': 1}, dict(args.list_index))
+        self.assertEqual(args, CustomFieldArgs.parse(args.to_json()))
+        self.assertEqual((0, 0, 0, (), False), CustomFieldArgs.parse("__import__('os').getcwd()")[:5])
+        self.assertEqual((0, 0, 0, (), False), CustomFieldArgs.parse("")[:5])
+
+        accented_list = ['Élève', 'Secrétaire général', 'Trésorière', 'Présidente', 'Chargée de mission', 'Bénévole', 'Invité', 'Député']
+        self.factory.xfer = CustomFieldAddModify()
+        self.calljson('/lucterios.contacts/customFieldAddModify', {"SAVE": "YES", 'name': 'fff', 'modelname': 'contacts.Individual', 'kind': '4',
+                                                                   'args_multi': 'n', 'args_min': '0', 'args_max': '0', 'args_prec': '0',
+                                                                   'args_list': ','.join(accented_list)}, False)
+        self.assert_observer('core.acknowledge', 'lucterios.contacts', 'customFieldAddModify')
+        fff_field = CustomField.objects.get(name='fff')
+        self.assertNotIn('\\u', fff_field.args)
+        self.assertLessEqual(len(fff_field.args), 200)
+        self.assertEqual(tuple(accented_list), fff_field.args_spec.list)
+
     def _initial_custom_values(self):
         initial_values = [{'name': 'aaa', 'modelname': 'contacts.AbstractContact', 'kind': '0', 'args': "{'multi':False, 'min':0, 'max':0, 'prec':0, 'list':[]}"},
                           {'name': 'bbb', 'modelname': 'contacts.AbstractContact', 'kind': '1',
@@ -811,6 +1039,102 @@ class ContactsTest(LucteriosTest):
         self.assertEqual(" 0 0.0 Non ", indiv_jack.evaluate(print_text[168:252]))
         self.assertEqual("boum! -67 9.9 W a{[br/]}z ", indiv_jack.evaluate(print_text[252:]))
 
+    def test_custom_fields_batch(self):
+        self._initial_custom_values()
+
+        def get_default_fields_with_custom(cls):
+            return ["firstname", "lastname", ('aaa', 'custom_1'), ('bbb', 'custom_2'), ('eee', 'custom_5')]
+
+        def count_queries_of_list():
+            with patch.object(Individual, 'get_default_fields', classmethod(get_default_fields_with_custom)):
+                with CaptureQueriesContext(connection) as queries:
+                    self.factory.xfer = IndividualList()
+                    self.calljson('/lucterios.contacts/individualList', {}, False)
+                    self.assert_observer('core.custom', 'lucterios.contacts', 'individualList')
+            return len(queries.captured_queries), len([query for query in queries.captured_queries if 'contacts_contactcustomfield' in query['sql']])
+
+        Individual.objects.get(id=2).set_custom_values({'custom_1': 'abc', 'custom_2': '5', 'custom_5': 'V'})
+        for idx in range(4):
+            create_jack(firstname="jack%d" % idx).set_custom_values({'custom_1': 'abc', 'custom_2': '5', 'custom_5': 'V'})
+        count_queries_of_list()  # warm the parameter cache
+        nb_queries_5, nb_custom_queries_5 = count_queries_of_list()
+        self.assert_count_equal('individual', 5)
+        self.assert_json_equal('', 'individual/@0/custom_1', 'abc')
+        self.assert_json_equal('', 'individual/@0/custom_2', '5')
+        self.assert_json_equal('', 'individual/@0/custom_5', 'V')
+
+        for idx in range(4, 24):
+            create_jack(firstname="jack%d" % idx).set_custom_values({'custom_1': 'abc', 'custom_2': '5', 'custom_5': 'V'})
+        nb_queries_25, nb_custom_queries_25 = count_queries_of_list()
+        self.assert_count_equal('individual', 25)
+        self.assert_json_equal('', 'individual/@24/custom_1', 'abc')
+
+        self.assertLessEqual(nb_custom_queries_25, 2)
+        self.assertEqual(nb_custom_queries_5, nb_custom_queries_25)
+        self.assertEqual(nb_queries_5, nb_queries_25)
+
+    def test_custom_fields_cache(self):
+        self._initial_custom_values()
+        self.assertEqual(['custom_1', 'custom_2', 'custom_3', 'custom_5', 'custom_6'], [cf_name for cf_name, _cf_model in CustomField.get_fields(Individual)])
+        self.assertEqual(['custom_1', 'custom_2', 'custom_3', 'custom_4'], [cf_name for cf_name, _cf_model in CustomField.get_fields(LegalEntity)])
+        with CaptureQueriesContext(connection) as queries:
+            CustomField.get_fields(Individual)
+            CustomField.get_fields(LegalEntity)
+            self.assertEqual('eee', CustomField.get_cached(5).name)
+            self.assertEqual(['U', 'V', 'W', 'X', 'Y', 'Z'], CustomField.get_cached(5).get_args()['list'])
+        self.assertEqual(0, len(queries.captured_queries))
+
+        CustomField.objects.create(name='ggg', modelname='contacts.Individual', kind=0, args="{'multi':False}")
+        self.assertEqual(['custom_1', 'custom_2', 'custom_3', 'custom_5', 'custom_6', 'custom_7'], [cf_name for cf_name, _cf_model in CustomField.get_fields(Individual)])
+        self.assertEqual(4, len(CustomField.get_fields(LegalEntity)))
+
+        CustomField.objects.get(id=2).delete()
+        self.assertEqual(['custom_1', 'custom_3', 'custom_5', 'custom_6', 'custom_7'], [cf_name for cf_name, _cf_model in CustomField.get_fields(Individual)])
+        self.assertEqual(['custom_1', 'custom_3', 'custom_4'], [cf_name for cf_name, _cf_model in CustomField.get_fields(LegalEntity)])
+
+    def test_custom_fields_bulk(self):
+        self._initial_custom_values()
+        rowdatas = [{'firstname': 'jack%d' % idx, 'lastname': 'MISTER', 'address': 'rue de la libert\xe9', 'postal_code': '97250', 'city': 'LE PRECHEUR',
+                     'country': 'MARTINIQUE', 'tel1': '', 'tel2': '', 'email': '', 'custom_1': 'abc', 'custom_2': '5', 'custom_3': 'xyz', 'custom_5': 'V'} for idx in range(10)]
+        with CaptureQueriesContext(connection) as queries:
+            new_items = Individual.import_data_list(rowdatas, '%d/%m/%Y')
+        self.assertEqual(10, len(new_items))
+        self.assertEqual(1, len([query for query in queries.captured_queries if query['sql'].startswith('INSERT') and 'contacts_contactcustomfield' in query['sql']]))
+        self.assertEqual(40, ContactCustomField.objects.filter(contact__in=new_items).count())
+        new_item = Individual.objects.get(id=new_items[3].id)
+        self.assertEqual(('abc', 5, 0.0, 'V'), (new_item.custom_1, new_item.custom_2, new_item.custom_3, new_item.custom_5))
+
+        with CaptureQueriesContext(connection) as queries:
+            Individual.set_custom_values_list([(item, {'custom_1': 'abc', 'custom_2': '7', 'custom_5': 'Y'}) for item in new_items])
+        self.assertEqual(2, len([query for query in queries.captured_queries if query['sql'].startswith('UPDATE')]))
+        self.assertEqual(0, len([query for query in queries.captured_queries if query['sql'].startswith('INSERT')]))
+        new_item = Individual.objects.get(id=new_items[7].id)
+        self.assertEqual(('abc', 7, 0.0, 'Y'), (new_item.custom_1, new_item.custom_2, new_item.custom_3, new_item.custom_5))
+
+    def test_custom_fields_unique(self):
+        self._initial_custom_values()
+        Individual.objects.get(id=2).set_custom_values({'custom_1': 'abc', 'custom_2': '5'})
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                ContactCustomField.objects.create(contact_id=2, field_id=1, value='def')
+        with CaptureQueriesContext(connection) as queries:
+            individual = Individual.objects.get(id=2)
+            self.assertEqual(('abc', 5), (individual.custom_1, individual.custom_2))
+        self.assertEqual(0, len([query for query in queries.captured_queries if not query['sql'].startswith('SELECT')]))
+
+    def test_custom_fields_readonly(self):
+        self._initial_custom_values()
+        individual = Individual.objects.get(id=2)
+        self.assertEqual(('', 0, 0.0, 'U', ''), (individual.custom_1, individual.custom_2, individual.custom_3, individual.custom_5, individual.custom_6))
+        self.assertEqual(0, ContactCustomField.objects.all().count())
+
+        individual.set_custom_values({'custom_1': '', 'custom_2': '5', 'custom_3': 'abc'})
+        self.assertEqual(3, ContactCustomField.objects.all().count())
+        out = StringIO()
+        call_command('purge_customvalues', stdout=out)
+        self.assertEqual('2 empty custom field values', out.getvalue().strip())
+        self.assertEqual(['5'], [ccf.value for ccf in ContactCustomField.objects.all()])
+
     def test_custom_fields_search(self):
         from django.db.models import Q
         self._initial_custom_values()
@@ -865,7 +1189,10 @@ class ContactsTest(LucteriosTest):
         self.assert_observer('core.custom', 'lucterios.contacts', 'abstractContactFindDouble')
         self.assert_count_equal('individual', 2)
         self.assert_json_equal('', 'individual/@0/id', '2')
+        self.assert_json_equal('', 'individual/@0/group', '1')
+        self.assert_json_equal('', 'individual/@0/score', '100 %')
         self.assert_json_equal('', 'individual/@1/id', '3')
+        self.assert_json_equal('', 'individual/@1/group', '1')
 
         self.factory.xfer = ObjectMerge()
         self.calljson('/CORE/objectMerge',
@@ -914,6 +1241,59 @@ class ContactsTest(LucteriosTest):
         self.assert_json_equal('LABELFORM', 'lastname', "MISTER")
         self.assert_json_equal('LINK', 'email', "jack@worldcompany.com")
 
+    def test_duplicate_finder(self):
+        self.assertEqual('a261 r163', phonetic_key('Ashcraft Robert'))
+        self.assertEqual('eloise dupont leger', normalize_text('Éloïse  DUPONT-Léger'))
+        self.assertEqual(normalize_phone('+33 6 12 34 56 78'), normalize_phone('06.12.34.56.78'))
+        create_jack(firstname="Jàck", lastname="Mister", with_email=False)
+        create_jack(firstname="Jak", lastname="MISTERE")
+        create_jack(firstname="john", lastname="DOE")
+        clusters = DuplicateFinder(Individual).find_clusters()
+        self.assertEqual(1, len(clusters))
+        self.assertEqual([2, 3, 4], clusters[0].ids)
+        self.assertEqual(1.0, clusters[0].score)
+        self.assertEqual([], DuplicateFinder(LegalEntity).find_clusters())
+
+        phone_and_email = create_jack(firstname="anne", lastname="ONYME")
+        phone_and_email.tel2 = "05-55-55-55-55"
+        phone_and_email.save()
+        same_email = create_jack(firstname="anne", lastname="DUPONT")
+        same_email.tel2 = ""
+        same_email.save()
+        same_phone = create_jack(firstname="zoe", lastname="MARTIN", with_email=False)
+        same_phone.tel2 = "05-55-55-55-55"
+        same_phone.save()
+        self.assertEqual([[2, 3, 4]], [cluster.ids for cluster in Individual.get_duplicate_clusters()])
+
+    def test_duplicate_match_keys(self):
+        self.assertEqual(['email', 'name', 'phone', 'phonetic', 'postal_code'], sorted(ContactMatchKey.objects.filter(contact_id=2).values_list('kind', flat=True)))
+        jack_params = {"address": 'rue du port', "firstname": 'Jàck', "lastname": 'Mister', "city": 'LE PRECHEUR', "country": 'MARTINIQUE',
+                       "tel2": '02 78 45 12 95', "postal_code": '97250', "email": '', "genre": "1", "SAVE": 'YES'}
+        self.factory.xfer = IndividualAddModify()
+        self.calljson('/lucterios.contacts/individualAddModify', jack_params, False)
+        self.assert_observer('core.dialogbox', 'lucterios.contacts', 'individualAddModify')
+        self.assert_json_equal('', 'type', '3')
+        self.assertIn('MISTER jack', self.json_data['text'])
+        self.assertEqual(1, Individual.objects.all().count())
+
+        jack_params['CONFIRME'] = 'YES'
+        self.factory.xfer = IndividualAddModify()
+        self.calljson('/lucterios.contacts/individualAddModify', jack_params, False)
+        self.assert_observer('core.acknowledge', 'lucterios.contacts', 'individualAddModify')
+        self.assertEqual(2, Individual.objects.all().count())
+        self.assertEqual([[2, 3]], [cluster.ids for cluster in DuplicateFinder(Individual).find_clusters(ContactMatchKey.get_candidate_keys(Individual))])
+        self.assertEqual([[2, 3]], [cluster.ids for cluster in Individual.get_duplicate_clusters()])
+
+        other = Individual.objects.get(id=3)
+        other.lastname = 'DOE'
+        other.firstname = 'john'
+        other.save()
+        self.assertEqual({}, ContactMatchKey.get_candidate_keys(LegalEntity))
+        self.assertEqual([], DuplicateFinder(Individual).find_clusters(ContactMatchKey.get_candidate_keys(Individual)))
+        self.assertEqual([], Individual.get_duplicate_clusters())
+        other.delete()
+        self.assertEqual(0, ContactMatchKey.objects.filter(contact_id=3).count())
+
     def test_import_contacts(self):
         csv_content = """value;nom;adresse;codePostal;ville;fixe;portable;mail;Num;Type
 4.6;USIF;37 avenue de la plage;99673;TOUINTOUIN;0502851031;0439423854;pierre572@free.fr;1000029;Type B
@@ -1002,3 +1382,60 @@ class ContactsTest(LucteriosTest):
         self.factory.xfer = LegalEntityList()
         self.calljson('/lucterios.contacts/legalEntityList', {"structure_type": 2}, False)
         self.assert_count_equal('legal_entity', 2)
+
+    def test_import_contacts_chunks(self):
+        self._initial_custom_values()
+        rowdatas = [{'firstname': 'jack', 'lastname': 'MISTER', 'address': 'rue de la liberté', 'postal_code': '97250', 'city': 'LE PRECHEUR', 'email': 'jack@worldcompany.com', 'custom_2': '5'},
+                    {'firstname': 'john', 'lastname': 'DOE', 'address': 'rue de la paix', 'postal_code': '97200', 'city': '', 'email': '', 'custom_2': '7'},
+                    {'firstname': 'jane', 'lastname': 'DOE', 'address': 'rue de la paix', 'postal_code': '97250', 'city': 'LE PRECHEUR', 'email': 'jane.doe', 'custom_2': '8'},
+                    {'firstname': 'jack', 'lastname': 'MISTER', 'address': 'rue du port', 'postal_code': '97250', 'city': 'LE PRECHEUR', 'email': 'jack@worldcompany.com', 'custom_2': '6'},
+                    {'firstname': 'joe', 'lastname': 'DALTON', 'address': 'rue de la prison', 'postal_code': '97250', 'city': 'LE PRECHEUR', 'email': '', 'custom_2': '9'}]
+        progress = []
+        importer = ContactImporter(Individual, '%d/%m/%Y', chunk_size=2, progress=lambda current: progress.append(current.nb_rows))
+        importer.import_rows(iter(rowdatas))
+        self.assertEqual([2, 4, 5], progress)
+        self.assertEqual(5, importer.nb_rows)
+        self.assertEqual(3, len(importer.imported_ids))
+        self.assertEqual([3], [line_num for line_num, _message in importer.errors])
+        self.assertGreater(importer.rows_per_second, 0)
+
+        jack = Individual.objects.get(firstname='jack', lastname='MISTER')
+        self.assertEqual(('rue du port', 6), (jack.address, jack.custom_2))
+        john = Individual.objects.get(firstname='john', lastname='DOE')
+        self.assertEqual(('FORT DE FRANCE', 'MARTINIQUE', 7), (john.city, john.country, john.custom_2))
+        self.assertEqual(0, Individual.objects.filter(firstname='jane').count())
+
+    def test_import_contacts_bulk(self):
+        self._initial_custom_values()
+        nb_queries = []
+        for nb_rows in (5, 15):
+            rowdatas = [{'firstname': 'bob%d' % idx, 'lastname': 'BULK%d' % nb_rows, 'address': 'rue de la liberté', 'postal_code': '97250', 'city': 'LE PRECHEUR',
+                         'email': 'bob%d@worldcompany.com' % idx, 'custom_2': '%d' % idx} for idx in range(nb_rows)]
+            importer = ContactImporter(Individual, '%d/%m/%Y', chunk_size=20)
+            with CaptureQueriesContext(connection) as queries:
+                importer.import_rows(iter(rowdatas))
+            self.assertEqual(nb_rows, len(importer.imported_ids))
+            nb_queries.append(len(queries))
+        self.assertLessEqual(nb_queries[1] - nb_queries[0], 10)
+        bob = Individual.objects.get(firstname='bob7', lastname='BULK15')
+        self.assertEqual(('BULK15 bob7', 7), (bob.display_name, bob.custom_2))
+        self.assertEqual([bob], list(Individual.objects.filter(Individual.get_search_filter('bob7@worldcompany'))))
+        self.assertEqual(1, ContactMatchKey.objects.filter(contact_id=bob.id, kind='email').count())
+
+    def test_import_contacts_processes(self):
+        self._initial_custom_values()
+        rowdatas = [{'firstname': 'jack%d' % idx, 'lastname': 'MISTER', 'address': 'rue de la liberté', 'postal_code': '97250', 'city': 'LE PRECHEUR',
+                     'email': 'jack%d@worldcompany.com' % idx if (idx % 3) != 0 else 'jack%d' % idx, 'genre': 'Femme' if (idx % 2) == 0 else 'Homme', 'custom_2': '%d' % idx, 'custom_5': 'W'} for idx in range(20)]
+        serial_importer = ContactImporter(Individual, '%d/%m/%Y', chunk_size=3)
+        serial_chunks = list(serial_importer.get_validated_chunks(iter(rowdatas)))
+        parallel_importer = ContactImporter(Individual, '%d/%m/%Y', chunk_size=3, processes=2)
+        parallel_chunks = list(parallel_importer.get_validated_chunks(iter(rowdatas)))
+        self.assertEqual(serial_chunks, parallel_chunks)
+        self.assertEqual([1, 4, 7, 10, 13, 16, 19], [line_num for _chunk, errors in parallel_chunks for line_num, _message in errors])
+
+        parallel_importer = ContactImporter(Individual, '%d/%m/%Y', chunk_size=3, processes=2)
+        parallel_importer.import_rows(iter(rowdatas))
+        self.assertEqual(13, len(parallel_importer.imported_ids))
+        self.assertEqual([1, 4, 7, 10, 13, 16, 19], [line_num for line_num, _message in parallel_importer.errors])
+        jack = Individual.objects.get(firstname='jack5')
+        self.assertEqual((1, 5, 'W'), (jack.genre, jack.custom_2, jack.custom_5))
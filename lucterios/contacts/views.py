@@ -23,23 +23,21 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 from __future__ import unicode_literals
-from os.path import exists
-
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.utils import six
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Q
 from django.db import IntegrityError, transaction
+from django.apps import apps
 
 from lucterios.framework.tools import MenuManage, FORMTYPE_NOMODAL, FORMTYPE_REFRESH, CLOSE_NO, WrapAction, ActionsManage, \
     FORMTYPE_MODAL, get_icon_path, SELECT_SINGLE, CLOSE_YES, SELECT_MULTI
 from lucterios.framework.xfergraphic import XferContainerCustom, XferContainerAcknowledge
 from lucterios.framework.xferadvance import XferDelete, XferAddEditor, XferListEditor, TITLE_DELETE, TITLE_ADD, TITLE_MODIFY, TEXT_TOTAL_NUMBER
-from lucterios.framework.xfercomponents import XferCompImage, XferCompLabelForm, XferCompEdit, XferCompGrid, XferCompButton, XferCompCaptcha
+from lucterios.framework.xfercomponents import XferCompImage, XferCompLabelForm, XferCompEdit, XferCompGrid, XferCompButton, XferCompCaptcha, \
+    XferCompUpLoad
 from lucterios.framework import signal_and_lock
 from lucterios.framework.error import LucteriosException, IMPORTANT
-from lucterios.framework.filetools import get_user_path, readimage_to_base64
 
 from lucterios.CORE.models import LucteriosUser
 from lucterios.CORE.views_usergroup import UsersEdit
@@ -49,6 +47,8 @@ from lucterios.CORE.parameters import Params, notfree_mode_connect
 
 from lucterios.contacts.models import PostalCode, Function, StructureType, LegalEntity, Individual, CustomField, AbstractContact, Responsability
 from lucterios.contacts.views_contacts import LegalEntityAddModify, LegalEntityShow
+from lucterios.contacts.importation import ContactImporter, PostalCodeLoader
+from lucterios.contacts.images import fill_image
 
 
 @MenuManage.describ(None)
@@ -87,15 +87,8 @@ class Account(XferContainerCustom):
         self.fill_from_model(1, 1, True, fields[_('001@Identity')])
         self.get_components('name').colspan = 2
         self.get_components('structure_type').colspan = 2
-        img_path = get_user_path(
-            "contacts", "Image_%s.jpg" % legal_entity.abstractcontact_ptr_id)
         img = XferCompImage('logoimg')
-        if exists(img_path):
-            img.type = 'jpg'
-            img.set_value(readimage_to_base64(img_path))
-        else:
-            img.set_value(
-                get_icon_path("lucterios.contacts/images/NoImage.png"))
+        fill_image(img, legal_entity.abstractcontact_ptr_id)
         img.set_location(0, 2, 1, 6)
         self.add_component(img)
 
@@ -438,7 +431,7 @@ class PostalCodeList(XferListEditor):
         comp.set_action(self.request, self.get_action(), modal=FORMTYPE_REFRESH, close=CLOSE_NO)
         comp.set_location(1, 1)
         self.add_component(comp)
-        self.filter = Q(postal_code__startswith=filter_postal_code)
+        self.filter = PostalCode.get_prefix_filter(filter_postal_code)
 
 
 @ActionsManage.affect_grid(TITLE_ADD, "images/add.png")
@@ -451,6 +444,73 @@ class PostalCodeAdd(XferAddEditor):
     field_id = 'postalCode'
 
 
+@ActionsManage.affect_list(_("Import"), "images/up.png")
+@MenuManage.describ('contacts.add_postalcode')
+class PostalCodeImport(XferContainerCustom):
+    caption = _("Postal code import")
+    icon = "postalCode.png"
+    model = PostalCode
+    field_id = 'postalCode'
+
+    def _select_file(self, country, delimiter, encoding):
+        upld = XferCompUpLoad('postalcodefile')
+        upld.http_file = True
+        upld.add_filter(".csv")
+        upld.add_filter(".tsv")
+        upld.add_filter(".txt")
+        upld.add_filter(".gz")
+        upld.set_location(1, 0, 2)
+        upld.description = _('postal code file')
+        self.add_component(upld)
+        edt = XferCompEdit('country')
+        edt.set_value(country)
+        edt.set_location(1, 1, 2)
+        edt.description = _('default country')
+        self.add_component(edt)
+        edt = XferCompEdit('delimiter')
+        edt.set_value(delimiter)
+        edt.set_location(1, 2)
+        edt.description = _('delimiter')
+        self.add_component(edt)
+        edt = XferCompEdit('encoding')
+        edt.set_value(encoding)
+        edt.set_location(2, 2)
+        edt.description = _('encoding')
+        self.add_component(edt)
+        self.add_action(self.get_action(_('Ok'), "images/ok.png"), close=CLOSE_NO, params={'step': 1})
+        self.add_action(WrapAction(_("Cancel"), "images/cancel.png"))
+
+    def _load_file(self, country, delimiter, encoding):
+        loader = PostalCodeLoader(country, delimiter)
+        loader.load(PostalCodeLoader.open_stream(self.request.FILES['postalcodefile'].file, encoding))
+        lbl = XferCompLabelForm('result')
+        lbl.set_value_as_header(_("%(created)d postal codes created, %(existing)d already existing (%(speed).1f rows/s)") %
+                                {'created': loader.nb_created, 'existing': loader.nb_existing, 'speed': loader.rows_per_second})
+        lbl.set_location(1, 0, 2)
+        self.add_component(lbl)
+        if len(loader.errors) > 0:
+            grid = XferCompGrid('errors')
+            grid.add_header('line', _('line'))
+            grid.add_header('message', _('error'))
+            for line_num, message in loader.errors:
+                grid.set_value(line_num, 'line', line_num)
+                grid.set_value(line_num, 'message', message)
+            grid.set_location(1, 1, 2)
+            grid.description = _("%d errors") % len(loader.errors)
+            self.add_component(grid)
+        self.add_action(WrapAction(_("Close"), "images/close.png"))
+
+    def fillresponse(self, country='', delimiter='', encoding='utf-8', step=0):
+        img = XferCompImage('img')
+        img.set_value(self.icon_path())
+        img.set_location(0, 0, 1, 3)
+        self.add_component(img)
+        if (step == 0) or ('postalcodefile' not in self.request.FILES.keys()):
+            self._select_file(country, delimiter, encoding)
+        else:
+            self._load_file(country, delimiter, encoding)
+
+
 @MenuManage.describ('contacts.change_postalcode', FORMTYPE_MODAL, 'contact.conf', _('Tool to import contacts from CSV file.'))
 class ContactImport(ObjectImport):
     caption = _("Contact import")
@@ -459,10 +519,55 @@ class ContactImport(ObjectImport):
     def get_select_models(self):
         return AbstractContact.get_select_contact_type(False)
 
+    def _read_csv_rows(self):
+        import_fields = [fieldname[0] if isinstance(fieldname, tuple) else fieldname for fieldname in self.model.get_import_fields()]
+        fields_association = {}
+        for param_key in self.params.keys():
+            if (param_key[:4] == 'fld_') and (self.params[param_key] != "") and (param_key[4:] in import_fields):
+                fields_association[param_key[4:]] = self.params[param_key]
+        self._read_csv()
+        for row in self.spamreader:
+            if row[self.spamreader.fieldnames[0]] is not None:
+                yield dict([(fieldname, row[csv_name] if row.get(csv_name) is not None else '') for fieldname, csv_name in fields_association.items()])
+
+    def _import_contacts(self, dateformat):
+        importer = ContactImporter(self.model, dateformat, keep_items=False)
+        importer.import_rows(self._read_csv_rows())
+        lbl = XferCompLabelForm('result')
+        lbl.set_value_as_header(_("%d items are been imported") % len(importer.imported_ids))
+        lbl.set_location(1, 2, 2)
+        self.add_component(lbl)
+        if len(importer.errors) > 0:
+            grid = XferCompGrid('errors')
+            grid.add_header('line', _('line'))
+            grid.add_header('message', _('error'))
+            for line_num, message in importer.errors:
+                grid.set_value(line_num, 'line', line_num)
+                grid.set_value(line_num, 'message', message)
+            grid.set_location(1, 3, 2)
+            grid.description = _("%(nb)d errors (%(speed).1f rows/s)") % {'nb': len(importer.errors), 'speed': importer.rows_per_second}
+            self.add_component(grid)
+
+    def fillresponse(self, modelname, quotechar="'", delimiter=";", encoding="utf-8", dateformat="%d/%m/%Y", step=0):
+        if step != 3:
+            ObjectImport.fillresponse(self, modelname, quotechar, delimiter, encoding, dateformat, step)
+            return
+        self.model = apps.get_model(modelname)
+        self.quotechar = quotechar
+        self.delimiter = delimiter
+        self.encoding = encoding
+        self.dateformat = dateformat
+        img = XferCompImage('img')
+        img.set_value(self.icon_path())
+        img.set_location(0, 0, 1, 6)
+        self.add_component(img)
+        self._import_contacts(dateformat)
+        self.add_action(WrapAction(_("Close"), "images/close.png"))
+
 
 @signal_and_lock.Signal.decorate('config')
 def config_contacts(xfer):
-    new_params = ['contacts-mailtoconfig', 'contacts-createaccount']
+    new_params = ['contacts-mailtoconfig', 'contacts-createaccount', 'contacts-imageurl']
     Params.fill(xfer, new_params, 1, 10)
     xfer.params['params'].extend(new_params)
     return True
@@ -26,18 +26,19 @@ from __future__ import unicode_literals
 
 from django.utils.translation import ugettext_lazy as _
 from django.utils import six
+from django.db import transaction
 from django.db.models import Q
 from django.apps.registry import apps
 
-from lucterios.framework.tools import MenuManage, WrapAction, ActionsManage, SELECT_MULTI
+from lucterios.framework.tools import MenuManage, WrapAction, ActionsManage, SELECT_MULTI, SELECT_NONE
 from lucterios.framework.tools import FORMTYPE_NOMODAL, FORMTYPE_REFRESH, CLOSE_NO, FORMTYPE_MODAL, CLOSE_YES, SELECT_SINGLE
-from lucterios.framework.xfergraphic import XferContainerCustom, XferContainerAcknowledge
+from lucterios.framework.xfergraphic import XferContainerCustom, XferContainerAcknowledge, XferContainerDialogBox, XFER_DBOX_WARNING
 from lucterios.framework.xferadvance import XferAddEditor, XferDelete, XferShowEditor, XferListEditor, XferSave,\
     TITLE_ADD, TITLE_MODIFY, TITLE_EDIT, TITLE_PRINT, TITLE_DELETE, TITLE_LABEL,\
     TITLE_LISTING
 from lucterios.framework.xfercomponents import XferCompLabelForm, XferCompEdit, XferCompImage, XferCompGrid,\
     XferCompButton
-from lucterios.framework.xfersearch import XferSearchEditor
+from lucterios.framework.xfersearch import XferSearchEditor, get_search_query_from_criteria
 from lucterios.framework import signal_and_lock
 
 from lucterios.CORE.editors import XferSavedCriteriaSearchEditor
@@ -45,7 +46,9 @@ from lucterios.CORE.models import LucteriosUser
 from lucterios.CORE.xferprint import XferPrintAction, XferPrintListing, XferPrintLabel
 from lucterios.CORE.views import ObjectMerge, ObjectPromote
 
-from lucterios.contacts.models import LegalEntity, Individual, Responsability, AbstractContact
+from lucterios.contacts.models import LegalEntity, Individual, Responsability, AbstractContact, ContactMatchKey
+from lucterios.contacts.autocomplete import ContactPrefixIndex
+from lucterios.contacts.address import AddressNormalizer, ADDRESS_VALID, ADDRESS_FIXED
 
 MenuManage.add_sub(
     "office", None, "lucterios.contacts/images/office.png", _("Office"), _("Office tools"), 70)
@@ -54,10 +57,31 @@ MenuManage.add_sub("contact.actions", "office", "lucterios.contacts/images/conta
                    _("Addresses and contacts"), _("Management of men or women and organizations saved."), 50)
 
 
+class AbstractContactAddModify(XferAddEditor):
+
+    def run_save(self, request, *args, **kwargs):
+        if self.is_new and (self.getparam("CONFIRME") is None):
+            similar_contacts = ContactMatchKey.get_similar_contacts(self.item)
+            if len(similar_contacts) > 0:
+                dlg = XferContainerDialogBox()
+                dlg.request = self.request
+                dlg.is_view_right = self.is_view_right
+                dlg.caption = self.caption_add
+                dlg.extension = self.extension
+                dlg.action = self.action
+                dlg.set_dialog(_("This contact looks like existing contacts:{[br/]}%s{[br/]}Do you want to save it anyway?") %
+                               "{[br/]}".join([six.text_type(contact) for contact in similar_contacts[:5]]), XFER_DBOX_WARNING)
+                dlg.add_action(self.get_action(_("Yes"), "images/ok.png"), modal=FORMTYPE_MODAL, close=CLOSE_YES, params={"CONFIRME": "YES"})
+                dlg.add_action(WrapAction(_("No"), "images/cancel.png"))
+                dlg.closeaction = self.closeaction
+                return dlg.get_post(request, *args, **kwargs)
+        return XferAddEditor.run_save(self, request, *args, **kwargs)
+
+
 @ActionsManage.affect_grid(TITLE_ADD, "images/add.png")
 @ActionsManage.affect_show(TITLE_MODIFY, "images/edit.png", close=CLOSE_YES)
 @MenuManage.describ('contacts.add_abstractcontact')
-class LegalEntityAddModify(XferAddEditor):
+class LegalEntityAddModify(AbstractContactAddModify):
     icon = "legalEntity.png"
     model = LegalEntity
     field_id = 'legal_entity'
@@ -65,6 +89,67 @@ class LegalEntityAddModify(XferAddEditor):
     caption_modify = _("Modify legal entity")
 
 
+@MenuManage.describ('contacts.change_abstractcontact')
+class AbstractContactNormalizeAddress(XferContainerAcknowledge):
+    caption = _("Normalize addresses")
+    icon = "contacts.png"
+    model = AbstractContact
+    field_id = 'abstractcontact'
+
+    def _search_model(self):
+        modelname = self.getparam('modelname')
+        if modelname is not None:
+            self.model = apps.get_model(modelname)
+        XferContainerAcknowledge._search_model(self)
+
+    def fillresponse(self, CRITERIA=''):
+        filter_result, _desc = get_search_query_from_criteria(CRITERIA, self.model)
+        addresses = AddressNormalizer.normalize_contacts(self.model.objects.filter(filter_result).distinct())
+        to_fix = [(contact, address) for contact, address in addresses if address.status == ADDRESS_FIXED]
+        if self.getparam("CONFIRME") is None:
+            dlg = self.create_custom()
+            img = XferCompImage('img')
+            img.set_value(self.icon_path())
+            img.set_location(0, 0, 1, 3)
+            dlg.add_component(img)
+            lbl = XferCompLabelForm('title')
+            lbl.set_value_as_title(self.caption)
+            lbl.set_location(1, 0)
+            dlg.add_component(lbl)
+            lbl = XferCompLabelForm('result')
+            lbl.set_value(_("%(nb)d contacts: %(valid)d valid, %(fixed)d to normalize, %(wrong)d to check") %
+                          {'nb': len(addresses), 'valid': len([address for _contact, address in addresses if address.status == ADDRESS_VALID]),
+                           'fixed': len(to_fix), 'wrong': len([address for _contact, address in addresses if address.status > ADDRESS_FIXED])})
+            lbl.set_location(1, 1)
+            dlg.add_component(lbl)
+            grid = XferCompGrid('address')
+            grid.add_header('contact', _('contact'))
+            grid.add_header('current', _('address'))
+            grid.add_header('normalized', _('normalized address'))
+            grid.add_header('status', _('status'))
+            for contact, address in addresses:
+                if address.status != ADDRESS_VALID:
+                    grid.set_value(contact.id, 'contact', six.text_type(contact))
+                    grid.set_value(contact.id, 'current', "%s %s %s" % (contact.postal_code, contact.city, contact.country))
+                    grid.set_value(contact.id, 'normalized', "%s %s %s" % (address.postal_code, address.city, address.country))
+                    grid.set_value(contact.id, 'status', address.status_text)
+            grid.set_location(1, 2)
+            dlg.add_component(grid)
+            if len(to_fix) > 0:
+                dlg.add_action(self.get_action(_('Ok'), "images/ok.png"), close=CLOSE_YES, modal=FORMTYPE_MODAL, params={'CONFIRME': 'YES'})
+                dlg.add_action(WrapAction(_("Cancel"), "images/cancel.png"))
+            else:
+                dlg.add_action(WrapAction(_("Close"), "images/close.png"))
+        else:
+            with transaction.atomic():
+                for contact, address in to_fix:
+                    contact.postal_code = address.postal_code
+                    contact.city = address.city
+                    contact.country = address.country
+                    contact.save()
+            self.message(_("%d addresses normalized") % len(to_fix))
+
+
 @ActionsManage.affect_grid(TITLE_EDIT, "images/show.png", unique=SELECT_SINGLE)
 @MenuManage.describ('contacts.change_abstractcontact')
 class LegalEntityShow(XferShowEditor):
@@ -153,7 +238,7 @@ class LegalEntityLabel(XferPrintLabel):
 @ActionsManage.affect_grid(TITLE_ADD, "images/add.png")
 @ActionsManage.affect_show(TITLE_MODIFY, "images/edit.png", close=CLOSE_YES)
 @MenuManage.describ('contacts.add_abstractcontact')
-class IndividualAddModify(XferAddEditor):
+class IndividualAddModify(AbstractContactAddModify):
     icon = "individual.png"
     model = Individual
     field_id = 'individual'
@@ -221,8 +306,7 @@ class IndividualList(XferListEditor):
         comp.description = _('Filtrer by name')
         self.add_component(comp)
         if name_filter != "":
-            self.filter = Q(firstname__icontains=name_filter) | Q(
-                lastname__icontains=name_filter)
+            self.filter = Individual.get_search_filter(name_filter)
 
     def fillresponse(self):
         XferListEditor.fillresponse(self)
@@ -240,7 +324,7 @@ class IndividualLabel(XferPrintLabel):
     def get_filter(self):
         name_filter = self.getparam('filter')
         if (name_filter is not None) and (name_filter != ""):
-            return [Q(firstname__icontains=name_filter) | Q(lastname__icontains=name_filter)]
+            return [Individual.get_search_filter(name_filter)]
         else:
             return XferPrintLabel.get_filter(self)
 
@@ -257,7 +341,7 @@ class IndividualListing(XferPrintListing):
     def get_filter(self):
         name_filter = self.getparam('filter')
         if (name_filter is not None) and (name_filter != ""):
-            return Q(firstname__icontains=name_filter) | Q(lastname__icontains=name_filter)
+            return Individual.get_search_filter(name_filter)
         else:
             return XferPrintListing.get_filter(self)
 
@@ -320,8 +404,7 @@ class ResponsabilityAdd(XferContainerCustom):
         self.add_component(comp)
         identfilter = []
         if name_filter != "":
-            identfilter = [
-                Q(firstname__icontains=name_filter) | Q(lastname__icontains=name_filter)]
+            identfilter = [Individual.get_search_filter(name_filter)]
         items = Individual.objects.filter(
             *identfilter)
         grid = XferCompGrid('individual')
@@ -355,6 +438,26 @@ class ResponsabilityDel(XferDelete):
     field_id = 'responsability'
 
 
+@MenuManage.describ('contacts.change_abstractcontact')
+class AbstractContactAutocomplete(XferContainerCustom):
+    caption = _("Search contact")
+    icon = "contacts.png"
+    field_id = 'abstractcontact'
+
+    def fillresponse(self, prefix='', modelname='', nb_result=10):
+        grid = XferCompGrid(self.field_id)
+        grid.add_header('contact', _('contact'))
+        grid.add_header('modelname', _('type'))
+        model_names = {}
+        for contact_id, label, contact_modelname in ContactPrefixIndex.search(prefix, nb_result, modelname):
+            if contact_modelname not in model_names:
+                model_names[contact_modelname] = six.text_type(apps.get_model(contact_modelname)._meta.verbose_name)
+            grid.set_value(contact_id, 'contact', label)
+            grid.set_value(contact_id, 'modelname', model_names[contact_modelname])
+        grid.set_location(0, 0)
+        self.add_component(grid)
+
+
 @MenuManage.describ('contacts.change_abstractcontact', FORMTYPE_NOMODAL, 'contact.actions', _('To find an individual following a set of criteria.'))
 class IndividualSearch(XferSavedCriteriaSearchEditor):
     caption = _("Individual search")
@@ -368,6 +471,9 @@ class IndividualSearch(XferSavedCriteriaSearchEditor):
         if WrapAction.is_permission(self.request, 'contacts.add_abstractcontact'):
             self.get_components(self.field_id).add_action(self.request, ObjectMerge.get_action(_("Merge"), "images/clone.png"),
                                                           close=CLOSE_NO, unique=SELECT_MULTI, params={'modelname': self.model.get_long_name(), 'field_id': self.field_id})
+        if WrapAction.is_permission(self.request, 'contacts.change_abstractcontact'):
+            self.get_components(self.field_id).add_action(self.request, AbstractContactNormalizeAddress.get_action(_("Normalize addresses"), "images/config.png"),
+                                                          close=CLOSE_NO, unique=SELECT_NONE, params={'modelname': self.model.get_long_name()})
         self.add_action(AbstractContactFindDouble.get_action(_("duplicate"), "images/clone.png"),
                         params={'modelname': self.model.get_long_name(), 'field_id': self.field_id}, pos_act=0)
 
@@ -385,6 +491,9 @@ class LegalEntitySearch(XferSavedCriteriaSearchEditor):
         if WrapAction.is_permission(self.request, 'contacts.add_abstractcontact'):
             self.get_components(self.field_id).add_action(self.request, ObjectMerge.get_action(_("Merge"), "images/clone.png"),
                                                           close=CLOSE_NO, unique=SELECT_MULTI, params={'modelname': self.model.get_long_name(), 'field_id': self.field_id})
+        if WrapAction.is_permission(self.request, 'contacts.change_abstractcontact'):
+            self.get_components(self.field_id).add_action(self.request, AbstractContactNormalizeAddress.get_action(_("Normalize addresses"), "images/config.png"),
+                                                          close=CLOSE_NO, unique=SELECT_NONE, params={'modelname': self.model.get_long_name()})
         self.add_action(AbstractContactFindDouble.get_action(_("duplicate"), "images/clone.png"),
                         params={'modelname': self.model.get_long_name(), 'field_id': self.field_id}, pos_act=0)
 
@@ -396,8 +505,23 @@ class AbstractContactFindDouble(XferListEditor):
     model = AbstractContact
     field_id = 'abstractcontact'
 
-    def fillresponse_header(self):
-        self.filter = self.model.get_query_for_duplicate()
+    def fillresponse_body(self):
+        clusters = self.model.get_duplicate_clusters()
+        contacts = self.model.objects.with_final_children().in_bulk([contact_id for cluster in clusters for contact_id in cluster.ids])
+        grid = XferCompGrid(self.field_id)
+        grid.add_header('contact', _('contact'))
+        grid.add_header('group', _('group'))
+        grid.add_header('score', _('score'))
+        for group_idx, cluster in enumerate(clusters):
+            for contact_id in cluster.ids:
+                if contact_id in contacts:
+                    grid.set_value(contact_id, 'contact', six.text_type(contacts[contact_id]))
+                    grid.set_value(contact_id, 'group', group_idx + 1)
+                    grid.set_value(contact_id, 'score', "%d %%" % round(cluster.score * 100))
+        grid.add_action_notified(self, model=self.model)
+        grid.set_location(0, self.get_max_row() + 1, 2)
+        grid.set_size(200, 500)
+        self.add_component(grid)
 
     def fillresponse(self, modelname, field_id):
         if modelname is not None:
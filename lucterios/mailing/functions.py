@@ -25,9 +25,17 @@ along with Lucterios.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
 
 from email.mime.text import MIMEText
-from smtplib import SMTP, SMTP_SSL
+from smtplib import SMTP, SMTP_SSL, SMTPException, SMTPServerDisconnected, SMTPResponseException, SMTPRecipientsRefused, \
+    SMTPSenderRefused, SMTPDataError
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from time import time, sleep
+import threading
+import socket
+import re
 
 from email.utils import formatdate
+from email.policy import compat32
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 
@@ -53,20 +61,226 @@ def split_doubled_email(email_list):
         return None
 
 
-def send_email(recipients, subject, body, files=None, cclist=None, bcclist=None, withcopy=False):
-    smtp_server = Params.getvalue('mailing-smtpserver')
-    sender_email = LegalEntity.objects.get(id=1).email
-    if (sender_email == '') or (smtp_server == ''):
-        raise LucteriosException(IMPORTANT, _('Email not configure!'))
-    if recipients is None:
-        recipients = sender_email
-    if not isinstance(recipients, list):
-        recipients = [six.text_type(recipients)]
-    recipients = split_doubled_email(recipients)
-    smtp_port = Params.getvalue('mailing-smtpport')
-    smtp_user = Params.getvalue('mailing-smtpuser')
-    smtp_pass = Params.getvalue('mailing-smtppass')
-    smtp_security = Params.getvalue('mailing-smtpsecurity')
+class EmailSender(object):
+
+    TIMEOUT = 60
+
+    def __init__(self, max_messages=None):
+        self.smtp_server = Params.getvalue('mailing-smtpserver')
+        self.sender_email = LegalEntity.objects.get(id=1).email
+        if (self.sender_email == '') or (self.smtp_server == ''):
+            raise LucteriosException(IMPORTANT, _('Email not configure!'))
+        self.smtp_port = Params.getvalue('mailing-smtpport')
+        self.smtp_user = Params.getvalue('mailing-smtpuser')
+        self.smtp_pass = Params.getvalue('mailing-smtppass')
+        self.smtp_security = Params.getvalue('mailing-smtpsecurity')
+        if max_messages is None:
+            max_messages = Params.getvalue('mailing-msg-by-connection')
+        self.max_messages = max_messages
+        self.server = None
+        self.nb_sent = 0
+        self.nb_connections = 0
+        self.last_error_code = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        self.close()
+        if self.smtp_security == 2:
+            self.server = SMTP_SSL(self.smtp_server, self.smtp_port, timeout=self.TIMEOUT)
+        else:
+            self.server = SMTP(self.smtp_server, self.smtp_port, timeout=self.TIMEOUT)
+        self.nb_connections += 1
+        if self.smtp_security == 1:
+            self.server.starttls()
+        if (self.smtp_pass != '') and (self.smtp_user != ''):
+            self.server.login(self.smtp_user, self.smtp_pass)
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (SMTPException, OSError):
+                self.server.close()
+            self.server = None
+        self.nb_sent = 0
+
+    @classmethod
+    def is_reconnectable(cls, error):
+        if isinstance(error, SMTPServerDisconnected):
+            return True
+        if isinstance(error, SMTPResponseException):
+            return error.smtp_code == 421
+        if isinstance(error, SMTPException):
+            return False
+        return isinstance(error, (socket.timeout, ConnectionError))
+
+    @classmethod
+    def get_error_code(cls, error):
+        if isinstance(error, SMTPResponseException):
+            return error.smtp_code
+        if isinstance(error, SMTPRecipientsRefused) and (len(error.recipients) > 0):
+            return min([recipient_error[0] for recipient_error in error.recipients.values()])
+        return 0
+
+    def _send_envelope(self, recipients, msg_data):
+        if (self.server is None) or (self.nb_sent >= self.max_messages):
+            self.connect()
+        self.server.ehlo_or_helo_if_needed()
+        mail_options = []
+        if self.server.does_esmtp and self.server.has_extn('size'):
+            mail_options.append("size=%d" % len(msg_data))
+        (code, resp) = self.server.mail(self.sender_email, mail_options)
+        if code != 250:
+            raise SMTPSenderRefused(code, resp, self.sender_email)
+        refused = {}
+        for recipient in recipients:
+            (code, resp) = self.server.rcpt(recipient)
+            if code == 421:
+                raise SMTPServerDisconnected(resp)
+            if code not in (250, 251):
+                refused[recipient] = (code, resp)
+        if len(refused) == len(recipients):
+            self.server.rset()
+            raise SMTPRecipientsRefused(refused)
+
+    def _send_data(self, msg_data):
+        (code, resp) = self.server.data(msg_data)
+        if code != 250:
+            raise SMTPDataError(code, resp)
+        self.nb_sent += 1
+
+    def sendmail(self, recipients, msg_string):
+        try:
+            msg_data = msg_string
+            if isinstance(msg_data, six.text_type):
+                msg_data = re.sub(r'(?:\r\n|\n|\r(?!\n))', "\r\n", msg_data).encode('ascii')
+            reused = (self.server is not None) and (self.nb_sent < self.max_messages)
+            try:
+                self._send_envelope(recipients, msg_data)
+            except Exception as error:
+                # only a stale connection before DATA is retried: the message can not be sent twice
+                if not reused or not self.is_reconnectable(error):
+                    raise
+                self.close()
+                self._send_envelope(recipients, msg_data)
+            self._send_data(msg_data)
+        except SMTPRecipientsRefused as error:
+            self.last_error_code = self.get_error_code(error)
+            raise LucteriosException(IMPORTANT, six.text_type(error))
+        except Exception as error:
+            self.last_error_code = self.get_error_code(error)
+            self.close()
+            raise LucteriosException(IMPORTANT, six.text_type(error))
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval > 0:
+            with self.lock:
+                now = time()
+                send_time = max(now, self.next_time)
+                self.next_time = send_time + self.interval
+            if send_time > now:
+                sleep(send_time - now)
+
+
+class EmailSenderPool(object):
+
+    def __init__(self, nb_connection=None, rate=None, max_messages=None):
+        if nb_connection is None:
+            nb_connection = Params.getvalue('mailing-nb-connection')
+        if rate is None:
+            rate = Params.getvalue('mailing-rate')
+        self.senders = Queue()
+        self.all_senders = []
+        for _idx in range(max(nb_connection, 1)):
+            sender = EmailSender(max_messages)
+            self.senders.put(sender)
+            self.all_senders.append(sender)
+        self.sender_email = self.all_senders[0].sender_email
+        self.limiter = RateLimiter(rate)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.all_senders))
+        self.stat_lock = threading.Lock()
+        self.nb_sent = 0
+        self.nb_throttled = 0
+        self.begin_time = None
+        self.end_time = None
+
+    @property
+    def duration(self):
+        if self.begin_time is None:
+            return 0.0
+        return self.end_time - self.begin_time
+
+    @property
+    def rate(self):
+        if self.duration > 0:
+            return self.nb_sent / self.duration
+        return 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for sender in self.all_senders:
+            sender.close()
+
+    def _sendmail(self, recipients, msg_string):
+        self.limiter.wait()
+        sender = self.senders.get()
+        with self.stat_lock:
+            if self.begin_time is None:
+                self.begin_time = time()
+        try:
+            sender.sendmail(recipients, msg_string)
+            with self.stat_lock:
+                self.nb_sent += 1
+        except LucteriosException:
+            if 400 <= sender.last_error_code < 500:
+                with self.stat_lock:
+                    self.nb_throttled += 1
+            raise
+        finally:
+            with self.stat_lock:
+                self.end_time = time()
+            self.senders.put(sender)
+
+    def send_all(self, emails):
+        futures = [self.executor.submit(self._sendmail, recipients, msg_string) for recipients, msg_string in emails]
+        for future in futures:
+            try:
+                future.result()
+                yield None
+            except Exception as error:
+                yield six.text_type(error)
+
+
+def get_adaptive_batch(nb_by_batch, delay_batch, nb_sent, nb_throttled, duration, min_delay, max_delay, max_nb_by_batch):
+    if nb_throttled > 0:
+        return max(1, nb_by_batch // 2), min(max_delay, delay_batch * 2)
+    delay_batch = max(min_delay, delay_batch / 2)
+    if (nb_sent >= nb_by_batch) and (duration > 0):
+        target_nb = int(nb_sent * delay_batch * 30.0 / duration)
+        nb_by_batch = max(1, min(max_nb_by_batch, nb_by_batch * 2, target_nb))
+    return nb_by_batch, delay_batch
+
+
+def create_mime(sender_email, subject, body, files=None):
     body = six.text_type(body).strip()
     if body[:6].lower() == '<html>':
         subtype = 'html'
@@ -75,6 +289,38 @@ def send_email(recipients, subject, body, files=None, cclist=None, bcclist=None,
     msg = MIMEMultipart()
     msg['Date'] = formatdate(localtime=True)
     msg['Subject'] = six.text_type(subject)
+    msg['From'] = sender_email
+    msg.attach(MIMEText(body, subtype, 'utf-8'))
+    if files:
+        for filename, file in files:
+            msg.attach(MIMEApplication(
+                file.read(),
+                Content_Disposition='attachment; filename="%s"' % filename,
+                Name=filename
+            ))
+    return msg
+
+
+class EmailTemplate(object):
+
+    def __init__(self, sender_email, subject, body, files=None):
+        self.content = create_mime(sender_email, subject, body, files).as_string()
+
+    def get_content(self, recipients):
+        return compat32.fold('To', ", ".join(recipients)) + self.content
+
+
+def send_email(recipients, subject, body, files=None, cclist=None, bcclist=None, withcopy=False, sender=None):
+    if sender is None:
+        with EmailSender(1) as sender:
+            return send_email(recipients, subject, body, files, cclist, bcclist, withcopy, sender)
+    sender_email = sender.sender_email
+    if recipients is None:
+        recipients = sender_email
+    if not isinstance(recipients, list):
+        recipients = [six.text_type(recipients)]
+    recipients = split_doubled_email(recipients)
+    msg = create_mime(sender_email, subject, body, files)
     msg['To'] = ", ".join(recipients)
     if isinstance(cclist, list):
         cclist = split_doubled_email(cclist)
@@ -94,31 +340,7 @@ def send_email(recipients, subject, body, files=None, cclist=None, bcclist=None,
             if recipient in bcclist:
                 bcclist.remove(recipient)
         recipients.extend(bcclist)
-    msg['From'] = sender_email
-    msg.attach(MIMEText(body, subtype, 'utf-8'))
-    if files:
-        for filename, file in files:
-            msg.attach(MIMEApplication(
-                file.read(),
-                Content_Disposition='attachment; filename="%s"' % filename,
-                Name=filename
-            ))
-    server = None
-    try:
-        if smtp_security == 2:
-            server = SMTP_SSL(smtp_server, smtp_port)
-        else:
-            server = SMTP(smtp_server, smtp_port)
-        if smtp_security == 1:
-            server.starttls()
-        if (smtp_pass != '') and (smtp_user != ''):
-            server.login(smtp_user, smtp_pass)
-        server.sendmail(sender_email, recipients, msg.as_string())
-    except Exception as error:
-        raise LucteriosException(IMPORTANT, six.text_type(error))
-    finally:
-        if server:
-            server.quit()
+    sender.sendmail(recipients, msg.as_string())
 
 
 def send_connection_by_email(recipients, alias, passwd):
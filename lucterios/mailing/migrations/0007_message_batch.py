@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0006_message_doc_in_link'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='nb_by_batch',
+            field=models.IntegerField(default=0, verbose_name='batch size'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='delay_batch',
+            field=models.FloatField(default=0, verbose_name='batch delay'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sending_rate',
+            field=models.FloatField(default=0, verbose_name='sending rate (emails/s)'),
+        ),
+    ]
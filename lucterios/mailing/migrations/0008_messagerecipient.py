@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+'''
+Move the pending emails of messages from the email_to_send text into the MessageRecipient queue
+'''
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+ID_CHUNK_SIZE = 500
+
+
+def convert_email_to_send(apps, schema_editor):
+    Message = apps.get_model("mailing", "Message")
+    MessageRecipient = apps.get_model("mailing", "MessageRecipient")
+    AbstractContact = apps.get_model("contacts", "AbstractContact")
+    for message in Message.objects.exclude(email_to_send=''):
+        email_items = []
+        for contact_email in message.email_to_send.split("\n"):
+            if ':' in contact_email:
+                contact_id, email = contact_email.split(':', 1)
+                email_items.append((int(contact_id), email))
+        item_ids = [contact_id for contact_id, _email in email_items]
+        contact_ids = set()
+        for chunk_begin in range(0, len(item_ids), ID_CHUNK_SIZE):
+            contact_ids.update(AbstractContact.objects.filter(id__in=item_ids[chunk_begin:chunk_begin + ID_CHUNK_SIZE]).values_list('id', flat=True))
+        email_set = set()
+        recipient_list = []
+        for contact_id, email in email_items:
+            if email not in email_set:
+                email_set.add(email)
+                recipient_list.append(MessageRecipient(message=message, contact_id=contact_id if contact_id in contact_ids else None, email=email))
+        MessageRecipient.objects.bulk_create(recipient_list, batch_size=ID_CHUNK_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0004_length_field'),
+        ('mailing', '0007_message_batch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageRecipient',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.CharField(max_length=254, verbose_name='email')),
+                ('status', models.IntegerField(choices=[(0, 'pending'), (1, 'sending'), (2, 'sent'), (3, 'failed')], default=0, verbose_name='status')),
+                ('contact', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='contacts.AbstractContact', verbose_name='contact')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mailing.Message', verbose_name='message')),
+            ],
+            options={
+                'verbose_name': 'recipient',
+                'verbose_name_plural': 'recipients',
+                'default_permissions': [],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='messagerecipient',
+            unique_together={('message', 'email')},
+        ),
+        migrations.AlterIndexTogether(
+            name='messagerecipient',
+            index_together={('message', 'status')},
+        ),
+        migrations.RunPython(convert_email_to_send, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0008_messagerecipient'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='message',
+            name='email_to_send',
+        ),
+    ]
@@ -40,7 +40,9 @@ from lucterios.CORE.models import Parameter
 from lucterios.CORE.parameters import Params
 from lucterios.contacts.models import AbstractContact
 from lucterios.documents.models import Document
-from lucterios.mailing.functions import will_mail_send, send_email
+from lucterios.mailing.functions import will_mail_send, EmailSenderPool, EmailTemplate, get_adaptive_batch
+
+MAX_DELAY_BATCH = 120
 
 
 class Message(LucteriosModel):
@@ -50,9 +52,11 @@ class Message(LucteriosModel):
     recipients = models.TextField(_('recipients'), default="", null=False)
     date = models.DateField(verbose_name=_('date'), null=True)
     contact = models.ForeignKey('contacts.AbstractContact', verbose_name=_('contact'), null=True, on_delete=models.SET_NULL)
-    email_to_send = models.TextField(_('email to send'), default="")
     documents = models.ManyToManyField(Document, verbose_name=_('documents'), blank=True)
     doc_in_link = models.BooleanField(_('documents in link'), null=False, default=False)
+    nb_by_batch = models.IntegerField(_('batch size'), null=False, default=0)
+    delay_batch = models.FloatField(_('batch delay'), null=False, default=0)
+    sending_rate = models.FloatField(_('sending rate (emails/s)'), null=False, default=0)
 
     def __init__(self, *args, **kwargs):
         LucteriosModel.__init__(self, *args, **kwargs)
@@ -90,11 +94,11 @@ class Message(LucteriosModel):
 
     @property
     def contact_nb(self):
-        return len(self.get_contacts())
+        return self.get_contacts().count()
 
     @property
     def contact_noemail(self):
-        no_emails = self.get_contacts(False)
+        no_emails = AbstractContact.get_final_children(self.get_contacts(False))
         return '{[br/]}'.join([six.text_type(no_email) for no_email in no_emails])
 
     @classmethod
@@ -150,13 +154,19 @@ class Message(LucteriosModel):
     @transition(field=status, source=1, target=2, conditions=[lambda item:will_mail_send()])
     def sending(self):
         if will_mail_send():
-            email_list = []
-            for contact in self.get_contacts(True):
-                for email1 in contact.email.split(';'):
+            self.messagerecipient_set.all().delete()
+            email_set = set()
+            recipient_list = []
+            for contact_id, contact_email in self.get_contacts(True).order_by('id').values_list('id', 'email'):
+                for email1 in contact_email.split(';'):
                     for email2 in email1.split(','):
-                        if (":%s|" % email2) not in ("|".join(email_list) + '|'):
-                            email_list.append("%d:%s" % (contact.id, email2))
-            self.email_to_send = "\n".join(email_list)
+                        if email2 not in email_set:
+                            email_set.add(email2)
+                            recipient_list.append(MessageRecipient(message=self, contact_id=contact_id, email=email2))
+            MessageRecipient.objects.bulk_create(recipient_list)
+            self.nb_by_batch = Params.getvalue('mailing-nb-by-batch')
+            self.delay_batch = Params.getvalue('mailing-delay-batch')
+            self.sending_rate = 0
             self.save()
             self.emailsent_set.all().delete()
             if self._last_xfer is not None:
@@ -167,9 +177,21 @@ class Message(LucteriosModel):
             add_mailing_in_scheduler(check_nb=False, http_root_address=root_url)
         return
 
+    def get_nb_by_batch(self):
+        if self.nb_by_batch > 0:
+            return self.nb_by_batch
+        return Params.getvalue('mailing-nb-by-batch')
+
+    def get_delay_batch(self):
+        if self.delay_batch > 0:
+            return self.delay_batch
+        return Params.getvalue('mailing-delay-batch')
+
     def sendemail(self, nb_to_send, http_root_address):
         if will_mail_send() and (self.status == 2):
-            email_list = self.email_to_send.split("\n")
+            self.messagerecipient_set.filter(status=MessageRecipient.STATUS_SENDING).update(status=MessageRecipient.STATUS_PENDING)
+            recipient_list = list(self.messagerecipient_set.filter(status=MessageRecipient.STATUS_PENDING).order_by('id')[:nb_to_send])
+            MessageRecipient.objects.filter(id__in=[recipient.id for recipient in recipient_list]).update(status=MessageRecipient.STATUS_SENDING)
             link_html = ""
             files = []
             for doc in self.documents.all():
@@ -184,19 +206,26 @@ class Message(LucteriosModel):
             if self.doc_in_link and (link_html != ''):
                 link_html = "<hr/><h3>%s</h3><ul>%s</ul>" % (_('Shared documents'), link_html)
             email_content = "<html><body>%s%s</body></html>" % (toHtml(self.body), link_html)
-            for contact_email in email_list[:nb_to_send]:
-                contact_id, email = contact_email.split(':')
-                try:
-                    contact = AbstractContact.objects.get(id=contact_id)
-                except AbstractContact.DoesNotExist:
-                    contact = None
-                try:
-                    send_email([email], self.subject, email_content, files=files if len(files) > 0 else None)
-                    EmailSent.objects.create(message=self, contact=contact, email=email, date=timezone.now(), success=True)
-                except Exception as error:
-                    EmailSent.objects.create(message=self, contact=contact, email=email, date=timezone.now(), success=False, error=six.text_type(error))
-            self.email_to_send = "\n".join(email_list[nb_to_send:])
-            if self.email_to_send == '':
+            contacts = AbstractContact.objects.in_bulk([recipient.contact_id for recipient in recipient_list if recipient.contact_id is not None])
+            sent_ids = []
+            failed_ids = []
+            with EmailSenderPool() as sender_pool:
+                email_template = EmailTemplate(sender_pool.sender_email, self.subject, email_content, files)
+                email_errors = sender_pool.send_all([([recipient.email], email_template.get_content([recipient.email])) for recipient in recipient_list])
+                for recipient, error in zip(recipient_list, email_errors):
+                    EmailSent.objects.create(message=self, contact=contacts.get(recipient.contact_id), email=recipient.email, date=timezone.now(),
+                                             success=error is None, error=error if error is not None else "")
+                    if error is None:
+                        sent_ids.append(recipient.id)
+                    else:
+                        failed_ids.append(recipient.id)
+            MessageRecipient.objects.filter(id__in=sent_ids).update(status=MessageRecipient.STATUS_SENT)
+            MessageRecipient.objects.filter(id__in=failed_ids).update(status=MessageRecipient.STATUS_FAILED)
+            self.nb_by_batch, self.delay_batch = get_adaptive_batch(nb_to_send, self.get_delay_batch(), sender_pool.nb_sent, sender_pool.nb_throttled,
+                                                                    sender_pool.duration, Params.getvalue('mailing-delay-batch'), MAX_DELAY_BATCH,
+                                                                    Params.getvalue('mailing-nb-by-batch-max'))
+            self.sending_rate = sender_pool.rate
+            if not self.messagerecipient_set.filter(status=MessageRecipient.STATUS_PENDING).exists():
                 self.status = 1
             self.save()
         return
@@ -225,6 +254,21 @@ class Message(LucteriosModel):
         verbose_name_plural = _('messages')
 
 
+class EmailSentQuerySet(models.QuerySet):
+
+    def _fetch_all(self):
+        is_new_fetch = self._result_cache is None
+        models.QuerySet._fetch_all(self)
+        if is_new_fetch:
+            AbstractContact.attach_final_children([item.contact for item in self._result_cache if isinstance(item, EmailSent) and (item.contact is not None)])
+
+
+class EmailSentManager(models.Manager.from_queryset(EmailSentQuerySet)):
+
+    def get_queryset(self):
+        return super(EmailSentManager, self).get_queryset().select_related('contact')
+
+
 class EmailSent(LucteriosModel):
     message = models.ForeignKey(Message, verbose_name=_('message'), null=False, on_delete=models.CASCADE)
     contact = models.ForeignKey('contacts.AbstractContact', verbose_name=_('contact'), null=True, on_delete=models.SET_NULL)
@@ -233,6 +277,8 @@ class EmailSent(LucteriosModel):
     success = models.BooleanField(verbose_name=_('success'), default=False)
     error = models.TextField(_('error'), default="")
 
+    objects = EmailSentManager()
+
     @classmethod
     def get_default_fields(cls):
         return ['contact', 'email', 'date', 'success', 'error']
@@ -244,19 +290,51 @@ class EmailSent(LucteriosModel):
         ordering = ['date', 'email']
 
 
+class MessageRecipient(LucteriosModel):
+    STATUS_PENDING = 0
+    STATUS_SENDING = 1
+    STATUS_SENT = 2
+    STATUS_FAILED = 3
+
+    message = models.ForeignKey(Message, verbose_name=_('message'), null=False, on_delete=models.CASCADE)
+    contact = models.ForeignKey('contacts.AbstractContact', verbose_name=_('contact'), null=True, on_delete=models.SET_NULL)
+    email = models.CharField(_('email'), max_length=254, blank=False)
+    status = models.IntegerField(verbose_name=_('status'), default=STATUS_PENDING,
+                                 choices=((STATUS_PENDING, _('pending')), (STATUS_SENDING, _('sending')), (STATUS_SENT, _('sent')), (STATUS_FAILED, _('failed'))))
+
+    class Meta(object):
+        verbose_name = _('recipient')
+        verbose_name_plural = _('recipients')
+        default_permissions = []
+        unique_together = [('message', 'email')]
+        index_together = [('message', 'status')]
+
+
+def get_mailing_delay():
+    delays = [msg_item.get_delay_batch() for msg_item in Message.objects.filter(status=2)]
+    if len(delays) > 0:
+        return max(delays)
+    return Params.getvalue('mailing-delay-batch')
+
+
 def send_mailing_in_waiting(http_root_address):
     '''Mailing'''
     msg_list = Message.objects.filter(status=2)
     if len(msg_list) == 0:
         LucteriosScheduler.remove(send_mailing_in_waiting)
     else:
+        old_delay = get_mailing_delay()
         for msg_item in msg_list:
-            msg_item.sendemail(Params.getvalue('mailing-nb-by-batch'), http_root_address)
+            msg_item.sendemail(msg_item.get_nb_by_batch(), http_root_address)
+        new_delay = get_mailing_delay()
+        if new_delay != old_delay:
+            LucteriosScheduler.remove(send_mailing_in_waiting)
+            LucteriosScheduler.add_task(send_mailing_in_waiting, minutes=new_delay, http_root_address=http_root_address)
 
 
 def add_mailing_in_scheduler(check_nb=True, http_root_address=""):
     if not check_nb or (Message.objects.filter(status=2).count() > 0):
-        LucteriosScheduler.add_task(send_mailing_in_waiting, minutes=Params.getvalue('mailing-delay-batch'), http_root_address=http_root_address)
+        LucteriosScheduler.add_task(send_mailing_in_waiting, minutes=get_mailing_delay(), http_root_address=http_root_address)
 
 
 @Signal.decorate('checkparam')
@@ -274,3 +352,7 @@ def mailing_checkparam():
                                value=_('''Connection confirmation to your application:{[br/]} - User:%(username)s{[br/]} - Password:%(password)s{[br/]}'''))
     Parameter.check_and_create(name='mailing-delay-batch', typeparam=2, title=_("mailing-delay-batch"), args="{'Min': 0.1, 'Max': 120, 'Prec': 1}", value='15')
     Parameter.check_and_create(name='mailing-nb-by-batch', typeparam=1, title=_("mailing-nb-by-batch"), args="{'Min': 1, 'Max': 100}", value='10')
+    Parameter.check_and_create(name='mailing-nb-by-batch-max', typeparam=1, title=_("mailing-nb-by-batch-max"), args="{'Min': 1, 'Max': 10000}", value='500')
+    Parameter.check_and_create(name='mailing-msg-by-connection', typeparam=1, title=_("mailing-msg-by-connection"), args="{'Min': 1, 'Max': 1000}", value='100')
+    Parameter.check_and_create(name='mailing-nb-connection', typeparam=1, title=_("mailing-nb-connection"), args="{'Min': 1, 'Max': 20}", value='2')
+    Parameter.check_and_create(name='mailing-rate', typeparam=2, title=_("mailing-rate"), args="{'Min': 0, 'Max': 1000, 'Prec': 1}", value='0')
@@ -42,7 +42,7 @@ def decode_b64(data):
     return decoded.decode('utf-8')
 
 
-def configSMTP(server, port, security=0, user='', passwd='', batchtime=0.1, batchsize=20):
+def configSMTP(server, port, security=0, user='', passwd='', batchtime=0.1, batchsize=20, nbconnection=1, rate=0):
     param = Parameter.objects.get(name='mailing-smtpserver')
     param.value = server
     param.save()
@@ -64,6 +64,12 @@ def configSMTP(server, port, security=0, user='', passwd='', batchtime=0.1, batc
     param = Parameter.objects.get(name='mailing-nb-by-batch')
     param.value = "%.d" % batchsize
     param.save()
+    param = Parameter.objects.get(name='mailing-nb-connection')
+    param.value = "%d" % nbconnection
+    param.save()
+    param = Parameter.objects.get(name='mailing-rate')
+    param.value = "%.1f" % rate
+    param.save()
     Params.clear()
 
 
@@ -103,6 +109,11 @@ class TestSMTPServer(smtpd.SMTPServer):
     emails = []
     with_authentificate = False
     auth_params = None
+    nb_connections = 0
+
+    def handle_accepted(self, conn, addr):
+        self.nb_connections += 1
+        smtpd.SMTPServer.handle_accepted(self, conn, addr)
 
     def process_message(self, peer, mailfrom, rcpttos, data):
         self.emails.append((peer, mailfrom, rcpttos, data))
@@ -120,6 +131,7 @@ class TestReceiver(TestCase):
         self.smtp.emails = []
         self.smtp.with_authentificate = False
         self.smtp.auth_params = None
+        self.smtp.nb_connections = 0
         self.thread = Thread(target=asyncore.loop, kwargs={'timeout': 1})
         self.thread.start()
 
@@ -130,6 +142,9 @@ class TestReceiver(TestCase):
     def count(self):
         return len(self.smtp.emails)
 
+    def connection_count(self):
+        return self.smtp.nb_connections
+
     def get(self, index):
         return self.smtp.emails[index]
 
@@ -28,7 +28,9 @@ from base64 import b64decode
 from os.path import join, dirname
 from _io import BytesIO
 from io import SEEK_END
-from time import sleep
+from time import sleep, time
+from email import message_from_string
+from smtplib import SMTPServerDisconnected
 
 from django.utils import six
 from django.contrib.auth.models import AnonymousUser
@@ -45,14 +47,15 @@ from lucterios.CORE.views import AskPassword, AskPasswordAct
 
 from lucterios.contacts.tests_contacts import change_ourdetail, create_jack
 from lucterios.contacts.views import CreateAccount
-from lucterios.contacts.models import Individual, LegalEntity
+from lucterios.contacts.models import Individual, LegalEntity, CustomField
 
 from lucterios.mailing.views import Configuration, SendEmailTry
-from lucterios.mailing.functions import will_mail_send, send_email
+from lucterios.mailing.functions import will_mail_send, send_email, EmailSender, EmailTemplate, EmailSenderPool, get_adaptive_batch
 from lucterios.mailing.views_message import MessageAddModify, MessageList, MessageDel, MessageShow, MessageValidRecipient,\
     MessageDelRecipient, MessageLetter, MessageTransition, MessageInsertDoc,\
     MessageValidInsertDoc, MessageRemoveDoc
 from lucterios.mailing.test_tools import configSMTP, decode_b64, TestReceiver
+from lucterios.mailing.models import Message, MessageRecipient, EmailSent, send_mailing_in_waiting
 
 from lucterios.documents.tests import create_doc
 
@@ -66,6 +69,7 @@ class ConfigurationTest(LucteriosTest):
     def setUp(self):
         change_ourdetail()
         LucteriosTest.setUp(self)
+        CustomField.clear_cache()
         rmtree(get_user_dir(), True)
         self.server.start(1025)
 
@@ -78,7 +82,7 @@ class ConfigurationTest(LucteriosTest):
         self.calljson('/lucterios.mailing/configuration', {}, False)
         self.assert_observer('core.custom', 'lucterios.mailing', 'configuration')
         self.assertEqual(len(self.json_context), 0)
-        self.assert_count_equal('', 2 + 8 + 2 + 2)
+        self.assert_count_equal('', 2 + 12 + 2 + 2)
         self.assert_json_equal('LABELFORM', "mailing-smtpserver", '')
         self.assert_json_equal('LABELFORM', "mailing-smtpport", '25')
         self.assert_json_equal('LABELFORM', "mailing-smtpsecurity", 'Aucune')
@@ -88,6 +92,10 @@ class ConfigurationTest(LucteriosTest):
                                'Bienvenue{[br/]}{[br/]}Confirmation de connexion à votre application :{[br/]} - Alias : %(username)s{[br/]} - Mot de passe : %(password)s{[br/]}{[br/]}Salutations{[br/]}')
         self.assert_json_equal('LABELFORM', "mailing-delay-batch", '15.0')
         self.assert_json_equal('LABELFORM', "mailing-nb-by-batch", '10')
+        self.assert_json_equal('LABELFORM', "mailing-nb-by-batch-max", '500')
+        self.assert_json_equal('LABELFORM', "mailing-msg-by-connection", '100')
+        self.assert_json_equal('LABELFORM', "mailing-nb-connection", '2')
+        self.assert_json_equal('LABELFORM', "mailing-rate", '0.0')
 
     def test_tryemail_noconfig(self):
         configSMTP('', 25)
@@ -149,6 +157,28 @@ class ConfigurationTest(LucteriosTest):
         self.assertEqual('Yessss!!!', decode_b64(msg.get_payload()))
         self.assertEqual(None, self.server.smtp.auth_params)
 
+    def test_send_pool(self):
+        configSMTP('localhost', 1025)
+        with EmailSender(2) as sender:
+            for idx in range(5):
+                send_email('toto%d@machin.com' % idx, 'send with pool', 'Yessss!!!', sender=sender)
+            self.assertEqual(3, sender.nb_connections)
+            sender.server.close()
+            send_email('titi@machin.com', 'send after disconnect', 'Yessss!!!', sender=sender)
+            self.assertEqual(4, sender.nb_connections)
+            try:
+                send_email('émilie@machin.com', 'send unicode', 'boom!!!', sender=sender)
+                self.assertTrue(False)
+            except LucteriosException as error:
+                self.assertEqual(six.text_type(error)[:36], "'ascii' codec can't encode character")
+            send_email('tata@machin.com', 'send after error', 'Yessss!!!', sender=sender)
+            self.assertEqual(5, sender.nb_connections)
+        self.assertEqual(7, self.server.count())
+        self.assertEqual(5, self.server.connection_count())
+        self.assertEqual(['toto4@machin.com'], self.server.get(4)[2])
+        self.assertEqual(['titi@machin.com'], self.server.get(5)[2])
+        self.assertEqual(['tata@machin.com'], self.server.get(6)[2])
+
     def test_send_copyhimself(self):
         configSMTP('localhost', 1025)
         self.assertEqual(0, self.server.count())
@@ -309,6 +339,72 @@ class ConfigurationTest(LucteriosTest):
             file1.close()
             file2.close()
 
+    def test_send_template(self):
+        file1 = BytesIO(get_binay('blablabla\blabla.'))
+        try:
+            configSMTP('localhost', 1025)
+            with EmailSender() as sender:
+                email_template = EmailTemplate(sender.sender_email, 'send template', '<html>template sent!</html>', [('filename1.txt', file1)])
+                for email in ('toto@machin.com', 'titi@machin.com'):
+                    sender.sendmail([email], email_template.get_content([email]))
+            self.assertEqual(2, self.server.count())
+            self.assertEqual(1, self.server.connection_count())
+            for idx, email in enumerate(('toto@machin.com', 'titi@machin.com')):
+                self.assertEqual([email], self.server.get(idx)[2])
+                msg = message_from_string(self.server.get(idx)[3])
+                self.assertEqual(email, msg.get('To', ''))
+                self.assertEqual('send template', msg.get('Subject', ''))
+                msg_body, msg_f1 = msg.get_payload()
+                self.assertEqual('text/html', msg_body.get_content_type())
+                self.assertEqual('<html>template sent!</html>', decode_b64(msg_body.get_payload()))
+                self.assertEqual('blablabla\blabla.', decode_b64(msg_f1.get_payload()))
+        finally:
+            file1.close()
+
+    def test_send_reconnect(self):
+        configSMTP('localhost', 1025)
+        with EmailSender() as sender:
+            email_template = EmailTemplate(sender.sender_email, 'send reconnect', 'Yessss!!!')
+            sender.sendmail(['toto@machin.com'], email_template.get_content(['toto@machin.com']))
+            sender.server.close()
+            sender.sendmail(['titi@machin.com'], email_template.get_content(['titi@machin.com']))
+            self.assertEqual(2, self.server.count())
+            self.assertEqual(2, self.server.connection_count())
+
+            def data_disconnected(msg):
+                raise SMTPServerDisconnected('Connection unexpectedly closed')
+            sender.server.data = data_disconnected
+            try:
+                sender.sendmail(['tutu@machin.com'], email_template.get_content(['tutu@machin.com']))
+                self.assertTrue(False)
+            except LucteriosException as error:
+                self.assertEqual('Connection unexpectedly closed', six.text_type(error))
+        self.assertEqual(2, self.server.count())
+        self.assertEqual(2, self.server.connection_count())
+
+    def test_send_concurrent(self):
+        configSMTP('localhost', 1025)
+        emails = ['toto%d@machin.com' % idx for idx in range(10)] + ['émilie@machin.com']
+        start_time = time()
+        with EmailSenderPool(3, 20.0) as sender_pool:
+            email_template = EmailTemplate(sender_pool.sender_email, 'send concurrent', 'Yessss!!!')
+            errors = list(sender_pool.send_all([([email], email_template.get_content([email])) for email in emails]))
+        self.assertGreaterEqual(time() - start_time, 0.5)
+        self.assertEqual([None] * 10, errors[:10])
+        self.assertEqual("'ascii' codec can't encode character", errors[10][:36])
+        self.assertEqual(10, self.server.count())
+        self.assertLessEqual(self.server.connection_count(), 4)
+        self.assertEqual(sorted(emails[:10]), sorted([self.server.get(idx)[2][0] for idx in range(10)]))
+
+    def test_adaptive_batch(self):
+        self.assertEqual((20, 1.0), get_adaptive_batch(10, 1.0, 10, 0, 2.0, 1.0, 120, 500))
+        self.assertEqual((15, 1.0), get_adaptive_batch(10, 1.0, 10, 0, 20.0, 1.0, 120, 500))
+        self.assertEqual((12, 1.0), get_adaptive_batch(10, 1.0, 10, 0, 2.0, 1.0, 120, 12))
+        self.assertEqual((10, 1.0), get_adaptive_batch(10, 1.0, 6, 0, 2.0, 1.0, 120, 500))
+        self.assertEqual((5, 2.0), get_adaptive_batch(10, 1.0, 8, 2, 2.0, 1.0, 120, 500))
+        self.assertEqual((1, 120), get_adaptive_batch(1, 100.0, 0, 1, 2.0, 1.0, 120, 500))
+        self.assertEqual((1, 2.0), get_adaptive_batch(5, 4.0, 5, 0, 200.0, 1.0, 120, 500))
+
     def test_user_withoutconfig(self):
         configSMTP('', 25)
         self.factory.xfer = UsersEdit()
@@ -347,6 +443,7 @@ class MailingTest(LucteriosTest):
 
     def setUp(self):
         LucteriosTest.setUp(self)
+        CustomField.clear_cache()
         change_ourdetail()
         create_jack(firstname="jack", lastname="MISTER", with_email=True)
         create_jack(firstname="jean", lastname="Valjean", with_email=False)
@@ -479,6 +576,44 @@ class MailingTest(LucteriosTest):
         self.assert_action_equal(self.json_actions[1], ('Lettres', 'lucterios.mailing/images/letter.png', 'lucterios.mailing', 'messageLetter', 0, 1, 1))
         self.assert_action_equal(self.json_actions[2], ('Fermer', 'images/close.png'))
 
+    def test_recipient_queue(self):
+        contact_jack = Individual.objects.get(id=2)
+        contact_jack.email += ';joe@worldcompany.com'
+        contact_jack.save()
+        create_jack(firstname="joe", lastname="Dalton", with_email=True)
+        configSMTP('localhost', 1025)
+        self.factory.xfer = MessageAddModify()
+        self.calljson('/lucterios.mailing/messageAddModify', {'SAVE': 'YES', 'subject': 'new message', 'body': 'Small message'}, False)
+        self.factory.xfer = MessageValidRecipient()
+        self.calljson('/lucterios.mailing/messageValidRecipient', {'message': '1', 'modelname': 'contacts.Individual', 'CRITERIA': 'genre||8||1'}, False)
+        self.factory.xfer = MessageValidRecipient()
+        self.calljson('/lucterios.mailing/messageValidRecipient', {'message': '1', 'modelname': 'contacts.LegalEntity', 'CRITERIA': ''}, False)
+        self.factory.xfer = MessageTransition()
+        self.calljson('/lucterios.mailing/messageTransition', {'message': '1', 'TRANSITION': 'valid', 'CONFIRME': 'YES'}, False)
+        msg = Message.objects.get(id=1)
+        try:
+            msg.sending()
+            msg.save()
+        finally:
+            LucteriosScheduler.remove(send_mailing_in_waiting)
+        self.assertEqual([(1, 'mr-sylvestre@worldcompany.com', 0), (2, 'jack@worldcompany.com', 0), (2, 'joe@worldcompany.com', 0)],
+                         list(MessageRecipient.objects.filter(message=msg).order_by('id').values_list('contact_id', 'email', 'status')))
+        server = TestReceiver()
+        server.start(1025)
+        try:
+            msg.sendemail(2, '')
+            self.assertEqual(2, server.count())
+            self.assertEqual(2, Message.objects.get(id=1).status)
+            self.assertEqual([2, 2, 0], list(MessageRecipient.objects.filter(message=msg).order_by('id').values_list('status', flat=True)))
+            msg.sendemail(2, '')
+            self.assertEqual(3, server.count())
+            self.assertEqual(['joe@worldcompany.com'], server.get(2)[2])
+            self.assertEqual(1, Message.objects.get(id=1).status)
+            self.assertEqual([2, 2, 2], list(MessageRecipient.objects.filter(message=msg).order_by('id').values_list('status', flat=True)))
+        finally:
+            server.stop()
+        self.assertEqual(3, EmailSent.objects.filter(message=msg, success=True).count())
+
     def test_letter_message(self):
         self.factory.xfer = MessageAddModify()
         self.calljson('/lucterios.mailing/messageAddModify', {'SAVE': 'YES', 'subject': 'new message', 'body':
@@ -582,6 +717,7 @@ class SendMailingTest(AsychronousLucteriosTest):
 
     def setUp(self):
         AsychronousLucteriosTest.setUp(self)
+        CustomField.clear_cache()
         change_ourdetail()
         create_jack(firstname="jack", lastname='Dalton')
         create_jack(firstname="joe", lastname='Dalton')
@@ -639,7 +775,8 @@ class SendMailingTest(AsychronousLucteriosTest):
 
         self.calljson('/lucterios.mailing/messageSentInfo', {'message': '1', 'show_only_failed': False})
         self.assert_observer('core.custom', 'lucterios.mailing', 'messageSentInfo')
-        self.assert_count_equal('', 6)
+        self.assert_count_equal('', 8)
+        self.assert_json_equal('LABELFORM', 'nb_by_batch', 8)
         self.assert_grid_equal('emailsent', {"contact": "contact", "email": "courriel", "date": "date", "success": "succès"}, 9)
         self.assert_json_equal('', "emailsent/@0/email", "mr-sylvestre@worldcompany.com")
         self.assert_json_equal('', "emailsent/@0/success", 1)
@@ -663,7 +800,7 @@ class SendMailingTest(AsychronousLucteriosTest):
 
         self.calljson('/lucterios.mailing/messageSentInfo', {'message': '1', 'show_only_failed': True})
         self.assert_observer('core.custom', 'lucterios.mailing', 'messageSentInfo')
-        self.assert_count_equal('', 6)
+        self.assert_count_equal('', 8)
         self.assert_grid_equal('emailsent', {"contact": "contact", "email": "courriel", "date": "date", "success": "succès", "error": "erreur"}, 1)
         self.assert_json_equal('', "emailsent/@0/email", "émilie@worldcompany.com")
         self.assert_json_equal('', "emailsent/@0/success", 0)
@@ -704,6 +841,7 @@ class UserTest(LucteriosTest):
 
     def setUp(self):
         LucteriosTest.setUp(self)
+        CustomField.clear_cache()
         self.factory.user = AnonymousUser()
         change_ourdetail()
         create_jack(LucteriosUser.objects.create(first_name='jack', last_name='MISTER', username='jack', email='jack@worldcompany.com'))
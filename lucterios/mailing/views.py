@@ -57,7 +57,8 @@ class Configuration(XferContainerCustom):
 
         conf_params = ['mailing-smtpserver', 'mailing-smtpport',
                        'mailing-smtpsecurity', 'mailing-smtpuser', 'mailing-smtppass',
-                       'mailing-delay-batch', 'mailing-nb-by-batch']
+                       'mailing-delay-batch', 'mailing-nb-by-batch', 'mailing-nb-by-batch-max', 'mailing-msg-by-connection',
+                       'mailing-nb-connection', 'mailing-rate']
         Params.fill(self, conf_params, 1, 1)
         btn = XferCompButton('editparam')
         btn.set_location(3, 1, 1, 5)
@@ -66,7 +66,6 @@ class MessageClone(XferContainerAcknowledge):
         new_item.subject = self.item.subject
         new_item.body = self.item.body
         new_item.recipients = self.item.recipients
-        new_item.email_to_send = ""
         new_item.doc_in_link = self.item.doc_in_link
         new_item.save()
         for doc in self.item.documents.all():
@@ -124,7 +123,8 @@ class MessageSentInfo(XferContainerCustom):
         begin.set_value_as_title(_('Transmission report'))
         self.add_component(begin)
 
-        self.filltab_from_model(1, 1, True, [((_('date begin of send'), 'date_begin'), (_('date end of send'), 'date_end')), ('emailsent_set',)])
+        self.filltab_from_model(1, 1, True, [((_('date begin of send'), 'date_begin'), (_('date end of send'), 'date_end')),
+                                             ('nb_by_batch', 'sending_rate'), ('emailsent_set',)])
         if not show_only_failed:
             grid = self.get_components('emailsent')
             grid.delete_header('error')
@@ -132,7 +132,7 @@ class MessageSentInfo(XferContainerCustom):
         check = XferCompCheck('show_only_failed')
         check.set_value(show_only_failed)
         check.description = _('Show only failed')
-        check.set_location(1, 3, 2)
+        check.set_location(1, self.get_max_row() + 1, 2)
         check.set_action(self.request, self.get_action(), modal=FORMTYPE_REFRESH, close=CLOSE_NO)
         self.add_component(check)
 
@@ -150,7 +150,7 @@ class MessageLetter(XferPrintReporting):
 
     def items_callback(self):
         items = []
-        for current_contact in self.item.get_contacts():
+        for current_contact in self.item.get_contacts().with_final_children():
             new_item = Message.objects.get(id=self.item.id)
             new_item.contact = current_contact
             items.append(new_item)
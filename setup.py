@@ -57,6 +57,8 @@ setup(
     packages=["lucterios", "lucterios.contacts", "lucterios.mailing"],
     package_data={
         "lucterios.contacts.migrations": ['*'],
+        "lucterios.contacts.management": ['*'],
+        "lucterios.contacts.management.commands": ['*'],
         "lucterios.contacts": ['build', 'images/*', 'locale/*/*/*', 'help/*'],
         "lucterios.mailing.migrations": ['*'],
         "lucterios.mailing": ['build', 'images/*', 'locale/*/*/*', 'help/*'],